@@ -0,0 +1,67 @@
+"""
+Size and encode/decode latency of cached recommendation lists: legacy JSON vs the binary codec.
+
+Usage:
+    python benchmark_cache_encoding.py
+    python benchmark_cache_encoding.py --items 50 100 200 --iterations 5000
+"""
+import argparse
+import json
+import time
+import numpy as np
+from config import TOP_K
+from recommendation_codec import decode_recommendations, encode_recommendations
+
+
+def synthetic_recommendations(n, seed=0):
+    """ObjectId-like item ids with descending scores, as written by the tasks"""
+    rng = np.random.default_rng(seed)
+    scores = np.sort(rng.uniform(0.3, 1.0, n))[::-1]
+    return [
+        {"item_id": rng.bytes(12).hex(), "score": float(score), "rank": rank + 1}
+        for rank, score in enumerate(scores)
+    ]
+
+
+def legacy_encode(recommendations):
+    return json.dumps({"user_id": "u" * 24, "recommendations": recommendations, "timestamp": int(time.time())})
+
+
+def per_call_us(fn, arg, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[TOP_K])
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'items':>6}  {'format':<8}{'bytes':>8}{'encode us':>11}{'decode us':>11}{'max |score err|':>17}")
+    for n in args.items:
+        recommendations = synthetic_recommendations(n)
+        truth = np.array([rec["score"] for rec in recommendations])
+
+        formats = [
+            ('json', legacy_encode),
+            ('binary', encode_recommendations),
+        ]
+        for name, encode in formats:
+            value = encode(recommendations)
+            decoded, _ = decode_recommendations(value)
+            error = np.abs(np.array([rec["score"] for rec in decoded]) - truth).max()
+            assert [rec["item_id"] for rec in decoded] == [rec["item_id"] for rec in recommendations]
+
+            print(
+                f"{n:>6}  {name:<8}{len(value.encode()):>8}"
+                f"{per_call_us(encode, recommendations, args.iterations):>11.1f}"
+                f"{per_call_us(decode_recommendations, value, args.iterations):>11.1f}"
+                f"{error:>17.5f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
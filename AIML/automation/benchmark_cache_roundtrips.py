@@ -0,0 +1,63 @@
+"""
+Round trips and latency of reading cached recommendations for many users from
+a local redis-server (REDIS_HOST / REDIS_PORT): one GET per user vs get_many (MGET).
+
+Writes its test entries under recommendations:bench-* and removes them afterwards.
+
+Usage:
+    python benchmark_cache_roundtrips.py
+    python benchmark_cache_roundtrips.py --users 1000 10000 --batch-size 500
+"""
+import argparse
+import time
+import redis
+from cache_manager import CacheManager, create_connection_pool
+from config import TOP_K
+from benchmark_cache_encoding import synthetic_recommendations
+
+
+class CountingConnection(redis.Connection):
+    """Counts requests written to the socket (a pipeline or MGET is one round trip)"""
+    round_trips = 0
+
+    def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        return super().send_packed_command(command, check_health)
+
+
+def measure(fn):
+    CountingConnection.round_trips = 0
+    started = time.perf_counter()
+    result = fn()
+    return result, CountingConnection.round_trips, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000])
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    cache = CacheManager(connection_pool=create_connection_pool(connection_class=CountingConnection))
+    recommendations = synthetic_recommendations(TOP_K)
+
+    print(f"{'users':>7}  {'method':<10}{'round trips':>12}{'per 1k users':>14}{'total ms':>10}")
+    for n in args.users:
+        user_ids = [f"bench-{i}" for i in range(n)]
+        for user_id in user_ids:
+            cache.cache_recommendations(user_id, recommendations)
+
+        methods = [
+            ('get', lambda: {user_id: cache.get_cached_recommendations(user_id) for user_id in user_ids}),
+            ('get_many', lambda: cache.get_many(user_ids, batch_size=args.batch_size)),
+        ]
+        for name, fn in methods:
+            result, round_trips, elapsed_ms = measure(fn)
+            assert all(result[user_id] for user_id in user_ids)
+            print(f"{n:>7}  {name:<10}{round_trips:>12}{round_trips * 1000 / n:>14.1f}{elapsed_ms:>10.1f}")
+
+        cache.invalidate_users(user_ids)
+
+
+if __name__ == '__main__':
+    main()
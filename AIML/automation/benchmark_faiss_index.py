@@ -0,0 +1,103 @@
+"""
+Recall vs latency benchmark of the FAISS index types against the exact flat index.
+
+Usage:
+    python benchmark_faiss_index.py                      # post embedding store (EMBEDDINGS_PATH)
+    python benchmark_faiss_index.py --synthetic 1000000  # clustered random vectors
+    python benchmark_faiss_index.py --nprobe 8 16 32 --ef-search 64 128 256
+"""
+import argparse
+import time
+import faiss
+import numpy as np
+from config import EMBEDDINGS_PATH, EMBEDDING_DIMENSION, TOP_K
+from embedding_store import EmbeddingStore
+from faiss_indexer import FAISSIndexer
+
+
+def synthetic_embeddings(n, dimension, n_clusters=256, seed=0):
+    """Clustered vectors, closer to real sentence embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dimension)).astype('float32')
+    labels = rng.integers(0, n_clusters, n)
+    return centers[labels] + 0.5 * rng.standard_normal((n, dimension)).astype('float32')
+
+
+def measure(indexer, queries, k, ground_truth):
+    """Recall@k vs ground truth plus single-query latency percentiles (ms)"""
+    latencies = []
+    hits = 0
+    for query, truth in zip(queries, ground_truth):
+        q = query.reshape(1, -1).copy()
+        started = time.perf_counter()
+        _, indices = indexer.index.search(q, k)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += len(np.intersect1d(indices[0], truth))
+
+    latencies = np.array(latencies)
+    return {
+        'recall': hits / ground_truth.size,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic posts (default: use the embedding store)')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, default=TOP_K)
+    parser.add_argument('--nlist', type=int, default=None, help='default: 4 * sqrt(#posts)')
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[8, 16, 32, 64])
+    parser.add_argument('--pq-m', type=int, default=48)
+    parser.add_argument('--hnsw-m', type=int, default=32)
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[64, 128, 256])
+    args = parser.parse_args()
+
+    if args.synthetic:
+        embeddings = synthetic_embeddings(args.synthetic, EMBEDDING_DIMENSION)
+    else:
+        embeddings = np.asarray(EmbeddingStore(EMBEDDINGS_PATH).vectors, dtype='float32')
+        if len(embeddings) == 0:
+            parser.error(f"No embeddings in {EMBEDDINGS_PATH}; use --synthetic N")
+
+    n = len(embeddings)
+    post_ids = list(range(n))
+    nlist = args.nlist or max(1, int(4 * np.sqrt(n)))
+
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(n, min(args.queries, n), replace=False)]
+    queries = queries + 0.1 * rng.standard_normal(queries.shape).astype('float32')
+    faiss.normalize_L2(queries)
+
+    print(f"{n} posts, dim {embeddings.shape[1]}, {len(queries)} queries, k={args.k}, nlist={nlist}")
+
+    flat = FAISSIndexer()
+    flat.create_index(embeddings, post_ids, index_type='flat')
+    _, ground_truth = flat.index.search(queries, args.k)
+
+    configs = [('flat', {}, [{}])]
+    configs.append(('ivf_flat', {'nlist': nlist}, [{'nprobe': p} for p in args.nprobe]))
+    configs.append(('ivf_pq', {'nlist': nlist, 'm': args.pq_m}, [{'nprobe': p} for p in args.nprobe]))
+    configs.append(('hnsw', {'m': args.hnsw_m}, [{'ef_search': e} for e in args.ef_search]))
+
+    print(f"{'index':<10}{'search params':<18}{'build s':>9}{'size MB':>9}{'recall':>8}{'p50 ms':>9}{'p99 ms':>9}")
+    for index_type, build_params, search_params in configs:
+        indexer = FAISSIndexer()
+        started = time.perf_counter()
+        indexer.create_index(embeddings, post_ids, index_type=index_type, **build_params)
+        build_seconds = time.perf_counter() - started
+        size_mb = faiss.serialize_index(indexer.index).nbytes / 1e6
+
+        for params in search_params:
+            indexer.set_search_params(**params)
+            result = measure(indexer, queries, args.k, ground_truth)
+            label = ' '.join(f"{key}={value}" for key, value in params.items()) or '-'
+            print(
+                f"{index_type:<10}{label:<18}{build_seconds:>9.1f}{size_mb:>9.1f}"
+                f"{result['recall']:>8.3f}{result['p50_ms']:>9.3f}{result['p99_ms']:>9.3f}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,62 +1,244 @@
 
 
 import redis
-import json
 import logging
-from config import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_TTL
+import time
+from config import (
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_DB,
+    REDIS_TTL,
+    REDIS_MAX_CONNECTIONS,
+    REDIS_POOL_TIMEOUT,
+    REDIS_SOCKET_TIMEOUT,
+    REDIS_SOCKET_CONNECT_TIMEOUT,
+    REDIS_SOCKET_KEEPALIVE,
+    REDIS_HEALTH_CHECK_INTERVAL,
+    CACHE_BINARY_ENCODING,
+    CACHE_SCAN_BATCH_SIZE,
+)
+from recommendation_codec import decode_recommendations, encode_recommendations
 
 logger = logging.getLogger(__name__)
 
+# DB 0 is shared with the Celery broker, so everything here stays inside
+# the recommendations namespace. Bookkeeping keys use their own prefix so
+# they never match "recommendations:*".
+NAMESPACE = "recommendations:"
+EXPIRY_INDEX_KEY = "recommendations_meta:expiry"  # zset user_id -> expiry (unix seconds)
+WRITE_STATS_KEY = "recommendations_meta:stats"    # hash: writes, bytes
+
+
+def create_connection_pool(connection_class=redis.Connection):
+    """
+    Bounded pool from the REDIS_* settings; callers wait up to
+    REDIS_POOL_TIMEOUT for a free connection instead of opening more.
+    """
+    return redis.BlockingConnectionPool(
+        connection_class=connection_class,
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=REDIS_DB,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=REDIS_SOCKET_KEEPALIVE,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+        decode_responses=True
+    )
+
 class CacheManager:
-    def __init__(self):
+    def __init__(self, connection_pool=None):
         try:
             self.redis_client = redis.Redis(
-                host=REDIS_HOST,
-                port=REDIS_PORT,
-                db=REDIS_DB,
-                decode_responses=True
+                connection_pool=connection_pool or create_connection_pool()
             )
             self.redis_client.ping()
             logger.info(f" Connected to Redis ({REDIS_HOST}:{REDIS_PORT})")
         except Exception as e:
             logger.error(f" Redis connection failed: {e}")
             raise
-    
+
+    def _key(self, user_id):
+        return f"{NAMESPACE}{user_id}"
+
     def cache_recommendations(self, user_id, recommendations):
         try:
-            key = f"recommendations:{user_id}"
-            value = json.dumps(recommendations)
-            self.redis_client.setex(key, REDIS_TTL, value)
+            key = self._key(user_id)
+            value = encode_recommendations(recommendations, binary=CACHE_BINARY_ENCODING)
+            now = time.time()
+
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.setex(key, REDIS_TTL, value)
+            # key count without KEYS: live users are the index members not yet expired
+            pipe.zadd(EXPIRY_INDEX_KEY, {str(user_id): now + REDIS_TTL})
+            pipe.zremrangebyscore(EXPIRY_INDEX_KEY, "-inf", now)
+            pipe.hincrby(WRITE_STATS_KEY, "writes", 1)
+            pipe.hincrby(WRITE_STATS_KEY, "bytes", len(value))
+            pipe.execute()
             logger.info(f"Cached {len(recommendations)} recommendations for {user_id}")
         except Exception as e:
             logger.error(f"Error caching: {e}")
-    
+
     def get_cached_recommendations(self, user_id):
         try:
-            key = f"recommendations:{user_id}"
+            key = self._key(user_id)
             cached = self.redis_client.get(key)
             if cached:
-                return json.loads(cached)
+                recommendations, _ = decode_recommendations(cached)
+                return recommendations
             return None
         except Exception as e:
             logger.error(f"Error retrieving cache: {e}")
             return None
-    
+
+    def get_many(self, user_ids, batch_size=CACHE_SCAN_BATCH_SIZE):
+        """
+        Cached recommendations for many users, one MGET per batch_size users
+
+        Args:
+            user_ids: Iterable of user ids
+            batch_size: Keys per MGET
+
+        Returns:
+            Dict user_id -> recommendations (None if not cached)
+        """
+        user_ids = [str(user_id) for user_id in user_ids]
+        results = {}
+        try:
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                values = self.redis_client.mget([self._key(user_id) for user_id in batch])
+                for user_id, value in zip(batch, values):
+                    results[user_id] = decode_recommendations(value)[0] if value else None
+        except Exception as e:
+            logger.error(f"Error retrieving cache: {e}")
+            results.update((user_id, None) for user_id in user_ids if user_id not in results)
+        return results
+
+    # ----------------- Bulk invalidation (SCAN + pipelined UNLINK) -----------------
+    def _scan_batches(self, match, batch_size):
+        """Yield lists of up to batch_size keys matching the pattern, one SCAN page at a time."""
+        batch = []
+        for key in self.redis_client.scan_iter(match=match, count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _unlink(self, keys):
+        """UNLINK keys (memory is freed off the main thread) and drop them from the expiry index."""
+        if not keys:
+            return 0
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.unlink(*keys)
+        pipe.zrem(EXPIRY_INDEX_KEY, *[key[len(NAMESPACE):] for key in keys])
+        removed, _ = pipe.execute()
+        return removed
+
+    def invalidate_users(self, user_ids, batch_size=CACHE_SCAN_BATCH_SIZE):
+        """
+        Remove cached recommendations for a set of users
+
+        Args:
+            user_ids: Iterable of user ids
+            batch_size: Keys per UNLINK pipeline
+
+        Returns:
+            Number of entries removed
+        """
+        keys = [self._key(user_id) for user_id in user_ids]
+        removed = 0
+        try:
+            for start in range(0, len(keys), batch_size):
+                removed += self._unlink(keys[start:start + batch_size])
+            logger.info(f"Invalidated {removed} cached users")
+        except Exception as e:
+            logger.error(f"Error invalidating users: {e}")
+        return removed
+
+    def invalidate_post(self, post_id, batch_size=CACHE_SCAN_BATCH_SIZE):
+        """
+        Remove every cached list that contains post_id
+
+        Walks the namespace with SCAN + MGET one page at a time, so Redis
+        keeps serving other clients in between.
+
+        Returns:
+            Number of entries removed
+        """
+        post_id = str(post_id)
+        removed = 0
+        try:
+            for keys in self._scan_batches(f"{NAMESPACE}*", batch_size):
+                affected = []
+                for key, value in zip(keys, self.redis_client.mget(keys)):
+                    if not value:
+                        continue
+                    try:
+                        recommendations, _ = decode_recommendations(value)
+                    except Exception:
+                        logger.warning(f"Skipping undecodable cache entry {key}")
+                        continue
+                    if any(str(rec.get("item_id")) == post_id for rec in recommendations):
+                        affected.append(key)
+                removed += self._unlink(affected)
+            logger.info(f"Invalidated {removed} cached users containing post {post_id}")
+        except Exception as e:
+            logger.error(f"Error invalidating post {post_id}: {e}")
+        return removed
+
+    def invalidate_prefix(self, prefix="", batch_size=CACHE_SCAN_BATCH_SIZE):
+        """
+        Remove all entries under recommendations:{prefix} (e.g. prefix "v3:")
+
+        Returns:
+            Number of entries removed
+        """
+        removed = 0
+        try:
+            for keys in self._scan_batches(f"{NAMESPACE}{prefix}*", batch_size):
+                removed += self._unlink(keys)
+            logger.info(f"Invalidated {removed} cached entries under {NAMESPACE}{prefix}")
+        except Exception as e:
+            logger.error(f"Error invalidating {NAMESPACE}{prefix}: {e}")
+        return removed
+
     def clear_all_cache(self):
+        """Remove all cached recommendations; other data on the DB (Celery broker) is left alone."""
         try:
-            self.redis_client.flushdb()
+            self.invalidate_prefix("")
+            self.redis_client.unlink(EXPIRY_INDEX_KEY, WRITE_STATS_KEY)
             logger.info(" Cache cleared")
             return True
         except Exception as e:
             logger.error(f"Error clearing cache: {e}")
             return False
-    
+
+    # ----------------- Statistics -----------------
     def get_cache_stats(self):
+        """
+        Stats from the maintained counters; O(log n), safe to poll
+
+        Returns:
+            Dict with cached_users, average / estimated value bytes, Redis
+            memory and TTL
+        """
         try:
-            info = self.redis_client.info()
-            keys = len(self.redis_client.keys("recommendations:*"))
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.zcount(EXPIRY_INDEX_KEY, time.time(), "+inf")
+            pipe.hmget(WRITE_STATS_KEY, "writes", "bytes")
+            cached_users, (writes, written_bytes) = pipe.execute()
+            info = self.redis_client.info("memory")
+
+            avg_bytes = int(written_bytes) / int(writes) if writes else 0.0
             return {
-                'cached_users': keys,
+                'cached_users': cached_users,
+                'avg_value_bytes': round(avg_bytes, 1),
+                'estimated_value_bytes': int(avg_bytes * cached_users),
                 'total_memory_bytes': info.get('used_memory', 0),
                 'ttl_seconds': REDIS_TTL
             }
@@ -64,6 +246,31 @@ class CacheManager:
             logger.error(f"Error getting stats: {e}")
             return {}
 
+    def scan_cache_stats(self, batch_size=CACHE_SCAN_BATCH_SIZE):
+        """
+        Exact key count and value bytes by walking the namespace with SCAN
+
+        Slower than get_cache_stats but never blocks Redis, and also counts
+        entries written by clients that bypass the counters.
+        """
+        try:
+            cached_users = 0
+            value_bytes = 0
+            for keys in self._scan_batches(f"{NAMESPACE}*", batch_size):
+                pipe = self.redis_client.pipeline(transaction=False)
+                for key in keys:
+                    pipe.strlen(key)
+                value_bytes += sum(pipe.execute())
+                cached_users += len(keys)
+            return {
+                'cached_users': cached_users,
+                'value_bytes': value_bytes,
+                'ttl_seconds': REDIS_TTL
+            }
+        except Exception as e:
+            logger.error(f"Error scanning stats: {e}")
+            return {}
+
 _cache = None
 
 def get_cache_manager():
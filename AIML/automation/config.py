@@ -10,6 +10,13 @@ load_dotenv()
 UPSTASH_REDIS_REST_URL = os.getenv("UPSTASH_REDIS_REST_URL")
 UPSTASH_REDIS_REST_TOKEN = os.getenv("UPSTASH_REDIS_REST_TOKEN")
 UPSTASH_REDIS_URL = os.getenv("UPSTASH_REDIS_URL")  # redis://:token@host:port
+# HTTP connection pool of the REST clients (one per process and client)
+UPSTASH_MAX_CONNECTIONS = int(os.getenv("UPSTASH_MAX_CONNECTIONS", 100))
+UPSTASH_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTASH_MAX_KEEPALIVE_CONNECTIONS", 20))
+UPSTASH_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("UPSTASH_KEEPALIVE_EXPIRY_SECONDS", 60))
+UPSTASH_TIMEOUT_SECONDS = float(os.getenv("UPSTASH_TIMEOUT_SECONDS", 5))
+UPSTASH_REST_RETRIES = int(os.getenv("UPSTASH_REST_RETRIES", 1))
+UPSTASH_MGET_BATCH_SIZE = int(os.getenv("UPSTASH_MGET_BATCH_SIZE", 500))  # keys per MGET in get_many
 
 
 # ============================================================================
@@ -55,6 +62,7 @@ LOGS_DIR.mkdir(exist_ok=True)
 # ============================================================================
 MONGO_URI = os.getenv("MONGO_URI")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "global_bene")
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", 1000))  # docs per cursor batch / column chunk
 
 
 # ============================================================================
@@ -64,6 +72,13 @@ REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_DB = int(os.getenv("REDIS_DB", 0))
 REDIS_TTL = 24 * 3600  # 24 hours in seconds
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))  # wait for a free pooled connection
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 2))
+REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "true").lower() == "true"
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+CACHE_SCAN_BATCH_SIZE = int(os.getenv("CACHE_SCAN_BATCH_SIZE", 1000))  # keys per SCAN page / UNLINK pipeline
 
 
 # ============================================================================
@@ -83,9 +98,27 @@ FAISS_INDEX_PATH = os.getenv(
     "FAISS_INDEX_PATH", 
     str(MODELS_DIR / "faiss_index.bin")
 )
+# Index type: "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw"
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")
+FAISS_TRAIN_SAMPLE_SIZE = int(os.getenv("FAISS_TRAIN_SAMPLE_SIZE", 100000))
+FAISS_NLIST = int(os.getenv("FAISS_NLIST", 1024))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", 16))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", 48))  # must divide EMBEDDING_DIMENSION
+FAISS_PQ_NBITS = int(os.getenv("FAISS_PQ_NBITS", 8))
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", 32))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", 200))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", 128))
+FAISS_OMP_THREADS = int(os.getenv("FAISS_OMP_THREADS", 0))  # 0 = FAISS default (all cores)
+# memory-map the index and id table so worker processes share one page-cache copy
+FAISS_MMAP = os.getenv("FAISS_MMAP", "true").lower() == "true"
+FAISS_COMPACT_INTERVAL_SECONDS = int(os.getenv("FAISS_COMPACT_INTERVAL_SECONDS", 3600))  # fold the delta log into a new snapshot
 EMBEDDINGS_PATH = os.getenv(
     "EMBEDDINGS_PATH", 
-    str(MODELS_DIR / "post_embeddings.pkl")
+    str(MODELS_DIR / "post_embeddings.npy")
+)
+USER_EMBEDDINGS_PATH = os.getenv(
+    "USER_EMBEDDINGS_PATH",
+    str(MODELS_DIR / "user_embeddings.npy")
 )
 
 
@@ -97,8 +130,40 @@ MODEL_PATH = os.getenv(
     str(MODELS_DIR / "recommendation_model.pkl")
 )
 TOP_K = int(os.getenv("TOP_K", 50))
+COLLAB_TOP_N_NEIGHBOURS = int(os.getenv("COLLAB_TOP_N_NEIGHBOURS", 5))
+COLLAB_INCLUDE_COMMENT_VOTES = os.getenv("COLLAB_INCLUDE_COMMENT_VOTES", "false").lower() == "true"  # comment co-votes widen neighbour similarity
+HEURISTICS_REFRESH_SECONDS = int(os.getenv("HEURISTICS_REFRESH_SECONDS", 300))  # 0 disables
+# two-stage pipeline: candidates per source before re-ranking
+CANDIDATE_ANN_K = int(os.getenv("CANDIDATE_ANN_K", 200))
+CANDIDATE_POPULAR_K = int(os.getenv("CANDIDATE_POPULAR_K", 100))  # overall and per followed community
+CANDIDATE_COLLAB_K = int(os.getenv("CANDIDATE_COLLAB_K", 200))
+# compute warm-user cache misses inside the API within a latency budget, Celery otherwise;
+# inline lists are the heuristic two-stage ranking, Celery caches the SBERT/FAISS list
+INLINE_WARM_RECOMMENDATIONS = os.getenv("INLINE_WARM_RECOMMENDATIONS", "false").lower() == "true"
+INLINE_WARM_BUDGET_MS = int(os.getenv("INLINE_WARM_BUDGET_MS", 150))
+INLINE_WARM_WORKERS = int(os.getenv("INLINE_WARM_WORKERS", 4))
+BATCH_MAX_USERS = int(os.getenv("BATCH_MAX_USERS", 5000))  # user ids per POST /recommendations/batch
 EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", 384))
-CACHE_EXPIRY_HOURS = int(os.getenv("CACHE_EXPIRY_HOURS", 24))
+CACHE_EXPIRY_HOURS = int(os.getenv("CACHE_EXPIRY_HOURS", 24))  # freshness (soft TTL)
+# per-user extra freshness, up to this fraction of CACHE_EXPIRY_HOURS, so entries written
+# together (nightly batch) do not go stale together; keep it below CACHE_STALE_GRACE_HOURS
+CACHE_EXPIRY_JITTER = float(os.getenv("CACHE_EXPIRY_JITTER", 0.25))
+# stale entries stay readable this much longer and are served while a refresh runs
+CACHE_STALE_GRACE_HOURS = int(os.getenv("CACHE_STALE_GRACE_HOURS", 24))
+# compact binary cache values (see recommendation_codec); false writes JSON, reads accept both
+CACHE_BINARY_ENCODING = os.getenv("CACHE_BINARY_ENCODING", "true").lower() == "true"
+# in-process LRU in front of Upstash; 0 entries disables it
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", 10000))
+LOCAL_CACHE_TTL_SECONDS = float(os.getenv("LOCAL_CACHE_TTL_SECONDS", 60))
+# readers re-read the cache generation pointer at most this often (nightly batch flips it)
+CACHE_GENERATION_POLL_SECONDS = float(os.getenv("CACHE_GENERATION_POLL_SECONDS", 5))
+# unpublished generation counts as abandoned (and collectable) once its run stops writing for this long
+CACHE_GENERATION_BUILD_TTL_SECONDS = int(os.getenv("CACHE_GENERATION_BUILD_TTL_SECONDS", 3600))
+# single-flight marker for on-demand refreshes; outlives a normal refresh task
+REFRESH_INFLIGHT_TTL_SECONDS = int(os.getenv("REFRESH_INFLIGHT_TTL_SECONDS", 120))
+INACTIVE_POSTS_REFRESH_SECONDS = float(os.getenv("INACTIVE_POSTS_REFRESH_SECONDS", 60))  # on-demand refreshes reuse the inactive post set this long
+NIGHTLY_ENCODE_BATCH_SIZE = int(os.getenv("NIGHTLY_ENCODE_BATCH_SIZE", 256))  # users per SBERT/FAISS batch
+NIGHTLY_WRITE_CHUNK_SIZE = int(os.getenv("NIGHTLY_WRITE_CHUNK_SIZE", 500))  # users per Upstash pipeline
 
 
 # ============================================================================
@@ -1,11 +1,17 @@
 from pymongo import MongoClient
-from config import MONGO_URI, DATABASE_NAME
+from config import MONGO_URI, DATABASE_NAME, MONGO_BATCH_SIZE
 import pandas as pd
 from bson import ObjectId
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Projections for the fields each consumer actually reads
+HEURISTIC_POST_FIELDS = ['_id', 'community_id', 'score', 'status']
+HEURISTIC_USER_FIELDS = ['_id', 'num_posts', 'num_comments', 'communities_followed']
+EMBEDDING_POST_FIELDS = ['_id', 'caption', 'body', 'title']
+PROFILE_USER_FIELDS = ['_id', 'username', 'bio', 'interests']
+
 class MongoDBConnection:
     def __init__(self):
         try:
@@ -17,27 +23,68 @@ class MongoDBConnection:
             logger.error(f"✗ MongoDB connection failed: {e}")
             raise
     
-    def _convert_objectid_to_str(self, data):
-        if isinstance(data, list):
-            for item in data:
-                if '_id' in item and isinstance(item['_id'], ObjectId):
-                    item['_id'] = str(item['_id'])
-        return data
-    
-    def get_users(self, filter_query=None):
+    def iter_column_chunks(self, collection, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
+        """
+        Stream a collection as column chunks of up to batch_size documents
+
+        Args:
+            collection: Collection name
+            filter_query: MongoDB filter (default: all documents)
+            projection: List of fields to load (default: all fields)
+            batch_size: Cursor batch size and documents per chunk
+
+        Yields:
+            Dict mapping field name to a list of values, _id stringified
+        """
+        cursor = self.db[collection].find(filter_query or {}, projection, batch_size=batch_size)
+        docs = []
+        for doc in cursor:
+            docs.append(doc)
+            if len(docs) >= batch_size:
+                yield self._docs_to_columns(docs)
+                docs = []
+        if docs:
+            yield self._docs_to_columns(docs)
+
+    def _docs_to_columns(self, docs):
+        columns = {}
+        for i, doc in enumerate(docs):
+            for key, value in doc.items():
+                if key not in columns:
+                    columns[key] = [None] * i
+                if key == '_id' and isinstance(value, ObjectId):
+                    value = str(value)
+                columns[key].append(value)
+            # fields missing from this document
+            for values in columns.values():
+                if len(values) <= i:
+                    values.append(None)
+        return columns
+
+    def _load_dataframe(self, collection, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
+        """Build a DataFrame from per-column lists, holding one batch of BSON docs at a time"""
+        columns = {}
+        n_rows = 0
+        for chunk in self.iter_column_chunks(collection, filter_query, projection, batch_size):
+            chunk_rows = len(next(iter(chunk.values())))
+            for key, values in chunk.items():
+                if key not in columns:
+                    columns[key] = [None] * n_rows
+                columns[key].extend(values)
+            for key, values in columns.items():
+                if key not in chunk:
+                    values.extend([None] * chunk_rows)
+            n_rows += chunk_rows
+        return pd.DataFrame(columns)
+
+    def get_users(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
         try:
-            if filter_query is None:
-                filter_query = {}
-            
-            users_bson = list(self.db['users'].find(filter_query))
+            users_df = self._load_dataframe('users', filter_query, projection, batch_size)
             
-            if not users_bson:
+            if users_df.empty:
                 logger.warning("No users found")
                 return pd.DataFrame()
             
-            users_bson = self._convert_objectid_to_str(users_bson)
-            users_df = pd.DataFrame(users_bson)
-            
             if '_id' in users_df.columns:
                 users_df = users_df.rename(columns={'_id': 'user_id'})
             
@@ -48,20 +95,14 @@ class MongoDBConnection:
             logger.error(f"✗ Error fetching users: {e}")
             return pd.DataFrame()
     
-    def get_posts(self, filter_query=None):
+    def get_posts(self, filter_query=None, projection=None, batch_size=MONGO_BATCH_SIZE):
         try:
-            if filter_query is None:
-                filter_query = {}
-            
-            posts_bson = list(self.db['posts'].find(filter_query))
+            posts_df = self._load_dataframe('posts', filter_query, projection, batch_size)
             
-            if not posts_bson:
+            if posts_df.empty:
                 logger.warning("No posts found")
                 return pd.DataFrame()
             
-            posts_bson = self._convert_objectid_to_str(posts_bson)
-            posts_df = pd.DataFrame(posts_bson)
-            
             if '_id' in posts_df.columns:
                 posts_df = posts_df.rename(columns={'_id': 'post_id'})
             
@@ -72,6 +113,47 @@ class MongoDBConnection:
             logger.error(f"✗ Error fetching posts: {e}")
             return pd.DataFrame()
 
+    def get_inactive_post_ids(self, batch_size=MONGO_BATCH_SIZE):
+        """Ids of posts whose status is set to anything but "active" """
+        post_ids = []
+        status_filter = {'status': {'$exists': True, '$ne': 'active'}}
+        for chunk in self.iter_column_chunks('posts', status_filter, ['_id'], batch_size):
+            post_ids.extend(chunk['_id'])
+        return post_ids
+
+    def get_voted_post_ids(self, user_ids, batch_size=MONGO_BATCH_SIZE):
+        """
+        Posts each user has voted on
+
+        Args:
+            user_ids: User ids (str); matched as string and ObjectId
+
+        Returns:
+            Dict mapping user id to a set of post ids
+        """
+        user_ids = [str(user_id) for user_id in user_ids]
+        match_ids = user_ids + [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+        pipeline = [
+            # votes documents are keyed by user_id, or by _id when user_id is missing
+            {'$match': {'$or': [
+                {'user_id': {'$in': match_ids}},
+                {'user_id': {'$exists': False}, '_id': {'$in': match_ids}},
+            ]}},
+            {'$project': {
+                '_id': 0,
+                'user_id': {'$toString': {'$ifNull': ['$user_id', '$_id']}},
+                'post_ids': {'$ifNull': ['$votes.post.target_ids', []]},
+            }},
+        ]
+
+        voted = {}
+        try:
+            for row in self.db['votes'].aggregate(pipeline, batchSize=batch_size):
+                voted.setdefault(row['user_id'], set()).update(str(post_id) for post_id in row['post_ids'])
+        except Exception as e:
+            logger.error(f"✗ Error fetching votes: {e}")
+        return voted
+
 _mongo_connection = None
 
 def get_mongo_connection():
@@ -81,20 +163,54 @@ def get_mongo_connection():
     return _mongo_connection
 
 
-def get_all_users():
+def get_all_users(projection=None):
     """
     Return a list of all user dicts (not a DataFrame),
     so tasks.py can iterate over them.
     """
-    users_df = get_mongo_connection().get_users()
+    users_df = get_mongo_connection().get_users(projection=projection)
     # Convert DataFrame to list of dicts
     return users_df.to_dict(orient='records') if not users_df.empty else []
 
-def get_user_data(user_id):
+def get_user_data(user_id, projection=None):
     """
     Return a dict for the user with given user_id; None if not found.
     """
-    users_df = get_mongo_connection().get_users({'_id': ObjectId(user_id)})
+    users_df = get_mongo_connection().get_users({'_id': ObjectId(user_id)}, projection=projection)
     if not users_df.empty:
         return users_df.iloc[0].to_dict()
     return None
+
+def get_users_data(user_ids, projection=None):
+    """
+    Return a list of user dicts for the given user_ids (one query);
+    unknown or malformed ids are left out.
+    """
+    object_ids = [ObjectId(user_id) for user_id in user_ids if ObjectId.is_valid(user_id)]
+    if not object_ids:
+        return []
+    users_df = get_mongo_connection().get_users({'_id': {'$in': object_ids}}, projection=projection)
+    return users_df.to_dict(orient='records') if not users_df.empty else []
+
+def get_posts_data(post_ids, projection=None):
+    """
+    Return a list of post dicts (post_id instead of _id) for the given
+    post_ids (one query); unknown or malformed ids are left out.
+    """
+    object_ids = [ObjectId(post_id) for post_id in post_ids if ObjectId.is_valid(post_id)]
+    if not object_ids:
+        return []
+    posts_df = get_mongo_connection().get_posts({'_id': {'$in': object_ids}}, projection=projection)
+    return posts_df.to_dict(orient='records') if not posts_df.empty else []
+
+def get_inactive_post_ids():
+    """
+    Return the ids of posts that should not be recommended (status != "active").
+    """
+    return get_mongo_connection().get_inactive_post_ids()
+
+def get_voted_post_ids(user_ids):
+    """
+    Return {user_id: set of post ids the user voted on} for the given users.
+    """
+    return get_mongo_connection().get_voted_post_ids(user_ids)
@@ -1,53 +1,63 @@
 from sentence_transformers import SentenceTransformer
-from config import SBERT_MODEL_NAME
+from config import SBERT_MODEL_NAME, EMBEDDINGS_PATH, USER_EMBEDDINGS_PATH
+from embedding_store import EmbeddingStore
 import numpy as np
 
 class EmbeddingGenerator:
     def __init__(self):
         # Download and cache SBERT model
         self.model = SentenceTransformer(SBERT_MODEL_NAME)
+
+        # Persistent embeddings, re-encoded only when the text changes
+        self.post_store = EmbeddingStore(EMBEDDINGS_PATH)
+        self.user_store = EmbeddingStore(USER_EMBEDDINGS_PATH)
+    
+    @staticmethod
+    def post_text(post):
+        # Combine caption + body + title
+        caption = str(post.get('caption', ''))
+        body = str(post.get('body', ''))
+        title = str(post.get('title', ''))
+        return f"{caption} {body} {title}"
+    
+    @staticmethod
+    def user_text(user):
+        username = str(user.get('username', ''))
+        interests = str(user.get('interests', ''))
+        bio = str(user.get('bio', ''))
+        return f"{username} {bio} {interests}"
+    
+    def encode(self, texts, batch_size=32):
+        return self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True)
     
     def generate_post_embeddings(self, posts_df):
         """Convert posts to embeddings"""
         
         # Extract text from each post
-        texts = []
-        for idx, post in posts_df.iterrows():
-            # Combine caption + body + title
-            caption = str(post.get('caption', ''))
-            body = str(post.get('body', ''))
-            title = str(post.get('title', ''))
-            
-            combined_text = f"{caption} {body} {title}"
-            texts.append(combined_text)
-        
-        # Convert all texts to embeddings
-        embeddings = self.model.encode(texts, convert_to_numpy=True)
+        texts = [self.post_text(post) for _, post in posts_df.iterrows()]
         
         # Get post IDs
         post_ids = posts_df['post_id'].tolist()
         
+        # Encode only new / changed posts, reuse the rest from disk
+        rows = self.post_store.sync(post_ids, texts, self.encode)
+        embeddings = self.post_store.vectors[rows]
+        
         return embeddings, post_ids
     
     def generate_user_embeddings(self, users_df):
         """Convert user profiles to embeddings"""
         
         # Extract user profile text
-        texts = []
-        for idx, user in users_df.iterrows():
-            username = str(user.get('username', ''))
-            interests = str(user.get('interests', ''))
-            bio = str(user.get('bio', ''))
-            
-            combined_text = f"{username} {bio} {interests}"
-            texts.append(combined_text)
-        
-        # Convert to embeddings
-        embeddings = self.model.encode(texts, convert_to_numpy=True)
+        texts = [self.user_text(user) for _, user in users_df.iterrows()]
         
         # Get user IDs
         user_ids = users_df['user_id'].tolist()
         
+        # Encode only new / changed profiles, reuse the rest from disk
+        rows = self.user_store.sync(user_ids, texts, self.encode)
+        embeddings = self.user_store.vectors[rows]
+        
         return embeddings, user_ids
 
 _generator = None
@@ -0,0 +1,183 @@
+# embedding_store.py
+
+import hashlib
+import logging
+import os
+import numpy as np
+from config import EMBEDDING_DIMENSION, SBERT_MODEL_NAME
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    On-disk embedding cache keyed by id and content hash.
+
+    Vectors live in a float32 .npy matrix that is memory-mapped on load;
+    an _index.npz sidecar holds the id and content hash of every row.
+    Only rows whose text changed (or that are new) get re-encoded.
+    """
+
+    def __init__(self, path, dimension=EMBEDDING_DIMENSION):
+        self.path = path
+        self.index_path = os.path.splitext(path)[0] + '_index.npz'
+        self.dimension = dimension
+
+        self.vectors = np.empty((0, dimension), dtype='float32')
+        self.ids = np.empty(0, dtype=object)
+        self.hashes = np.empty(0, dtype=object)
+        self._rows = {}
+        # file stamp of the last successful load, see reload_if_changed
+        self._stamp = None
+
+        self.load()
+
+    @staticmethod
+    def content_hash(text):
+        """Hash of the encoded text; includes the model name so a model swap invalidates rows"""
+        return hashlib.sha1(f"{SBERT_MODEL_NAME}\0{text}".encode('utf-8')).hexdigest()
+
+    def load(self):
+        """Memory-map the store from disk (empty store if missing or inconsistent)"""
+
+        # taken before reading: files replaced mid-load show up as a change next time
+        stamp = self._file_stamp()
+        if stamp is None:
+            return
+
+        try:
+            vectors = np.load(self.path, mmap_mode='r')
+            with np.load(self.index_path) as sidecar:
+                ids = sidecar['ids'].astype(object)
+                hashes = sidecar['hashes'].astype(object)
+
+            if vectors.ndim != 2 or vectors.shape[1] != self.dimension or len(vectors) != len(ids):
+                logger.warning(f"Ignoring inconsistent embedding store at {self.path}")
+                return
+
+            self.vectors = vectors
+            self.ids = ids
+            self.hashes = hashes
+            self._rows = {row_id: row for row, row_id in enumerate(ids)}
+            self._stamp = stamp
+            logger.info(f"✓ Loaded {len(ids)} stored embeddings from {self.path}")
+
+        except Exception as e:
+            logger.error(f"✗ Error loading embedding store {self.path}: {e}")
+
+    def reload_if_changed(self):
+        """
+        Load the store again if another process replaced its files (nightly
+        sync) since the last load. Rows are only ever appended, so rows looked
+        up before the reload stay valid.
+        """
+        stamp = self._file_stamp()
+        if stamp is not None and stamp != self._stamp:
+            self.load()
+
+    def _file_stamp(self):
+        """Inode and mtime of the matrix and its sidecar, None if either is missing"""
+        try:
+            # os.replace gives a new inode even where mtimes are coarse
+            return tuple((st.st_ino, st.st_mtime_ns) for st in map(os.stat, (self.path, self.index_path)))
+        except OSError:
+            return None
+
+    def lookup(self, ids, texts):
+        """
+        Find stored rows whose content hash still matches
+
+        Args:
+            ids: Row ids (user or post ids)
+            texts: Text that would be encoded for each id
+
+        Returns:
+            Tuple of (rows, hashes): row index into self.vectors or -1, and the new hashes
+        """
+        hashes = [self.content_hash(text) for text in texts]
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        for i, (row_id, content_hash) in enumerate(zip(ids, hashes)):
+            row = self._rows.get(str(row_id))
+            if row is not None and self.hashes[row] == content_hash:
+                rows[i] = row
+        return rows, hashes
+
+    def rows_for(self, ids):
+        """Row index into self.vectors for every id (-1 if missing), without checking content hashes"""
+        return np.fromiter((self._rows.get(str(row_id), -1) for row_id in ids), dtype=np.int64, count=len(ids))
+
+    def sync(self, ids, texts, encode_fn, batch_size=256):
+        """
+        Make sure every id has an up-to-date embedding, encoding only stale rows
+
+        Args:
+            ids: Row ids
+            texts: Text to encode for each id
+            encode_fn: Callable mapping a list of texts to an (n, d) array
+            batch_size: Texts per encode_fn call
+
+        Returns:
+            Row index into self.vectors for every id
+        """
+        ids = [str(row_id) for row_id in ids]
+        rows, hashes = self.lookup(ids, texts)
+
+        stale = np.flatnonzero(rows < 0)
+        logger.info(f"Embeddings: {len(ids) - stale.size} unchanged, {stale.size} to encode")
+        if stale.size == 0:
+            return rows
+
+        # existing ids keep their row, new ids are appended
+        new_ids = []
+        targets = {}
+        for i in stale:
+            row_id = ids[i]
+            if row_id in targets:
+                continue
+            row = self._rows.get(row_id)
+            if row is None:
+                row = len(self.ids) + len(new_ids)
+                new_ids.append(row_id)
+            targets[row_id] = row
+
+        new_hashes = np.concatenate([self.hashes, np.empty(len(new_ids), dtype=object)])
+
+        tmp_path = self.path + '.tmp'
+        out = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype='float32',
+            shape=(len(self.ids) + len(new_ids), self.dimension)
+        )
+        for start in range(0, len(self.ids), 65536):
+            stop = min(start + 65536, len(self.ids))
+            out[start:stop] = self.vectors[start:stop]
+
+        for start in range(0, stale.size, batch_size):
+            chunk = stale[start:start + batch_size]
+            encoded = np.asarray(encode_fn([texts[i] for i in chunk]), dtype='float32')
+            for i, vector in zip(chunk, encoded):
+                row = targets[ids[i]]
+                out[row] = vector
+                new_hashes[row] = hashes[i]
+
+        out.flush()
+        del out
+        # drop our mapping of the old file so it can be replaced (required on Windows)
+        self.vectors = np.empty((0, self.dimension), dtype='float32')
+
+        self._save(tmp_path, np.concatenate([self.ids, np.array(new_ids, dtype=object)]), new_hashes)
+        self.load()
+
+        for i in stale:
+            rows[i] = targets[ids[i]]
+        return rows
+
+    def _save(self, vectors_tmp_path, ids, hashes):
+        """Swap in the new matrix and sidecar; readers see old or new files, never partial ones"""
+
+        index_tmp_path = self.index_path + '.tmp'
+        with open(index_tmp_path, 'wb') as f:
+            np.savez(f, ids=ids.astype(str), hashes=hashes.astype(str))
+
+        os.replace(vectors_tmp_path, self.path)
+        os.replace(index_tmp_path, self.index_path)
+        logger.info(f"✓ Saved {len(ids)} embeddings to {self.path}")
@@ -1,17 +1,87 @@
 # faiss_indexer.py
 
+import base64
+import contextlib
 import faiss
+import json
 import numpy as np
+import os
 import pickle
 import logging
-from config import FAISS_INDEX_PATH
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # no flock on Windows; the delta log is then only safe for a single process
+    fcntl = None
+from config import (
+    FAISS_INDEX_PATH,
+    FAISS_MMAP,
+    FAISS_INDEX_TYPE,
+    FAISS_TRAIN_SAMPLE_SIZE,
+    FAISS_NLIST,
+    FAISS_NPROBE,
+    FAISS_PQ_M,
+    FAISS_PQ_NBITS,
+    FAISS_HNSW_M,
+    FAISS_HNSW_EF_CONSTRUCTION,
+    FAISS_HNSW_EF_SEARCH,
+    FAISS_OMP_THREADS,
+)
 
 logger = logging.getLogger(__name__)
 
+# process-wide OpenMP setting, applied once at import rather than per search
+if FAISS_OMP_THREADS > 0:
+    faiss.omp_set_num_threads(FAISS_OMP_THREADS)
+
 class FAISSIndexer:
+    """
+    Cosine-similarity post index.
+
+    Every vector is stored under an int64 label equal to its position in
+    self.post_ids, so search results map straight back to post ids. Removing
+    a post sets its post_ids entry to None; re-adding it appends a new label.
+    Live changes go through add_posts / remove_posts / upsert_posts and are
+    appended to a delta log next to the index file, which other processes
+    replay with apply_delta_log() and compact() folds into a new snapshot.
+
+    The log starts with a header naming the snapshot it belongs to; a
+    process that finds a different snapshot id reloads the index before
+    replaying. Writers hold an exclusive flock on the log while they catch
+    up, change the index and append, so no process skips another's entries;
+    readers and loads hold a shared one.
+
+    Snapshots can be loaded memory-mapped (index data and the fixed-width
+    _ids.npy table), so worker processes share one page-cache copy. The
+    first live change copies the mapped snapshot into private memory.
+
+    Inactive / blocked posts set with set_excluded_posts() are filtered
+    inside the FAISS query through an IDSelectorBitmap over the labels.
+    """
+
     def __init__(self):
         self.index = None
         self.post_ids = []
+        self._id_array = None
+        self._labels = {}
+        self._live = 0
+        self._mmapped = False
+
+        self._excluded_ids = set()
+        self._allowed_bitmap = None
+        self._selector = None
+
+        self.index_path = None
+        self.delta_log_path = None
+        self._delta_log_offset = 0
+        self._snapshot_id = None
+        self._mmap = FAISS_MMAP
+
+        # live changes and searches from API threads
+        self._lock = threading.RLock()
 
     def create_index_cosine(self, embeddings, post_ids):
         """Build FAISS index using cosine similarity"""
@@ -20,50 +90,681 @@ class FAISSIndexer:
         faiss.normalize_L2(embeddings)
 
         dimension = int(embeddings.shape[1])
-        self.index = faiss.IndexFlatIP(dimension)
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+
+        self._add_initial(embeddings, post_ids)
+
+    def create_index(self, embeddings, post_ids, index_type=FAISS_INDEX_TYPE, **params):
+        """Build the configured index type: flat, ivf_flat, ivf_pq or hnsw"""
+
+        builders = {
+            'flat': self.create_index_cosine,
+            'ivf_flat': self.create_index_ivf_flat,
+            'ivf_pq': self.create_index_ivf_pq,
+            'hnsw': self.create_index_hnsw,
+        }
+        if index_type not in builders:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+
+        builders[index_type](embeddings, post_ids, **params)
+
+    def create_index_ivf_flat(self, embeddings, post_ids, nlist=FAISS_NLIST,
+                              nprobe=FAISS_NPROBE, train_sample_size=FAISS_TRAIN_SAMPLE_SIZE):
+        """Build an inverted-file index over uncompressed vectors"""
+
+        embeddings = embeddings.astype('float32')
+        faiss.normalize_L2(embeddings)
+
+        dimension = int(embeddings.shape[1])
+        nlist = min(nlist, len(embeddings))
+        quantizer = faiss.IndexFlatIP(dimension)
+        self.index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+
+        self._train_and_add(embeddings, post_ids, train_sample_size)
+        self.set_search_params(nprobe=nprobe)
+
+    def create_index_ivf_pq(self, embeddings, post_ids, nlist=FAISS_NLIST, m=FAISS_PQ_M,
+                            nbits=FAISS_PQ_NBITS, nprobe=FAISS_NPROBE,
+                            train_sample_size=FAISS_TRAIN_SAMPLE_SIZE):
+        """Build an inverted-file index over product-quantized vectors (m * nbits / 8 bytes per post)"""
+
+        embeddings = embeddings.astype('float32')
+        faiss.normalize_L2(embeddings)
+
+        dimension = int(embeddings.shape[1])
+        nlist = min(nlist, len(embeddings))
+        quantizer = faiss.IndexFlatIP(dimension)
+        self.index = faiss.IndexIVFPQ(
+            quantizer, dimension, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT
+        )
+
+        self._train_and_add(embeddings, post_ids, train_sample_size)
+        self.set_search_params(nprobe=nprobe)
+
+    def create_index_hnsw(self, embeddings, post_ids, m=FAISS_HNSW_M,
+                          ef_construction=FAISS_HNSW_EF_CONSTRUCTION, ef_search=FAISS_HNSW_EF_SEARCH):
+        """Build an HNSW graph index (no training; more memory, lowest latency)"""
+
+        embeddings = embeddings.astype('float32')
+        faiss.normalize_L2(embeddings)
+
+        dimension = int(embeddings.shape[1])
+        hnsw = faiss.IndexHNSWFlat(dimension, m, faiss.METRIC_INNER_PRODUCT)
+        hnsw.hnsw.efConstruction = ef_construction
+        self.index = faiss.IndexIDMap2(hnsw)
+
+        self._add_initial(embeddings, post_ids)
+        self.set_search_params(ef_search=ef_search)
+
+    def _train_and_add(self, embeddings, post_ids, train_sample_size):
+        """Train the coarse quantizer on a random sample, then add every vector"""
+
+        if len(embeddings) > train_sample_size:
+            sample = np.random.default_rng(0).choice(len(embeddings), train_sample_size, replace=False)
+            training = embeddings[np.sort(sample)]
+        else:
+            training = embeddings
+
+        self.index.train(training)
+        self._add_initial(embeddings, post_ids)
+
+    def _add_initial(self, embeddings, post_ids):
+        """Populate a freshly built index; labels are positions in post_ids"""
+
+        self.post_ids = list(post_ids)
+        self._id_array = None
+        self._labels = {str(post_id): label for label, post_id in enumerate(self.post_ids)}
+        self._live = len(self.post_ids)
+        self._mmapped = False
+        self.index.add_with_ids(embeddings, np.arange(len(self.post_ids), dtype='int64'))
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Apply query-time knobs; parameters that do not fit the index type are ignored"""
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None and nprobe is not None:
+            ivf.nprobe = min(nprobe, ivf.nlist)
+
+        hnsw = self._base_index()
+        if isinstance(hnsw, faiss.IndexHNSW) and ef_search is not None:
+            hnsw.hnsw.efSearch = ef_search
+
+    def _base_index(self):
+        """Underlying index type, looking through an IndexIDMap2 wrapper"""
+
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIDMap2):
+            index = faiss.downcast_index(index.index)
+        return index
+
+    # ----------------- Incremental updates -----------------
+    def add_posts(self, embeddings, post_ids, log=True):
+        """
+        Add new posts to the live index
+
+        Args:
+            embeddings: (n, d) post embeddings
+            post_ids: Post id for every row; ids already indexed are skipped
+            log: Append the change to the delta log
+
+        Returns:
+            Number of posts added
+        """
+        with self._change(log) as entries:
+            return self._add_posts(embeddings, post_ids, entries)
+
+    def remove_posts(self, post_ids, log=True):
+        """
+        Remove posts (deleted / inactive) from the live index
+
+        Returns:
+            Number of posts removed
+        """
+        with self._change(log) as entries:
+            return self._remove_posts(post_ids, entries)
+
+    def upsert_posts(self, embeddings, post_ids, log=True):
+        """Replace the vectors of existing posts and add the new ones"""
+
+        with self._change(log) as entries:
+            self._remove_posts(post_ids, entries)
+            return self._add_posts(embeddings, post_ids, entries)
+
+    @contextlib.contextmanager
+    def _change(self, log):
+        """
+        Scope of one live change; yields the list the change appends its log entries to
+
+        A logged change first replays what other processes appended, then
+        writes its own entries, all under the exclusive log lock.
+        """
+        with self._lock:
+            if not log or self.delta_log_path is None:
+                yield []
+                return
+
+            with self._open_delta_log(exclusive=True) as f:
+                self._replay_delta_log(f)
+                entries = []
+                yield entries
+                if entries:
+                    f.seek(0, os.SEEK_END)
+                    f.write(b''.join(json.dumps(entry).encode('utf-8') + b'\n' for entry in entries))
+                    f.flush()
+                    self._delta_log_offset = f.tell()
+
+    def _add_posts(self, embeddings, post_ids, entries):
+        self._make_writable()
+        labels_by_id = self._label_map()
+
+        keep = [i for i, post_id in enumerate(post_ids) if str(post_id) not in labels_by_id]
+        if len(keep) < len(post_ids):
+            logger.warning(f"Skipped {len(post_ids) - len(keep)} posts already in the index (use upsert_posts)")
+        if not keep:
+            return 0
+
+        vectors = np.array(embeddings, dtype='float32')[keep]
+        faiss.normalize_L2(vectors)
+        new_ids = [post_ids[i] for i in keep]
+
+        labels = np.arange(len(self.post_ids), len(self.post_ids) + len(new_ids), dtype='int64')
+        self.index.add_with_ids(vectors, labels)
+        for post_id, label in zip(new_ids, labels):
+            self.post_ids.append(post_id)
+            labels_by_id[str(post_id)] = int(label)
+        self._live += len(new_ids)
+        self._id_array = None
+        if self._selector is not None:
+            # the bitmap only covers labels that existed when it was built
+            self._build_selector()
+
+        entries.extend(
+            {'op': 'add', 'post_id': post_id, 'vector': self._encode_vector(vector)}
+            for post_id, vector in zip(new_ids, vectors)
+        )
+        return len(new_ids)
+
+    def _remove_posts(self, post_ids, entries):
+        self._make_writable()
+        labels_by_id = self._label_map()
+
+        labels = [labels_by_id.pop(str(post_id)) for post_id in post_ids if str(post_id) in labels_by_id]
+        if not labels:
+            return 0
+
+        for label in labels:
+            self.post_ids[label] = None
+        self._live -= len(labels)
+        self._id_array = None
+        try:
+            self.index.remove_ids(np.array(labels, dtype='int64'))
+        except RuntimeError:
+            # HNSW cannot delete; the None entries hide the vectors until compact()
+            pass
+
+        entries.extend({'op': 'remove', 'post_id': post_id} for post_id in post_ids)
+        return len(labels)
+
+    def set_excluded_posts(self, post_ids):
+        """
+        Exclude posts (inactive, blocked) from every search until the next call
+
+        Args:
+            post_ids: Post ids to filter inside the index query; empty clears the filter
+        """
+        excluded_ids = {str(post_id) for post_id in post_ids}
+        with self._lock:
+            if excluded_ids == self._excluded_ids:
+                return
+
+            self._excluded_ids = excluded_ids
+            self._build_selector()
 
-        self.index.add(embeddings)
-        self.post_ids = post_ids
+    def _build_selector(self):
+        """IDSelectorBitmap with a bit set for every label searches may return"""
+
+        if not self._excluded_ids:
+            self._allowed_bitmap = None
+            self._selector = None
+            return
+
+        labels_by_id = self._label_map()
+        allowed = np.ones(len(self.post_ids), dtype=bool)
+        allowed[[labels_by_id[post_id] for post_id in self._excluded_ids if post_id in labels_by_id]] = False
+
+        # the selector only holds a pointer, keep the bitmap alive next to it
+        self._allowed_bitmap = np.packbits(allowed, bitorder='little')
+        self._selector = faiss.IDSelectorBitmap(len(allowed), faiss.swig_ptr(self._allowed_bitmap))
+
+    def _search_params(self):
+        """Search parameters carrying the exclusion selector, typed for the index"""
+
+        if self._selector is None:
+            return None
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            return faiss.SearchParametersIVF(sel=self._selector, nprobe=ivf.nprobe)
+
+        base = self._base_index()
+        if isinstance(base, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=self._selector, efSearch=base.hnsw.efSearch)
+
+        return faiss.SearchParameters(sel=self._selector)
+
+    def _label_map(self):
+        """post id -> label, built on first use so read-only processes never pay for it"""
+
+        if self._labels is None:
+            self._labels = {}
+            for label in range(len(self.post_ids)):
+                post_id = self._post_id(label)
+                if post_id is not None:
+                    self._labels[str(post_id)] = label
+        return self._labels
+
+    def _post_id(self, label):
+        """Post id stored under a label, None if removed"""
+
+        post_id = self.post_ids[label]
+        if isinstance(post_id, bytes):
+            # row of the memory-mapped id table; b'' marks a removed post
+            return post_id.decode('utf-8') or None
+        return post_id
+
+    def _make_writable(self):
+        """Swap a memory-mapped snapshot for a private in-memory copy before changing it"""
+
+        if not self._mmapped:
+            return
+
+        logger.info("Copying memory-mapped FAISS index into memory for live updates")
+        # copy the mapped snapshot itself; the file may already hold a newer one
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            # mapped inverted lists cannot be serialized, copy them list by list
+            invlists = faiss.ArrayInvertedLists(ivf.nlist, ivf.code_size)
+            for list_no in range(ivf.nlist):
+                size = ivf.invlists.list_size(list_no)
+                if size:
+                    invlists.add_entries(
+                        list_no, size, ivf.invlists.get_ids(list_no), ivf.invlists.get_codes(list_no)
+                    )
+            ivf.replace_invlists(invlists, True)
+            invlists.this.disown()
+        else:
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+        self.set_search_params(nprobe=FAISS_NPROBE, ef_search=FAISS_HNSW_EF_SEARCH)
+        self.post_ids = [self._post_id(label) for label in range(len(self.post_ids))]
+        self._id_array = None
+        self._mmapped = False
+
+    def _encode_vector(self, vector):
+        return base64.b64encode(np.asarray(vector, dtype='float32').tobytes()).decode('ascii')
+
+    def _decode_vector(self, encoded):
+        return np.frombuffer(base64.b64decode(encoded), dtype='float32')
+
+    @contextlib.contextmanager
+    def _open_delta_log(self, exclusive, path=None):
+        """Delta log opened for append + read under an flock (exclusive for writers)"""
+
+        with open(path or self.delta_log_path, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            # closing the file releases the lock
+            yield f
+
+    @staticmethod
+    def _read_log_header(f):
+        """(snapshot id, header length) of an open delta log; (None, 0) for an empty or pre-header log"""
+
+        f.seek(0)
+        line = f.readline()
+        if line.endswith(b'\n'):
+            try:
+                header = json.loads(line)
+            except ValueError:
+                header = None
+            if isinstance(header, dict) and 'snapshot' in header:
+                return header['snapshot'], len(line)
+        return None, 0
+
+    def apply_delta_log(self):
+        """
+        Replay changes other processes appended to the delta log since the last call
+
+        Reloads the index first when another process wrote a new snapshot
+        (compact() or a rebuild) since it was loaded.
+
+        Returns:
+            Number of log entries applied
+        """
+        if self.delta_log_path is None:
+            return 0
+
+        with self._lock, self._open_delta_log(exclusive=False) as f:
+            return self._replay_delta_log(f)
+
+    def _replay_delta_log(self, f):
+        """Apply the entries of the locked log f past the read offset"""
+
+        snapshot_id, header_length = self._read_log_header(f)
+        if snapshot_id != self._snapshot_id:
+            logger.info("FAISS snapshot changed on disk, reloading")
+            self._load_snapshot(self.index_path, self._mmap)
+            self._snapshot_id = snapshot_id
+            self._delta_log_offset = header_length
+
+        f.seek(self._delta_log_offset)
+        lines = f.readlines()
+        if lines and not lines[-1].endswith(b'\n'):
+            # entry cut short by a writer without flock (Windows); picked up next time
+            lines.pop()
+        self._delta_log_offset += sum(len(line) for line in lines)
+
+        for line in lines:
+            entry = json.loads(line)
+            if entry['op'] == 'add':
+                vector = self._decode_vector(entry['vector']).reshape(1, -1)
+                self._add_posts(vector, [entry['post_id']], [])
+            elif entry['op'] == 'remove':
+                self._remove_posts([entry['post_id']], [])
+
+        if lines:
+            logger.info(f"Applied {len(lines)} FAISS delta log entries")
+        return len(lines)
+
+    def compact(self):
+        """
+        Write a fresh snapshot of the live index and truncate the delta log
+
+        Catches up on the log first, under the exclusive lock, so changes
+        appended by other processes end up in the snapshot. Indexes that
+        cannot delete (HNSW) are rebuilt without the removed vectors.
+
+        Returns:
+            Number of log entries folded into the snapshot (0: nothing to do)
+        """
+        if self.index_path is None:
+            raise RuntimeError("FAISS index has no snapshot on disk. Call load_index() or save_index() first.")
+
+        with self._lock, self._open_delta_log(exclusive=True) as f:
+            self._replay_delta_log(f)
+            _, header_length = self._read_log_header(f)
+            f.seek(header_length)
+            entries = sum(1 for _ in f)
+            if not entries:
+                return 0
+
+            base = self._base_index()
+            if isinstance(base, faiss.IndexHNSW) and self._tombstones():
+                live = np.array(
+                    [label for label in range(len(self.post_ids)) if self._post_id(label) is not None],
+                    dtype='int64'
+                )
+                vectors = np.vstack([self.index.reconstruct(int(label)) for label in live])
+                hnsw = faiss.IndexHNSWFlat(base.d, base.hnsw.nb_neighbors(1), faiss.METRIC_INNER_PRODUCT)
+                hnsw.hnsw.efConstruction = base.hnsw.efConstruction
+                hnsw.hnsw.efSearch = base.hnsw.efSearch
+
+                self._make_writable()
+                self.index = faiss.IndexIDMap2(hnsw)
+                self.index.add_with_ids(vectors, live)
+
+            self._write_snapshot(self.index_path, f)
+
+        logger.info(f"✅ FAISS index compacted ({entries} log entries). #posts = {self._live}")
+        return entries
 
     def search(self, query_vector, k=50):
         """Search for K nearest neighbors"""
 
+        # copy, search_batch normalizes in place
+        query_vector = np.array(query_vector, dtype='float32').reshape(1, -1)
+        scores, post_ids = self.search_batch(query_vector, k)
+
+        return scores[0].compressed().reshape(1, -1), post_ids[0].compressed().tolist()
+
+    def search_batch(self, query_vectors, k=50, exclude=None):
+        """
+        Search K nearest neighbors for every row of an (n, d) query matrix in one call
+
+        Posts excluded with set_excluded_posts() are skipped by the index
+        itself. Per-query exclusions (e.g. posts the user already voted on)
+        can't go into one shared selector: they are masked out of the
+        results, and rows that come back short are searched again with an
+        over-fetch sized to their own exclusion list (rows bucketed by
+        size), so one heavy voter does not widen every query. Every row
+        still gets k results when the index has enough eligible posts.
+
+        Args:
+            query_vectors: (n, d) queries; a writable C-contiguous float32 array
+                is L2-normalized in place, anything else is copied first
+            k: Neighbours per query
+            exclude: Optional sequence with an iterable of post ids per query
+
+        Returns:
+            Tuple of (scores, post_ids), both (n, k) masked arrays sharing one
+            mask for slots without a result (fewer than k eligible posts).
+            Valid entries come first in every row, so
+            post_ids[i].compressed() / scores[i].compressed() are row i's hits.
+        """
         if self.index is None:
             raise RuntimeError("FAISS index is not loaded. Call load_index() first.")
 
-        query_vector = query_vector.astype('float32')
-        query_vector = np.expand_dims(query_vector, axis=0)  # Make 2D
+        query_vectors = np.require(query_vectors, dtype='float32', requirements=['C', 'W'])
+        faiss.normalize_L2(query_vectors)
+
+        with self._lock:
+            return self._search_batch(query_vectors, k, exclude)
+
+    def _search_batch(self, query_vectors, k, exclude):
+        exclude_labels = None
+        if exclude is not None:
+            labels_by_id = self._label_map()
+            exclude_labels = [
+                np.array([
+                    labels_by_id[post_id]
+                    for post_id in map(str, row_exclude)
+                    if post_id in labels_by_id and post_id not in self._excluded_ids
+                ], dtype='int64')
+                for row_exclude in exclude
+            ]
+
+        params = self._search_params()
+        fetch = self._fetch_size(k, self._tombstones())
+        scores, labels = self.index.search(query_vectors, fetch, params=params)
+        scores, post_ids = self._resolve_labels(scores, labels, k, exclude_labels)
+
+        if exclude_labels is not None and fetch < self.index.ntotal:
+            sizes = np.array([len(row) for row in exclude_labels], dtype=np.int64)
+            short = np.flatnonzero((np.ma.count(post_ids, axis=1) < k) & (sizes > 0))
+            # next power of two of each exclusion list: few extra searches, none over-sized by much
+            buckets = 1 << np.ceil(np.log2(sizes[short])).astype(np.int64)
+            for bucket in np.unique(buckets):
+                rows = short[buckets == bucket]
+                fetch = self._fetch_size(k, self._tombstones() + int(bucket))
+                row_scores, row_labels = self.index.search(query_vectors[rows], fetch, params=params)
+                scores[rows], post_ids[rows] = self._resolve_labels(
+                    row_scores, row_labels, k, [exclude_labels[row] for row in rows]
+                )
+
+        return scores, post_ids
+
+    def _fetch_size(self, k, over_fetch):
+        return min(k + over_fetch, max(self.index.ntotal, k))
+
+    def _tombstones(self):
+        """Removed vectors still physically in the index (HNSW until compact())"""
+        return max(0, self.index.ntotal - self._live)
+
+    def _ids_for_labels(self):
+        """Post id table as a NumPy array: the mapped bytes table, or an object array of post_ids"""
+
+        if isinstance(self.post_ids, np.ndarray):
+            return self.post_ids
+        if self._id_array is None:
+            self._id_array = np.empty(len(self.post_ids), dtype=object)
+            self._id_array[:] = self.post_ids
+        return self._id_array
 
-        faiss.normalize_L2(query_vector)
+    def _resolve_labels(self, scores, labels, k, exclude_labels=None):
+        """Map labels to post ids, masking empty slots, removed posts and per-row exclusions"""
 
-        distances, indices = self.index.search(query_vector, k)
+        table = self._ids_for_labels()
+        invalid = labels < 0
+        if len(table) == 0:
+            post_ids = np.full(labels.shape, None, dtype=object)
+            invalid[:] = True
+        else:
+            post_ids = table[np.where(invalid, 0, labels)]
+            if post_ids.dtype.kind == 'S':
+                invalid |= post_ids == b''
+                post_ids = np.char.decode(post_ids, 'utf-8')
+            else:
+                invalid |= np.equal(post_ids, None)
 
-        # indices is shape (1, k). Flatten it
-        indices = indices[0]
-        result_post_ids = [self.post_ids[idx] for idx in indices]
+        if exclude_labels is not None:
+            for row, row_exclude in enumerate(exclude_labels):
+                if len(row_exclude):
+                    invalid[row] |= np.isin(labels[row], row_exclude)
 
-        return distances, result_post_ids
+        if labels.shape[1] > k or exclude_labels is not None:
+            # over-fetched past tombstones / exclusions: keep the first k valid slots of each row
+            order = np.argsort(invalid, axis=1, kind='stable')[:, :k]
+            scores = np.take_along_axis(scores, order, axis=1)
+            post_ids = np.take_along_axis(post_ids, order, axis=1)
+            invalid = np.take_along_axis(invalid, order, axis=1)
+
+        return np.ma.masked_array(scores, mask=invalid), np.ma.masked_array(post_ids, mask=invalid)
 
     def save_index(self, filepath=FAISS_INDEX_PATH):
-        """Save index to disk"""
+        """
+        Save index to disk
+
+        The post ids go to a fixed-width bytes table (_ids.npy) that load_index
+        can memory-map. Both files are written next to the target and renamed
+        into place, so processes that mapped the previous snapshot keep reading
+        intact files. The delta log restarts under a new snapshot id, which
+        makes other processes reload on their next apply_delta_log().
+        """
+        with self._lock:
+            self.index_path = filepath
+            self.delta_log_path = filepath.replace('.bin', '_delta.log')
+            with self._open_delta_log(exclusive=True) as f:
+                self._write_snapshot(filepath, f)
+
+    def _write_snapshot(self, filepath, f):
+        """Write the index files and restart the locked delta log f for them"""
+
+        self._make_writable()
+
+        ids_filepath = filepath.replace('.bin', '_ids.npy')
+        ids_table = np.array([
+            b'' if post_id is None else str(post_id).encode('utf-8')
+            for post_id in (self._post_id(label) for label in range(len(self.post_ids)))
+        ], dtype='S')
 
-        faiss.write_index(self.index, filepath)
+        with open(ids_filepath + '.tmp', 'wb') as ids_file:
+            np.save(ids_file, ids_table)
+        faiss.write_index(self.index, filepath + '.tmp')
 
-        ids_filepath = filepath.replace('.bin', '_ids.pkl')
-        with open(ids_filepath, 'wb') as f:
-            pickle.dump(self.post_ids, f)
+        # labels only ever grow, so new ids next to the old index stay valid
+        os.replace(ids_filepath + '.tmp', ids_filepath)
+        os.replace(filepath + '.tmp', filepath)
 
-    def load_index(self, filepath=FAISS_INDEX_PATH):
-        """Load index from disk"""
+        # the snapshot already contains every logged change
+        snapshot_id = uuid.uuid4().hex
+        header = json.dumps({'snapshot': snapshot_id}).encode('utf-8') + b'\n'
+        f.truncate(0)
+        f.write(header)
+        f.flush()
+        self._snapshot_id = snapshot_id
+        self._delta_log_offset = len(header)
 
+    def load_index(self, filepath=FAISS_INDEX_PATH, mmap=FAISS_MMAP):
+        """
+        Load index from disk and replay its delta log
+
+        Args:
+            filepath: Index file written by save_index
+            mmap: Memory-map the index data and id table instead of reading them
+        """
         logger.info(f"🔍 Loading FAISS index from {filepath}")
-        self.index = faiss.read_index(filepath)
 
-        ids_filepath = filepath.replace('.bin', '_ids.pkl')
-        with open(ids_filepath, 'rb') as f:
-            self.post_ids = pickle.load(f)
+        with self._lock:
+            self.index_path = filepath
+            self.delta_log_path = filepath.replace('.bin', '_delta.log')
+            self._mmap = mmap
+            # shared lock: no snapshot is written between reading it and the log header
+            with self._open_delta_log(exclusive=False) as f:
+                self._load_snapshot(filepath, mmap)
+                self._snapshot_id, self._delta_log_offset = self._read_log_header(f)
+                self._replay_delta_log(f)
+
+        logger.info(f"✅ FAISS index loaded{' (mmap)' if self._mmapped else ''}. #posts = {self._live}")
+
+    def _load_snapshot(self, filepath, mmap):
+        """Read the index files written by save_index, without the delta log"""
+
+        ids_filepath = filepath.replace('.bin', '_ids.npy')
+        legacy_ids_filepath = filepath.replace('.bin', '_ids.pkl')
+        if os.path.exists(ids_filepath) or not os.path.exists(legacy_ids_filepath):
+            self.post_ids = np.load(ids_filepath, mmap_mode='r' if mmap else None)
+            if not mmap:
+                self.post_ids = [self._post_id(label) for label in range(len(self.post_ids))]
+        else:
+            # snapshot from before _ids.npy; never memory-mapped since it may need converting
+            mmap = False
+            with open(legacy_ids_filepath, 'rb') as f:
+                self.post_ids = pickle.load(f)
+
+        self.index = self._read_index(filepath, mmap)
+        self._mmapped = mmap
+        self._id_array = None
+        self._labels = None
+        self._build_selector()
+
+        self._ensure_id_map()
+        # query-time parameters are not all persisted with the index
+        self.set_search_params(nprobe=FAISS_NPROBE, ef_search=FAISS_HNSW_EF_SEARCH)
+
+        self._live = self.index.ntotal
+        if isinstance(self._base_index(), faiss.IndexHNSW):
+            # removed HNSW vectors stay in the snapshot until compact()
+            if isinstance(self.post_ids, np.ndarray):
+                self._live = int(np.count_nonzero(self.post_ids))
+            else:
+                self._live = sum(1 for post_id in self.post_ids if post_id is not None)
+
+    def _read_index(self, filepath, mmap):
+        """faiss.read_index, memory-mapping flat/HNSW codes or IVF inverted lists when asked"""
+
+        if not mmap:
+            return faiss.read_index(filepath)
+
+        # IO_FLAG_MMAP_IFC (flat codes) is only available in recent faiss builds
+        flat_codes_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+        try:
+            return faiss.read_index(filepath, faiss.IO_FLAG_MMAP | flat_codes_flag)
+        except RuntimeError:
+            # IVF inverted lists only support the plain mmap flag
+            return faiss.read_index(filepath, faiss.IO_FLAG_MMAP)
+
+    def _ensure_id_map(self):
+        """Wrap indexes saved before labels were used (flat / HNSW) in an IndexIDMap2"""
+
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, (faiss.IndexIDMap2, faiss.IndexIVF)):
+            return
 
-        logger.info(f"✅ FAISS index loaded. #posts = {len(self.post_ids)}")
+        logger.info("Converting FAISS index to IndexIDMap2 for incremental updates")
+        vectors = index.reconstruct_n(0, index.ntotal)
+        index.reset()
+        # wrap the owning object from read_index, not the downcast view
+        self.index = faiss.IndexIDMap2(self.index)
+        self.index.add_with_ids(vectors, np.arange(len(vectors), dtype='int64'))
 
 
 _indexer = None
@@ -1,55 +1,267 @@
 # main_api.py
+import asyncio
+import contextlib
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
 import logging
-from tasks import refresh_single_user_recommendations
+from config import (
+    BATCH_MAX_USERS,
+    HEURISTICS_REFRESH_SECONDS,
+    INLINE_WARM_RECOMMENDATIONS,
+    INLINE_WARM_BUDGET_MS,
+    INLINE_WARM_WORKERS,
+)
+from database import get_users_data
+from refresh_coalescer import get_refresh_coalescer
+from tasks import refresh_single_user_recommendations, refresh_users_recommendations
 from topk_hybrid_advanced import get_recommender
+from upstash_client import upstash_client
 
 app = FastAPI()
 logger = logging.getLogger(__name__)
 
 recommender = None
+# periodic heuristics refresh, cancelled on shutdown
+refresh_task = None
+
+# warm-user recommendations computed in-process (INLINE_WARM_RECOMMENDATIONS)
+inline_executor = (
+    ThreadPoolExecutor(max_workers=INLINE_WARM_WORKERS, thread_name_prefix="inline-recs")
+    if INLINE_WARM_RECOMMENDATIONS else None
+)
+# inline computations that missed the budget, referenced until they finish
+inline_tasks = set()
+# in-flight markers of in-process refreshes; these are not Celery task ids
+INLINE_TOKEN_PREFIX = "inline-"
 
 
 @app.on_event("startup")
 async def startup_event():
-    global recommender
+    global recommender, refresh_task
     recommender = get_recommender()
     logger.info("Recommender initialized on startup")
 
+    if HEURISTICS_REFRESH_SECONDS > 0:
+        refresh_task = asyncio.create_task(refresh_heuristics_periodically())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if refresh_task is not None:
+        refresh_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await refresh_task
+        logger.info("Heuristics refresh stopped")
+
+
+async def refresh_heuristics_periodically():
+    """
+    Apply incremental MongoDB changes to the recommender, live FAISS
+    changes from the delta log to its ANN index, and a user embedding store
+    rewritten by the nightly job, off the event loop.
+    """
+    while True:
+        await asyncio.sleep(HEURISTICS_REFRESH_SECONDS)
+        try:
+            await asyncio.to_thread(recommender.refresh_heuristics_data)
+        except Exception:
+            logger.exception("Heuristics refresh failed")
+
+        if recommender.indexer is not None:
+            try:
+                await asyncio.to_thread(recommender.indexer.apply_delta_log)
+            except Exception:
+                logger.exception("FAISS delta log replay failed")
+
+        if recommender.embedder is not None:
+            try:
+                await asyncio.to_thread(recommender.embedder.user_store.reload_if_changed)
+            except Exception:
+                logger.exception("User embedding store reload failed")
+
+
+async def compute_inline_recommendations(user_id: str):
+    """
+    Run the warm-user pipeline (heuristic two-stage list, not the SBERT/FAISS
+    list of the Celery refresh) in the thread pool within INLINE_WARM_BUDGET_MS.
+
+    The computation is claimed as the user's in-flight refresh, so a request
+    arriving meanwhile does not start another one and the caller does not
+    enqueue a Celery task for the same user. Over budget it keeps running and
+    caches its list; Celery only takes over if it fails.
+
+    Returns:
+        Tuple of (recommendations, task_id): the list if it made the budget,
+        else None with the in-flight refresh id to report (None: enqueue one)
+    """
+    coalescer = get_refresh_coalescer()
+    token = f"{INLINE_TOKEN_PREFIX}{uuid.uuid4()}"
+    existing = await coalescer.aclaim(user_id, token)
+    if existing:
+        return None, existing
+
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(inline_executor, recommender.get_warm_recommendations, user_id)
+    try:
+        # shield: on timeout only the wait is cancelled, the result is still collected
+        recommendations = await asyncio.wait_for(asyncio.shield(future), timeout=INLINE_WARM_BUDGET_MS / 1000)
+    except asyncio.TimeoutError:
+        logger.info(f"Inline recommendations for {user_id} exceeded {INLINE_WARM_BUDGET_MS} ms")
+        task = asyncio.create_task(finish_inline_recommendations(user_id, future, token))
+        inline_tasks.add(task)
+        task.add_done_callback(inline_tasks.discard)
+        return None, token
+    except Exception:
+        logger.exception(f"Inline recommendations failed for {user_id}")
+        recommendations = None
+
+    await coalescer.arelease(user_id, token)
+    return recommendations, None
+
+
+async def finish_inline_recommendations(user_id: str, future, token: str):
+    """Wait out an inline computation that missed the budget; enqueue Celery if it fails."""
+    try:
+        recommendations = await future
+    except Exception:
+        logger.exception(f"Inline recommendations failed for {user_id}")
+        recommendations = None
+
+    try:
+        await get_refresh_coalescer().arelease(user_id, token)
+        if not recommendations:
+            await enqueue_refresh(user_id)
+    except Exception:
+        logger.exception(f"Fallback refresh failed for {user_id}")
+
+
+async def revalidate_recommendations(user_id: str):
+    """
+    Background refresh of a stale cache entry; the stale list keeps being
+    served until the new one is stored. Coalesced per user like enqueue_refresh.
+    """
+    try:
+        if not recommender.is_cold_start_user(user_id):
+            await enqueue_refresh(user_id)
+            return
+
+        # cold-start lists come from the in-process pipeline, not the Celery task
+        coalescer = get_refresh_coalescer()
+        token = f"{INLINE_TOKEN_PREFIX}{uuid.uuid4()}"
+        if await coalescer.aclaim(user_id, token):
+            return
+        try:
+            await asyncio.to_thread(recommender.get_cold_start_recommendations, user_id, recommender.top_k)
+        finally:
+            await coalescer.arelease(user_id, token)
+    except Exception:
+        logger.exception(f"Background refresh failed for {user_id}")
+
+
+def refresh_source(token: str):
+    """
+    Map an in-flight refresh marker to the (task_id, source) reported to clients.
+
+    Only Celery refreshes have a pollable task id; an in-process one reports
+    task_id None with source "inline".
+    """
+    if token.startswith(INLINE_TOKEN_PREFIX):
+        return None, "inline"
+    return token, "on-demand"
+
+
+async def enqueue_refresh(user_id: str):
+    """
+    Enqueue refresh_single_user_recommendations unless one is already in flight
+    for this user.
+
+    Returns:
+        Tuple of (token, enqueued); token is the existing refresh's marker
+        when enqueued is False (see refresh_source)
+    """
+    coalescer = get_refresh_coalescer()
+    task_id = str(uuid.uuid4())
+
+    existing = await coalescer.aclaim(user_id, task_id)
+    if existing:
+        logger.info(f"Refresh already in flight for {user_id} (task {existing})")
+        return existing, False
+
+    try:
+        refresh_single_user_recommendations.apply_async(
+            args=[user_id],
+            kwargs={"inflight_token": task_id},
+            queue="recommendations",
+            task_id=task_id,
+        )
+    except Exception:
+        await coalescer.arelease(user_id, task_id)
+        raise
+    return task_id, True
+
 
 @app.get("/recommendations/{user_id}")
 async def get_recommendations(user_id: str, background_tasks: BackgroundTasks):
     """
     Flow:
-      1) If cache hit -> return cache
+      1) If cache hit -> return cache; a stale entry is still returned and refreshed in the background
       2) If cold-start -> compute heuristics + collaborative synchronously -> return + cache
-      3) Else -> enqueue Celery on-demand refresh and return 202 'generating'
+      3) If INLINE_WARM_RECOMMENDATIONS -> compute in-process within the latency budget -> return + cache;
+         over budget it finishes in the background as the user's refresh -> 202 'generating'
+      4) Else -> enqueue Celery on-demand refresh and return 202 'generating'
+
+    Inline lists (source "inline") are the heuristic / collaborative two-stage
+    ranking; Celery refreshes cache the SBERT/FAISS list. Both are served
+    from the cache afterwards. A 202 for an in-process refresh has task_id
+    None and source "inline"; only Celery task ids can be polled.
     """
     try:
-        result = recommender.get_hybrid_recommendations(user_id)
+        result = await recommender.aget_hybrid_recommendations(user_id)
 
         # If recommendations present (cache or cold_start) -> return
         if result.get("recommendations") is not None:
             logger.info(f"Returning {result.get('source')} recommendations for {user_id}")
+            if result.get("stale"):
+                background_tasks.add_task(revalidate_recommendations, user_id)
             return JSONResponse({
                 "user_id": user_id,
                 "recommendations": result["recommendations"],
                 "source": result.get("source"),
                 "strategy": result.get("strategy"),
+                "stale": bool(result.get("stale")),
             })
 
-        # Otherwise: cache miss and not cold-start -> enqueue celery
-        logger.info(f"Cache miss & not cold-start for {user_id} -> enqueueing Celery task")
-        refresh_single_user_recommendations.apply_async(args=[user_id], queue="recommendations")
+        token = None
+        if inline_executor is not None:
+            recommendations, token = await compute_inline_recommendations(user_id)
+            if recommendations:
+                logger.info(f"Returning inline recommendations for {user_id}")
+                return JSONResponse({
+                    "user_id": user_id,
+                    "recommendations": recommendations,
+                    "source": "inline",
+                    "strategy": "inline",
+                })
+
+        if token is None:
+            # Otherwise: cache miss and not cold-start -> enqueue celery
+            logger.info(f"Cache miss & not cold-start for {user_id} -> enqueueing Celery task")
+            token, _ = await enqueue_refresh(user_id)
 
+        task_id, source = refresh_source(token)
         return JSONResponse(
             status_code=202,
             content={
                 "user_id": user_id,
+                "task_id": task_id,
                 "status": "generating",
                 "message": "Recommendations are being generated in background. Please retry in a few seconds.",
-                "source": "on-demand"
+                "source": source
             }
         )
 
@@ -58,11 +270,140 @@ async def get_recommendations(user_id: str, background_tasks: BackgroundTasks):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class BatchRecommendationsRequest(BaseModel):
+    user_ids: List[str]
+
+
+def _ndjson(record) -> str:
+    return json.dumps(record) + "\n"
+
+
+async def stream_batch_recommendations(user_ids: List[str]):
+    """
+    One NDJSON line per user, in four rounds:
+      0) malformed ids and users not in the database -> 'not_found'
+      1) cache hits from a single multi-get (stale ones are refreshed below)
+      2) cold-start users, computed together and cached in one pipeline
+      3) the remaining users, refreshed by one grouped Celery task (users
+         with a refresh already in flight are attached to it instead)
+    """
+    users = await asyncio.to_thread(get_users_data, user_ids, ['_id'])
+    known = {str(user['user_id']) for user in users}
+    for user_id in user_ids:
+        if user_id not in known:
+            yield _ndjson({"user_id": user_id, "status": "not_found"})
+    user_ids = [user_id for user_id in user_ids if user_id in known]
+    if not user_ids:
+        return
+
+    entries = await upstash_client.aget_many_entries(user_ids)
+
+    # generating: warm cache misses; stale_*: already answered from cache, refresh only
+    cold_start, stale_cold_start, generating, stale_warm = [], [], [], []
+    for user_id in user_ids:
+        entry = entries.get(user_id)
+        cold = recommender.is_cold_start_user(user_id)
+        if entry and entry[0]:
+            yield _ndjson({
+                "user_id": user_id,
+                "recommendations": entry[0],
+                "source": "cache",
+                "stale": entry[1],
+            })
+            if entry[1]:
+                (stale_cold_start if cold else stale_warm).append(user_id)
+        elif cold:
+            cold_start.append(user_id)
+        else:
+            generating.append(user_id)
+
+    if cold_start or stale_cold_start:
+        try:
+            computed = await asyncio.to_thread(
+                recommender.get_cold_start_recommendations_batch, cold_start + stale_cold_start, recommender.top_k
+            )
+            for user_id in cold_start:
+                yield _ndjson({
+                    "user_id": user_id,
+                    "recommendations": computed.get(user_id, []),
+                    "source": "cold_start",
+                    "stale": False,
+                })
+        except Exception as e:
+            logger.exception("Batch cold-start recommendations failed")
+            for user_id in cold_start:
+                yield _ndjson({"user_id": user_id, "status": "failed", "error": str(e)})
+
+    if generating or stale_warm:
+        # single-flight per user: users with a refresh in flight attach to it
+        coalescer = get_refresh_coalescer()
+        task_id = str(uuid.uuid4())
+        in_flight = await coalescer.aclaim_many(generating + stale_warm, task_id)
+        claimed = [user_id for user_id, existing in in_flight.items() if existing is None]
+        try:
+            if claimed:
+                refresh_users_recommendations.apply_async(
+                    args=[claimed],
+                    kwargs={"inflight_token": task_id},
+                    queue="recommendations",
+                    task_id=task_id,
+                )
+        except Exception as e:
+            logger.exception("Failed to enqueue batch refresh task")
+            await coalescer.arelease_many(claimed, task_id)
+            for user_id in generating:
+                yield _ndjson({"user_id": user_id, "status": "failed", "error": str(e)})
+            return
+
+        for user_id in generating:
+            user_task_id, source = refresh_source(in_flight[user_id] or task_id)
+            yield _ndjson({
+                "user_id": user_id,
+                "task_id": user_task_id,
+                "status": "generating",
+                "source": source,
+            })
+
+
+@app.post("/recommendations/batch")
+async def get_recommendations_batch(request: BatchRecommendationsRequest):
+    """
+    Recommendations for many users in one call (notification / email jobs),
+    streamed back as NDJSON, one line per distinct user id.
+    """
+    user_ids = list(dict.fromkeys(request.user_ids))
+    if len(user_ids) > BATCH_MAX_USERS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_USERS} user ids per request")
+
+    return StreamingResponse(stream_batch_recommendations(user_ids), media_type="application/x-ndjson")
+
+
 @app.post("/recommendations/refresh/{user_id}")
 async def manual_refresh(user_id: str):
     try:
-        result = refresh_single_user_recommendations.apply_async(args=[user_id], queue="recommendations")
-        return {"status": "refresh_queued", "user_id": user_id, "task_id": result.id}
+        token, enqueued = await enqueue_refresh(user_id)
+        status = "refresh_queued" if enqueued else "refresh_in_progress"
+        task_id, source = refresh_source(token)
+        return {"status": status, "user_id": user_id, "task_id": task_id, "source": source}
     except Exception as e:
         logger.exception("Failed to enqueue refresh task")
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Hit / miss counters of the in-process recommendation cache."""
+    return upstash_client.local_cache.stats()
+
+
+@app.post("/cache/generation/rollback")
+async def rollback_cache_generation():
+    """Serve the previous nightly generation again (e.g. after a bad model run)."""
+    try:
+        generation = await asyncio.to_thread(upstash_client.rollback_generation)
+    except Exception as e:
+        logger.exception("Cache rollback failed")
+        raise HTTPException(status_code=500, detail=str(e))
+    if generation is None:
+        raise HTTPException(status_code=409, detail="No previous cache generation to roll back to")
+    return {"status": "rolled_back", "generation": generation}
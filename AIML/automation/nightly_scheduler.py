@@ -36,6 +36,7 @@
 from celery import Celery
 from celery.schedules import crontab
 from topk_hybrid_advanced import get_recommender
+from config import FAISS_COMPACT_INTERVAL_SECONDS
 import logging
 
 logger = logging.getLogger(__name__)
@@ -81,6 +82,11 @@ app.conf.beat_schedule = {
         'task': 'nightly_scheduler.generate_nightly_recommendations',
         'schedule': crontab(hour=2, minute=0),  # 2:00 AM
     },
+    # fold live FAISS changes (tasks.index_posts / removals) into a new snapshot
+    'compact-faiss-index': {
+        'task': 'tasks.compact_faiss_index',
+        'schedule': FAISS_COMPACT_INTERVAL_SECONDS,
+    },
 }
 
 if __name__ == '__main__':
@@ -0,0 +1,122 @@
+# recommendation_codec.py
+
+import base64
+import json
+import re
+import struct
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Cached recommendation lists are stored as text (the Upstash REST API only
+# carries strings), so the binary payload is base64 encoded behind a version
+# prefix. Anything without the prefix is read as the old JSON format.
+#
+# v1 payload, little endian:
+#   uint8  flags          bit 0: item ids are packed 12-byte ObjectIds
+#   uint32 timestamp      unix seconds the list was computed
+#   uint16 count
+#   float16[count]        scores; rank is the position in the list
+#   ids                   count * 12 bytes, or count * (uint16 length + utf-8)
+BINARY_PREFIX = "rb1:"
+
+_HEADER = struct.Struct("<BIH")
+_FLAG_OBJECT_IDS = 0x01
+_OBJECT_ID = re.compile(r"[0-9a-f]{24}")
+_ITEM_KEYS = {"item_id", "score", "rank"}
+
+
+def _encodable(recommendations: List[Dict[str, Any]]) -> bool:
+    """Only plain {item_id, score, rank} lists ranked 1..n fit the binary format."""
+    if len(recommendations) > 0xFFFF:
+        return False
+    for position, rec in enumerate(recommendations, 1):
+        if not isinstance(rec, dict) or rec.keys() != _ITEM_KEYS or rec["rank"] != position:
+            return False
+    return True
+
+
+def encode_recommendations(
+    recommendations: List[Dict[str, Any]], timestamp: Optional[int] = None, binary: bool = True
+) -> str:
+    """
+    Serialize a recommendation list for the cache
+
+    Args:
+        recommendations: [{"item_id", "score", "rank"}, ...] best first
+        timestamp: Unix seconds the list was computed (default: now)
+        binary: Use the compact format when the list allows it, JSON otherwise
+
+    Returns:
+        Cache value (str)
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+
+    if not binary or not _encodable(recommendations):
+        return json.dumps({"recommendations": recommendations, "timestamp": timestamp})
+
+    item_ids = [str(rec["item_id"]) for rec in recommendations]
+    scores = np.asarray([rec["score"] for rec in recommendations], dtype="<f2")
+
+    flags = 0
+    if all(_OBJECT_ID.fullmatch(item_id) for item_id in item_ids):
+        flags |= _FLAG_OBJECT_IDS
+        ids = b"".join(bytes.fromhex(item_id) for item_id in item_ids)
+    else:
+        parts = []
+        for item_id in item_ids:
+            encoded = item_id.encode("utf-8")
+            parts.append(struct.pack("<H", len(encoded)))
+            parts.append(encoded)
+        ids = b"".join(parts)
+
+    payload = _HEADER.pack(flags, timestamp, len(item_ids)) + scores.tobytes() + ids
+    return BINARY_PREFIX + base64.b64encode(payload).decode("ascii")
+
+
+def decode_recommendations(value) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Read a cache value in any supported format
+
+    Args:
+        value: str / bytes from Redis; binary v1, the Upstash JSON object
+            ({"recommendations": [...], "timestamp": ...}) or a bare JSON list
+
+    Returns:
+        Tuple of (recommendations, timestamp); timestamp is None if unknown
+    """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+
+    if not value.startswith(BINARY_PREFIX):
+        data = json.loads(value)
+        if isinstance(data, list):
+            return data, None
+        return data["recommendations"], data.get("timestamp")
+
+    payload = base64.b64decode(value[len(BINARY_PREFIX):])
+    flags, timestamp, count = _HEADER.unpack_from(payload)
+    offset = _HEADER.size
+
+    # float16 keeps ~3 significant digits; round off the binary noise
+    scores = np.frombuffer(payload, dtype="<f2", count=count, offset=offset).astype(np.float64).round(4).tolist()
+    offset += 2 * count
+
+    item_ids = []
+    if flags & _FLAG_OBJECT_IDS:
+        hex_ids = payload[offset:offset + 12 * count].hex()
+        item_ids = [hex_ids[i:i + 24] for i in range(0, 24 * count, 24)]
+    else:
+        for _ in range(count):
+            (length,) = struct.unpack_from("<H", payload, offset)
+            offset += 2
+            item_ids.append(payload[offset:offset + length].decode("utf-8"))
+            offset += length
+
+    recommendations = [
+        {"item_id": item_id, "score": score, "rank": rank}
+        for rank, (item_id, score) in enumerate(zip(item_ids, scores), 1)
+    ]
+    return recommendations, timestamp
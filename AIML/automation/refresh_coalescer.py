@@ -0,0 +1,170 @@
+# refresh_coalescer.py
+
+import logging
+from typing import Dict, Iterable, Optional
+from upstash_redis import Redis
+from upstash_redis.asyncio import Redis as AsyncRedis
+from config import REFRESH_INFLIGHT_TTL_SECONDS
+from upstash_client import upstash_client
+
+logger = logging.getLogger(__name__)
+
+# DEL the marker only if it still holds the caller's task id, in one step
+_RELEASE_IF_OWNER = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _is_upstash(client) -> bool:
+    return isinstance(client, (Redis, AsyncRedis))
+
+
+def _eval(client, script: str, keys, args, pipeline=None):
+    """
+    EVAL on client, or queued on a pipeline of it, with Upstash's keyword
+    signature or redis-py's numkeys one.
+    """
+    target = client if pipeline is None else pipeline
+    if _is_upstash(client):
+        return target.eval(script, keys=keys, args=args)
+    return target.eval(script, len(keys), *keys, *args)
+
+
+def _exec(client, pipeline):
+    """Send a pipeline of client: Upstash's exec() or redis-py's execute()."""
+    return pipeline.exec() if _is_upstash(client) else pipeline.execute()
+
+
+class RefreshCoalescer:
+    """
+    Single-flight guard for on-demand refreshes of one user.
+
+    The first request sets refresh:inflight:{user_id} to its Celery task id
+    with SET NX + TTL; concurrent requests read the marker and attach to that
+    task instead of enqueueing another one. The task clears the marker when
+    it finishes, the TTL covers workers that die mid-task. Batch refreshes
+    claim and release the markers of all their users in one pipeline.
+
+    Any redis-py compatible pair of clients works (e.g. fakeredis locally);
+    the default is the Upstash client used for the recommendation cache.
+    """
+
+    def __init__(self, redis_client=None, async_redis_client=None, ttl_seconds: int = REFRESH_INFLIGHT_TTL_SECONDS):
+        self.redis = redis_client if redis_client is not None else upstash_client.sync_redis
+        self.async_redis = async_redis_client if async_redis_client is not None else upstash_client.async_redis
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, user_id: str) -> str:
+        return f"refresh:inflight:{user_id}"
+
+    async def aclaim(self, user_id: str, task_id: str) -> Optional[str]:
+        """
+        Try to become the refresh for user_id
+
+        Args:
+            user_id: User to refresh
+            task_id: Task id the caller will enqueue under if it wins
+
+        Returns:
+            None if the caller should enqueue, otherwise the in-flight task id
+        """
+        key = self._key(user_id)
+        try:
+            if await self.async_redis.set(key, task_id, nx=True, ex=self.ttl_seconds):
+                return None
+            existing = await self.async_redis.get(key)
+        except Exception as e:
+            # never block refreshes on the marker store
+            logger.error(f"✗ Error claiming refresh for {user_id}: {str(e)}")
+            return None
+
+        if isinstance(existing, bytes):
+            existing = existing.decode()
+        # None: the other refresh finished between SET and GET
+        return existing or None
+
+    async def arelease(self, user_id: str, task_id: str):
+        """Async release() for the API when enqueueing fails after a claim."""
+        try:
+            await _eval(self.async_redis, _RELEASE_IF_OWNER, [self._key(user_id)], [task_id])
+        except Exception as e:
+            logger.error(f"✗ Error releasing refresh for {user_id}: {str(e)}")
+
+    async def aclaim_many(self, user_ids: Iterable[str], task_id: str) -> Dict[str, Optional[str]]:
+        """
+        aclaim for every user of a batch refresh, in one round trip
+
+        Args:
+            user_ids: Users to refresh
+            task_id: Task id the caller will enqueue under for the users it wins
+
+        Returns:
+            Dict user_id -> None if the caller should refresh that user,
+            otherwise the in-flight task id
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        try:
+            pipeline = self.async_redis.pipeline()
+            for user_id in user_ids:
+                key = self._key(user_id)
+                pipeline.set(key, task_id, nx=True, ex=self.ttl_seconds)
+                pipeline.get(key)
+            results = await _exec(self.async_redis, pipeline)
+        except Exception as e:
+            logger.error(f"✗ Error claiming refresh for {len(user_ids)} users: {str(e)}")
+            return dict.fromkeys(user_ids)
+
+        claims = {}
+        for user_id, claimed, existing in zip(user_ids, results[::2], results[1::2]):
+            if isinstance(existing, bytes):
+                existing = existing.decode()
+            claims[user_id] = None if claimed else (existing or None)
+        return claims
+
+    async def arelease_many(self, user_ids: Iterable[str], task_id: str):
+        """Async release_many() for the API when enqueueing fails after a claim."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        try:
+            pipeline = self.async_redis.pipeline()
+            for user_id in user_ids:
+                _eval(self.async_redis, _RELEASE_IF_OWNER, [self._key(user_id)], [task_id], pipeline)
+            await _exec(self.async_redis, pipeline)
+        except Exception as e:
+            logger.error(f"✗ Error releasing refresh for {len(user_ids)} users: {str(e)}")
+
+    def release_many(self, user_ids: Iterable[str], task_id: str):
+        """release() for every user of a batch refresh, in one round trip."""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        try:
+            pipeline = self.redis.pipeline()
+            for user_id in user_ids:
+                _eval(self.redis, _RELEASE_IF_OWNER, [self._key(user_id)], [task_id], pipeline)
+            _exec(self.redis, pipeline)
+        except Exception as e:
+            logger.error(f"✗ Error releasing refresh for {len(user_ids)} users: {str(e)}")
+
+    def release(self, user_id: str, task_id: str):
+        """Clear the marker if it still belongs to task_id (a newer claim is left alone)."""
+        try:
+            _eval(self.redis, _RELEASE_IF_OWNER, [self._key(user_id)], [task_id])
+        except Exception as e:
+            logger.error(f"✗ Error releasing refresh for {user_id}: {str(e)}")
+
+
+_coalescer = None
+
+
+def get_refresh_coalescer():
+    global _coalescer
+    if _coalescer is None:
+        _coalescer = RefreshCoalescer()
+    return _coalescer
@@ -1,73 +1,170 @@
 import logging
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from celery_app import app  # ⬅️ use the configured Celery app instead of shared_task
 
-from database import get_all_users, get_user_data
+from database import (
+    get_all_users,
+    get_user_data,
+    get_users_data,
+    get_posts_data,
+    get_inactive_post_ids,
+    get_voted_post_ids,
+    EMBEDDING_POST_FIELDS,
+    PROFILE_USER_FIELDS,
+)
 from model_loader import get_recommendation_model
 from embedding_generator import get_embedding_generator
 from faiss_indexer import get_faiss_indexer
 from upstash_client import upstash_client
-from config import TOP_K, CACHE_EXPIRY_HOURS
+from refresh_coalescer import get_refresh_coalescer
+from config import (
+    TOP_K,
+    CACHE_EXPIRY_HOURS,
+    INACTIVE_POSTS_REFRESH_SECONDS,
+    NIGHTLY_ENCODE_BATCH_SIZE,
+    NIGHTLY_WRITE_CHUNK_SIZE,
+)
 
 logger = logging.getLogger(__name__)
 
+# when the worker last read the inactive post ids into the FAISS exclusion filter
+_inactive_posts_checked = float("-inf")
+
+
+def _exclude_inactive_posts(faiss_indexer, force=False):
+    """
+    Filter inactive posts inside the FAISS query. The ids come from a scan
+    of the posts collection, so on-demand refreshes reuse the last set for
+    INACTIVE_POSTS_REFRESH_SECONDS; the nightly run always re-reads it.
+    """
+    global _inactive_posts_checked
+    now = time.monotonic()
+    if force or now - _inactive_posts_checked >= INACTIVE_POSTS_REFRESH_SECONDS:
+        faiss_indexer.set_excluded_posts(get_inactive_post_ids())
+        _inactive_posts_checked = now
+
+
+def _to_recommendations(distances, item_ids):
+    return [
+        {
+            "item_id": str(item_id),
+            "score": float(1 / (1 + distance)),
+            "rank": rank + 1,
+        }
+        for rank, (distance, item_id) in enumerate(zip(distances, item_ids))
+    ]
+
+
+def _recommend_batch(faiss_indexer, user_ids, embeddings):
+    """One 2-D FAISS query for a batch of users, skipping posts each user voted on."""
+    voted = get_voted_post_ids(user_ids)
+    scores, item_ids = faiss_indexer.search_batch(
+        embeddings, k=TOP_K, exclude=[voted.get(user_id, ()) for user_id in user_ids]
+    )
+    return {
+        user_id: _to_recommendations(user_scores.compressed(), user_item_ids.compressed())
+        for user_id, user_scores, user_item_ids in zip(user_ids, scores, item_ids)
+    }
+
+
+def _store_chunk(user_recommendations, generation=None):
+    """Write one chunk through a single Upstash pipeline; returns #failed users."""
+    results = upstash_client.store_batch_recommendations(
+        user_recommendations, expiry_hours=CACHE_EXPIRY_HOURS, generation=generation
+    )
+    return sum(1 for ok in results.values() if not ok)
+
 
 @app.task(bind=True, max_retries=3, default_retry_delay=60, name="tasks.generate_recommendations_task")
 def generate_recommendations_task(self):
     """
     Nightly batch: Generate and directly cache recommendations in Upstash for all users.
+
+    Profile embeddings come from the persistent user embedding store, so SBERT
+    only runs for new or changed profiles. Users are searched with one 2-D FAISS
+    query per NIGHTLY_ENCODE_BATCH_SIZE users; results are written
+    NIGHTLY_WRITE_CHUNK_SIZE users per Upstash pipeline on a background thread
+    while the next batch is searched. Inactive posts and posts the user
+    already voted on are filtered inside the FAISS query.
+
+    Results go into a new cache generation that readers only see once every
+    user is written (publish_generation); a failed run leaves the previous
+    generation in place. Superseded generations are collected afterwards.
     """
     try:
         logger.info("🌙 Starting nightly batch recommendation generation...")
         recommendation_model = get_recommendation_model()
         embedding_generator = get_embedding_generator()
+        embedding_generator.user_store.reload_if_changed()
         faiss_indexer = get_faiss_indexer()
+        faiss_indexer.apply_delta_log()
+        _exclude_inactive_posts(faiss_indexer, force=True)
+
+        users = get_all_users(projection=PROFILE_USER_FIELDS)
+        generation = upstash_client.begin_generation()
+        logger.info(f"Processing {len(users)} users into cache generation {generation}...")
+
+        started = time.perf_counter()
+
+        user_store = embedding_generator.user_store
+        rows = user_store.sync(
+            [str(user.get("user_id")) for user in users],
+            [embedding_generator.user_text(user) for user in users],
+            embedding_generator.encode,
+            batch_size=NIGHTLY_ENCODE_BATCH_SIZE,
+        )
 
-        users = get_all_users()
-        logger.info(f"Processing {len(users)} users...")
+        pending_writes = []
+        chunk = {}
 
-        user_recommendations = {}
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            for start in range(0, len(users), NIGHTLY_ENCODE_BATCH_SIZE):
+                batch = users[start:start + NIGHTLY_ENCODE_BATCH_SIZE]
+                batch_ids = [str(user.get("user_id")) for user in batch]
+                embeddings = user_store.vectors[rows[start:start + NIGHTLY_ENCODE_BATCH_SIZE]]
 
-        for idx, user in enumerate(users):
-            user_id = str(user.get("user_id"))
+                for user_id, recommendations in _recommend_batch(faiss_indexer, batch_ids, embeddings).items():
+                    chunk[user_id] = recommendations
 
-            profile_text = (
-                str(user.get("username", "")) + " "
-                + str(user.get("bio", "")) + " "
-                + str(user.get("interests", ""))
-            )
+                    if len(chunk) >= NIGHTLY_WRITE_CHUNK_SIZE:
+                        pending_writes.append(writer.submit(_store_chunk, chunk, generation))
+                        chunk = {}
 
-            embedding = embedding_generator.model.encode(
-                [profile_text], convert_to_numpy=True
-            )
+                logger.info(f"✓ Done for {start + len(batch)}/{len(users)} users")
 
-            distances, item_ids = faiss_indexer.search(embedding[0], k=TOP_K)
+            if chunk:
+                pending_writes.append(writer.submit(_store_chunk, chunk, generation))
 
-            recommendations = [
-                {
-                    "item_id": str(item_id),
-                    "score": float(1 / (1 + distance)),
-                    "rank": rank + 1,
-                }
-                for rank, (distance, item_id) in enumerate(
-                    zip(distances[0], item_ids[0])
-                )
-            ]
+            failed = sum(future.result() for future in pending_writes)
 
-            # Store in Upstash Redis, per-user
-            upstash_client.store_user_recommendations(
-                user_id, recommendations, expiry_hours=CACHE_EXPIRY_HOURS
-            )
-            user_recommendations[user_id] = recommendations
+        # only a complete generation is published; a partial one is garbage-collected later
+        published = failed == 0
+        if published:
+            upstash_client.publish_generation(generation)
+            collect_cache_generations.delay()
+        else:
+            logger.error(f"❌ {failed} failed writes, cache generation {generation} not published")
 
-            if (idx + 1) % 100 == 0:
-                logger.info(f"✓ Done for {idx + 1}/{len(users)} users")
+        elapsed = time.perf_counter() - started
+        users_per_sec = len(users) / elapsed if elapsed > 0 else 0.0
 
-        logger.info(f"✅ Nightly batch complete for {len(users)} users")
+        logger.info(
+            f"✅ Nightly batch complete for {len(users)} users "
+            f"in {elapsed:.1f}s ({users_per_sec:.1f} users/sec, {failed} failed writes)"
+        )
         return {
             "status": "success",
             "users_processed": len(users),
+            "failed_writes": failed,
+            "generation": generation,
+            "published": published,
+            "elapsed_seconds": round(elapsed, 2),
+            "users_per_second": round(users_per_sec, 2),
         }
 
     except Exception as exc:
@@ -76,43 +173,40 @@ def generate_recommendations_task(self):
 
 
 @app.task(name="tasks.refresh_single_user_recommendations")
-def refresh_single_user_recommendations(user_id: str):
+def refresh_single_user_recommendations(user_id: str, inflight_token: str = None):
     """
     On-demand: Generate and cache recommendations in Upstash for a single user.
+
+    inflight_token is the single-flight marker value the API claimed for this
+    task (see refresh_coalescer); it is released when the task finishes.
     """
     try:
         logger.info(f"🔄 Refreshing recommendations for user {user_id}...")
         recommendation_model = get_recommendation_model()
         embedding_generator = get_embedding_generator()
+        embedding_generator.user_store.reload_if_changed()
         faiss_indexer = get_faiss_indexer()
+        faiss_indexer.apply_delta_log()
+        _exclude_inactive_posts(faiss_indexer)
 
-        user = get_user_data(user_id)
+        user = get_user_data(user_id, projection=PROFILE_USER_FIELDS)
         if not user:
             logger.warning(f"No user found with ID {user_id}")
             return {"status": "not_found", "user_id": user_id}
 
-        profile_text = (
-            str(user.get("username", "")) + " "
-            + str(user.get("bio", "")) + " "
-            + str(user.get("interests", ""))
-        )
+        # reuse the stored embedding unless the profile changed since it was encoded
+        profile_text = embedding_generator.user_text(user)
+        rows, _ = embedding_generator.user_store.lookup([user_id], [profile_text])
+        if rows[0] >= 0:
+            embedding = embedding_generator.user_store.vectors[rows]
+        else:
+            embedding = embedding_generator.encode([profile_text])
 
-        embedding = embedding_generator.model.encode(
-            [profile_text], convert_to_numpy=True
+        voted = get_voted_post_ids([user_id])
+        scores, item_ids = faiss_indexer.search_batch(
+            embedding, k=TOP_K, exclude=[voted.get(user_id, ())]
         )
-
-        distances, item_ids = faiss_indexer.search(embedding[0], k=TOP_K)
-
-        recommendations = [
-            {
-                "item_id": str(item_id),
-                "score": float(1 / (1 + distance)),
-                "rank": rank + 1,
-            }
-            for rank, (distance, item_id) in enumerate(
-                zip(distances[0], item_ids[0])
-            )
-        ]
+        recommendations = _to_recommendations(scores[0].compressed(), item_ids[0].compressed())
 
         # Store in Upstash Redis for this user
         upstash_client.store_user_recommendations(
@@ -128,3 +222,144 @@ def refresh_single_user_recommendations(user_id: str):
     except Exception as e:
         logger.error(f"Error refreshing for user {user_id}: {str(e)}")
         return {"status": "failed", "error": str(e)}
+
+    finally:
+        if inflight_token:
+            get_refresh_coalescer().release(user_id, inflight_token)
+
+
+@app.task(name="tasks.refresh_users_recommendations")
+def refresh_users_recommendations(user_ids, inflight_token: str = None):
+    """
+    On-demand refresh for many users in one task (bulk API): one Mongo query,
+    one FAISS query per NIGHTLY_ENCODE_BATCH_SIZE users and one Upstash
+    pipeline per NIGHTLY_WRITE_CHUNK_SIZE users. Like the single-user refresh,
+    stored embeddings are reused and new ones are not written back.
+
+    inflight_token is the single-flight marker value the API claimed for
+    these users (see refresh_coalescer); they are released when the task finishes.
+    """
+    try:
+        logger.info(f"🔄 Refreshing recommendations for {len(user_ids)} users...")
+        embedding_generator = get_embedding_generator()
+        embedding_generator.user_store.reload_if_changed()
+        faiss_indexer = get_faiss_indexer()
+        faiss_indexer.apply_delta_log()
+        _exclude_inactive_posts(faiss_indexer)
+
+        users = get_users_data(user_ids, projection=PROFILE_USER_FIELDS)
+        found_ids = [str(user.get("user_id")) for user in users]
+        profile_texts = [embedding_generator.user_text(user) for user in users]
+
+        user_store = embedding_generator.user_store
+        rows, _ = user_store.lookup(found_ids, profile_texts)
+        embeddings = np.empty((len(users), user_store.dimension), dtype=np.float32)
+        stored = rows >= 0
+        embeddings[stored] = user_store.vectors[rows[stored]]
+        changed = np.flatnonzero(~stored)
+        for start in range(0, len(changed), NIGHTLY_ENCODE_BATCH_SIZE):
+            positions = changed[start:start + NIGHTLY_ENCODE_BATCH_SIZE]
+            embeddings[positions] = embedding_generator.encode([profile_texts[i] for i in positions])
+
+        failed = 0
+        chunk = {}
+        for start in range(0, len(users), NIGHTLY_ENCODE_BATCH_SIZE):
+            batch_ids = found_ids[start:start + NIGHTLY_ENCODE_BATCH_SIZE]
+            chunk.update(_recommend_batch(faiss_indexer, batch_ids, embeddings[start:start + NIGHTLY_ENCODE_BATCH_SIZE]))
+            if len(chunk) >= NIGHTLY_WRITE_CHUNK_SIZE:
+                failed += _store_chunk(chunk)
+                chunk = {}
+        if chunk:
+            failed += _store_chunk(chunk)
+
+        return {
+            "status": "success",
+            "users_refreshed": len(users),
+            "not_found": len(set(map(str, user_ids)) - set(found_ids)),
+            "failed_writes": failed,
+        }
+
+    except Exception as e:
+        logger.error(f"Error refreshing {len(user_ids)} users: {str(e)}")
+        return {"status": "failed", "error": str(e)}
+
+    finally:
+        if inflight_token:
+            get_refresh_coalescer().release_many(user_ids, inflight_token)
+
+
+@app.task(name="tasks.invalidate_post_recommendations")
+def invalidate_post_recommendations(post_id: str):
+    """
+    A post was deleted, flagged or set to non-active: remove it from every
+    cached recommendation list that contains it (see
+    UpstashClient.invalidate_post) and from the live FAISS index.
+    """
+    try:
+        # out of the live index too, for every process replaying the delta log
+        get_faiss_indexer().remove_posts([post_id])
+        changed = upstash_client.invalidate_post(post_id)
+        return {"status": "success", "post_id": post_id, "lists_changed": changed}
+    except Exception as e:
+        logger.error(f"Error invalidating post {post_id}: {str(e)}")
+        return {"status": "failed", "error": str(e)}
+
+
+@app.task(name="tasks.index_posts")
+def index_posts(post_ids):
+    """
+    New or edited posts: embed them and upsert them into the live FAISS index;
+    posts that are missing or not active are removed instead. The change goes
+    through the delta log, so the API and the other workers pick it up with
+    apply_delta_log() instead of waiting for a rebuild. Stored post
+    embeddings are reused when the text is unchanged.
+    """
+    try:
+        faiss_indexer = get_faiss_indexer()
+        posts = get_posts_data(post_ids, projection=EMBEDDING_POST_FIELDS + ["status"])
+        # same rule as get_inactive_post_ids: only a status other than "active" retires a post
+        active = [post for post in posts if not isinstance(post.get("status"), str) or post["status"] == "active"]
+        active_ids = [str(post["post_id"]) for post in active]
+
+        removed = faiss_indexer.remove_posts([str(post_id) for post_id in post_ids if str(post_id) not in active_ids])
+        upserted = 0
+        if active:
+            embedding_generator = get_embedding_generator()
+            post_store = embedding_generator.post_store
+            post_store.reload_if_changed()
+            texts = [embedding_generator.post_text(post) for post in active]
+            rows, _ = post_store.lookup(active_ids, texts)
+            embeddings = np.empty((len(active), post_store.dimension), dtype=np.float32)
+            stored = rows >= 0
+            embeddings[stored] = post_store.vectors[rows[stored]]
+            if not stored.all():
+                embeddings[~stored] = embedding_generator.encode([texts[i] for i in np.flatnonzero(~stored)])
+            upserted = faiss_indexer.upsert_posts(embeddings, active_ids)
+
+        logger.info(f"Indexed {upserted} posts, removed {removed}")
+        return {"status": "success", "posts_indexed": upserted, "posts_removed": removed}
+    except Exception as e:
+        logger.error(f"Error indexing posts {post_ids}: {str(e)}")
+        return {"status": "failed", "error": str(e)}
+
+
+@app.task(name="tasks.compact_faiss_index")
+def compact_faiss_index():
+    """Periodic: fold the FAISS delta log into a new snapshot (see FAISSIndexer.compact)."""
+    try:
+        entries = get_faiss_indexer().compact()
+        return {"status": "success", "entries_compacted": entries}
+    except Exception as e:
+        logger.error(f"Error compacting FAISS index: {str(e)}")
+        return {"status": "failed", "error": str(e)}
+
+
+@app.task(name="tasks.collect_cache_generations")
+def collect_cache_generations():
+    """Background GC of old and abandoned cache generations (see UpstashClient.collect_generations)."""
+    try:
+        removed = upstash_client.collect_generations()
+        return {"status": "success", "keys_removed": removed}
+    except Exception as e:
+        logger.error(f"Error collecting cache generations: {str(e)}")
+        return {"status": "failed", "error": str(e)}
@@ -0,0 +1,48 @@
+"""
+Two EmbeddingStore instances sharing one file, the way the API process and
+the Celery worker running the nightly sync do.
+
+Run with: python -m pytest test_embedding_store.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from embedding_store import EmbeddingStore  # noqa: E402
+
+DIMENSION = 8
+
+
+def _encode(texts):
+    return np.array([np.full(DIMENSION, len(text), dtype=np.float32) for text in texts])
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "user_embeddings.npy")
+    EmbeddingStore(path, DIMENSION).sync(["u0", "u1"], ["a", "bb"], _encode)
+    return path
+
+
+def test_reload_picks_up_rows_synced_by_another_process(path):
+    reader, writer = EmbeddingStore(path, DIMENSION), EmbeddingStore(path, DIMENSION)
+    old_rows = reader.rows_for(["u0", "u1"])
+
+    writer.sync(["u0", "u1", "u2"], ["a", "bb", "ccc"], _encode)
+    assert reader.rows_for(["u2"])[0] == -1
+
+    reader.reload_if_changed()
+    assert reader.rows_for(["u2"])[0] >= 0
+    assert reader.vectors[reader.rows_for(["u2"])[0], 0] == 3
+    np.testing.assert_array_equal(reader.rows_for(["u0", "u1"]), old_rows)
+
+
+def test_reload_without_changes_keeps_the_mapping(path):
+    store = EmbeddingStore(path, DIMENSION)
+    vectors = store.vectors
+
+    store.reload_if_changed()
+    assert store.vectors is vectors
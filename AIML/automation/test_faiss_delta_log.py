@@ -0,0 +1,94 @@
+"""
+Two FAISSIndexer instances sharing one snapshot and delta log, the way the
+API process and the Celery workers do.
+
+Run with: python -m pytest test_faiss_delta_log.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+from faiss_indexer import FAISSIndexer  # noqa: E402
+
+DIMENSION = 8
+
+
+def _vectors(n, seed):
+    return np.random.default_rng(seed).random((n, DIMENSION), dtype=np.float32)
+
+
+def _post_ids(indexer):
+    return {indexer._post_id(label) for label in range(len(indexer.post_ids))} - {None}
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "faiss_index.bin")
+    builder = FAISSIndexer()
+    builder.create_index_cosine(_vectors(10, 0), [f"p{i}" for i in range(10)])
+    builder.save_index(path)
+    return path
+
+
+def _load(path):
+    indexer = FAISSIndexer()
+    indexer.load_index(path, mmap=False)
+    return indexer
+
+
+def test_writer_replays_entries_of_other_processes_before_appending(index_path):
+    a, b = _load(index_path), _load(index_path)
+
+    a.add_posts(_vectors(1, 1), ["a1"])
+    # b appends without calling apply_delta_log() first
+    b.add_posts(_vectors(1, 2), ["b1"])
+    a.apply_delta_log()
+    b.apply_delta_log()
+
+    assert {"a1", "b1"} <= _post_ids(a)
+    assert _post_ids(a) == _post_ids(b)
+
+
+def test_removes_propagate(index_path):
+    a, b = _load(index_path), _load(index_path)
+
+    a.remove_posts(["p3"])
+    assert b.apply_delta_log() == 1
+    assert "p3" not in _post_ids(b)
+
+    scores, post_ids = b.search_batch(_vectors(1, 3), k=10)
+    assert "p3" not in post_ids[0].compressed().tolist()
+
+
+def test_reader_reloads_after_compaction_even_when_the_log_grew_back(index_path):
+    a, b = _load(index_path), _load(index_path)
+
+    a.add_posts(_vectors(1, 4), ["a1"])
+    b.apply_delta_log()
+    b_offset = b._delta_log_offset
+
+    assert a.compact() == 1
+    # the new log outgrows the offset b read up to in the old one
+    a.add_posts(_vectors(5, 5), [f"a{i}" for i in range(2, 7)])
+    assert os.path.getsize(a.delta_log_path) > b_offset
+
+    b.apply_delta_log()
+    assert _post_ids(b) == _post_ids(a)
+
+
+def test_compact_without_pending_entries_is_a_no_op(index_path):
+    a = _load(index_path)
+    assert a.compact() == 0
+
+
+def test_fresh_load_sees_snapshot_and_log(index_path):
+    a = _load(index_path)
+    a.upsert_posts(_vectors(2, 6), ["p0", "n1"])
+    a.remove_posts(["p1"])
+
+    c = _load(index_path)
+    assert _post_ids(c) == _post_ids(a)
+    assert len(c.post_ids) == len(a.post_ids)
@@ -0,0 +1,132 @@
+"""
+Incremental refresh of the heuristic / collaborative snapshot
+(AdvancedTopKRecommender.refresh_heuristics_data) against an in-memory
+MongoDB (mongomock).
+
+Run with: python -m pytest test_heuristics_refresh.py
+"""
+import datetime as dt
+import os
+
+import pytest
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+
+mongomock = pytest.importorskip("mongomock")
+
+from bson import ObjectId  # noqa: E402
+
+import database  # noqa: E402
+import topk_hybrid_advanced  # noqa: E402
+from config import DATABASE_NAME  # noqa: E402
+
+T0 = dt.datetime(2025, 1, 1)
+T1 = dt.datetime(2025, 1, 2)
+
+
+def _unavailable():
+    raise RuntimeError("not available in tests")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(database, "MongoClient", lambda *args, **kwargs: client)
+    monkeypatch.setattr(database, "_mongo_connection", None)
+    for name in ("get_recommendation_model", "get_embedding_generator", "get_faiss_indexer"):
+        monkeypatch.setattr(topk_hybrid_advanced, name, _unavailable)
+    return client[DATABASE_NAME]
+
+
+def _post(community_id, updated_at=T0):
+    return {"_id": ObjectId(), "community_id": community_id, "score": 10, "status": "active", "updatedAt": updated_at}
+
+
+def _votes(post_ids, updated_at=T0, **fields):
+    return {
+        "votes": {"post": {"target_ids": list(post_ids), "value": 1}, "comment": {"target_ids": [], "value": 0}},
+        "updatedAt": updated_at,
+        **fields,
+    }
+
+
+@pytest.fixture
+def seeded(db):
+    community = ObjectId()
+    posts = [_post(community) for _ in range(5)]
+    users = [{"_id": ObjectId(), "num_posts": 1, "num_comments": 1, "updatedAt": T0} for _ in range(3)]
+    db.posts.insert_many(posts)
+    db.users.insert_many(users)
+    db.votes.insert_many([
+        _votes([posts[0]["_id"], posts[1]["_id"]], user_id=users[0]["_id"]),
+        _votes([posts[1]["_id"], posts[2]["_id"]], user_id=users[1]["_id"]),
+    ])
+    return community, posts, users
+
+
+def _cell(recommender, user_id, post_id):
+    state = recommender._state
+    return state.user_post_matrix[state.vote_user_index[str(user_id)], state.vote_post_index[str(post_id)]]
+
+
+def test_new_voter_keyed_by_document_id_is_added(db, seeded):
+    community, posts, _ = seeded
+    recommender = topk_hybrid_advanced.AdvancedTopKRecommender()
+
+    voter = ObjectId()
+    new_post = _post(community, T1)
+    db.votes.insert_one(_votes([posts[3]["_id"]], T1, _id=voter))
+    db.posts.insert_one(new_post)
+
+    assert recommender.refresh_heuristics_data()["status"] == "success"
+    assert str(new_post["_id"]) in recommender._state.post_index
+    assert _cell(recommender, voter, posts[3]["_id"]) == 1.0
+
+
+def test_changed_voter_keyed_by_document_id_replaces_its_row(db, seeded):
+    _, posts, _ = seeded
+    voter = ObjectId()
+    db.votes.insert_one(_votes([posts[3]["_id"]], _id=voter))
+    recommender = topk_hybrid_advanced.AdvancedTopKRecommender()
+    assert _cell(recommender, voter, posts[3]["_id"]) == 1.0
+
+    db.votes.update_one(
+        {"_id": voter},
+        {"$set": {"votes.post.target_ids": [posts[3]["_id"], posts[4]["_id"]], "updatedAt": T1}},
+    )
+
+    assert recommender.refresh_heuristics_data()["status"] == "success"
+    assert _cell(recommender, voter, posts[3]["_id"]) == 1.0
+    assert _cell(recommender, voter, posts[4]["_id"]) == 1.0
+
+
+def test_refresh_without_changes_keeps_the_snapshot(db, seeded):
+    recommender = topk_hybrid_advanced.AdvancedTopKRecommender()
+    before = recommender._state
+
+    for _ in range(2):
+        assert recommender.refresh_heuristics_data() == {"status": "success", "posts": 0, "users": 0, "votes": 0}
+    assert recommender._state.post_ids is before.post_ids
+    assert recommender._state.neighbour_ids is before.neighbour_ids
+
+
+def test_resaved_votes_do_not_rebuild_neighbours(db, seeded):
+    _, _, users = seeded
+    recommender = topk_hybrid_advanced.AdvancedTopKRecommender()
+    before = recommender._state
+
+    db.votes.update_one({"user_id": users[0]["_id"]}, {"$set": {"updatedAt": T1}})
+
+    assert recommender.refresh_heuristics_data()["votes"] == 1
+    assert recommender._state.neighbour_ids is before.neighbour_ids
+
+
+def test_late_write_on_the_watermark_is_picked_up(db, seeded):
+    community, _, _ = seeded
+    recommender = topk_hybrid_advanced.AdvancedTopKRecommender()
+
+    late = _post(community, T0)
+    db.posts.insert_one(late)
+
+    assert recommender.refresh_heuristics_data()["posts"] == 1
+    assert str(late["_id"]) in recommender._state.post_index
@@ -1,18 +1,87 @@
+import asyncio
+import copy
 import logging
+import threading
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity
-from typing import List, Dict, Any
+from scipy import sparse
+from typing import List, Dict, Any, Optional, Tuple
 
-from config import TOP_K
+from config import (
+    TOP_K,
+    COLLAB_TOP_N_NEIGHBOURS,
+    COLLAB_INCLUDE_COMMENT_VOTES,
+    MONGO_BATCH_SIZE,
+    CANDIDATE_ANN_K,
+    CANDIDATE_POPULAR_K,
+    CANDIDATE_COLLAB_K,
+)
 from model_loader import get_recommendation_model          # ✅ only PKL model from here
 from embedding_generator import get_embedding_generator    # ✅ SBERT embedder from here
 from faiss_indexer import get_faiss_indexer
-from database import get_mongo_connection
+from database import get_mongo_connection, HEURISTIC_POST_FIELDS, HEURISTIC_USER_FIELDS
 from upstash_client import upstash_client  # your existing Upstash wrapper
 
 logger = logging.getLogger(__name__)
 
+# rows of the user x user similarity computed per block when building neighbours
+SIMILARITY_BLOCK_ROWS = 512
+
+# collections whose updatedAt watermark drives incremental refreshes
+WATERMARK_COLLECTIONS = ("posts", "users", "votes")
+# ids of documents on the watermark remembered to skip them next time; past
+# this many the boundary is re-read instead (patching is idempotent)
+WATERMARK_MAX_BOUNDARY_IDS = 1000
+
+
+class HeuristicsState:
+    """
+    Everything the heuristic / collaborative scorers read, as one snapshot.
+
+    A snapshot is never modified once it is published on the recommender;
+    refreshes build a patched copy and swap the reference, so a request
+    that grabbed the old snapshot keeps a consistent view until it finishes.
+    """
+
+    def __init__(self):
+        self.posts_df: pd.DataFrame = pd.DataFrame()
+        self.user_profiles: Dict[str, Dict[str, Any]] = {}
+        self.user_post_matrix: sparse.csr_matrix | None = None
+
+        # columnar post arrays for vectorized cold-start scoring
+        self.post_ids: np.ndarray = np.empty(0, dtype=object)
+        self.post_index: Dict[str, int] = {}
+        self.post_community_codes: np.ndarray = np.empty(0, dtype=np.int64)
+        self.community_index: Dict[str, int] = {}
+        self.post_popularity: np.ndarray = np.empty(0, dtype=np.float64)
+        self.post_active: np.ndarray = np.empty(0, dtype=bool)
+
+        # sparse collaborative data: row/column lookups for user_post_matrix
+        # plus the top-N neighbours of every user (row indices + similarities)
+        self.vote_user_index: Dict[str, int] = {}
+        self.vote_post_index: Dict[str, int] = {}
+        self.neighbour_ids: np.ndarray | None = None
+        self.neighbour_sims: np.ndarray | None = None
+        # user_post_matrix column of every entry in post_ids (-1 if never voted)
+        self.post_vote_cols: np.ndarray = np.empty(0, dtype=np.int64)
+        # and the reverse: post_ids position of every matrix column (-1 if unknown)
+        self.vote_col_posts: np.ndarray = np.empty(0, dtype=np.int64)
+
+        # candidate generation: active post positions, most popular first,
+        # overall and per community code
+        self.popular_posts: np.ndarray = np.empty(0, dtype=np.int64)
+        self.community_popular_posts: Dict[int, np.ndarray] = {}
+
+        # optional user x comment vote matrix (COLLAB_INCLUDE_COMMENT_VOTES);
+        # comment co-votes count towards neighbour similarity
+        self.user_comment_matrix: sparse.csr_matrix | None = None
+        self.comment_user_index: Dict[str, int] = {}
+        self.vote_comment_index: Dict[str, int] = {}
+
+    def copy(self) -> "HeuristicsState":
+        """Shallow copy; callers replace fields rather than mutating them."""
+        return copy.copy(self)
+
 
 class AdvancedTopKRecommender:
     def __init__(self, top_k: int = TOP_K):
@@ -41,15 +110,29 @@ class AdvancedTopKRecommender:
         self.db_conn = get_mongo_connection()  # has .db attribute
         self.db = self.db_conn.db
 
-        # heuristic / collaborative data
-        self.posts_df: pd.DataFrame = pd.DataFrame()
-        self.user_post_matrix: pd.DataFrame | None = None
-        self.user_similarity_df: pd.DataFrame | None = None
-        self.user_profiles: Dict[str, Dict[str, Any]] = {}
+        # heuristic / collaborative data, swapped as a whole on refresh
+        self._state = HeuristicsState()
+        self._refresh_lock = threading.Lock()
+        # per collection (latest updatedAt, ids of the docs at it or None);
+        # None = no timestamped docs yet
+        self._watermarks: Dict[str, Any] = {name: None for name in WATERMARK_COLLECTIONS}
 
         # initialize heuristic data at startup
         self._init_heuristics_data()
 
+    # read-only views of the current snapshot
+    @property
+    def posts_df(self) -> pd.DataFrame:
+        return self._state.posts_df
+
+    @property
+    def user_profiles(self) -> Dict[str, Dict[str, Any]]:
+        return self._state.user_profiles
+
+    @property
+    def user_post_matrix(self) -> sparse.csr_matrix | None:
+        return self._state.user_post_matrix
+
     # ----------------- small helpers -----------------
     def _safe_int(self, value, default: int = 0) -> int:
         """
@@ -68,157 +151,644 @@ class AdvancedTopKRecommender:
         except Exception:
             return default
 
+    @staticmethod
+    def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Indices of the k highest scores, best first.
+        Ties keep their original order, same as a stable sort of the full array.
+        """
+        n = scores.shape[0]
+        if k <= 0 or n == 0:
+            return np.empty(0, dtype=np.int64)
+        if k < n:
+            part = np.argpartition(-scores, k - 1)[:k]
+            kth = scores[part].min()
+            # widen to every tie of the k-th score so the stable sort below decides
+            cand = np.flatnonzero(scores >= kth)
+        else:
+            cand = np.arange(n)
+        order = np.argsort(-scores[cand], kind="stable")
+        return cand[order][:k]
+
     # ----------------- Initialization helpers -----------------
     def _init_heuristics_data(self):
         logger.info("[HEURISTICS] initializing data...")
+        # read watermarks before the data so nothing written mid-load is skipped
+        watermarks = self._read_watermarks()
+        state = HeuristicsState()
         try:
             # -------- posts --------
-            posts_df = self.db_conn.get_posts()
+            posts_df = self.db_conn.get_posts(projection=HEURISTIC_POST_FIELDS)
             if posts_df is None or posts_df.empty:
                 logger.warning("[HEURISTICS] no posts found")
-                self.posts_df = pd.DataFrame()
             else:
-                # rename _id -> post_id is already done in get_posts()
-                # ensure post_id is string
-                if "post_id" in posts_df.columns:
-                    posts_df["post_id"] = posts_df["post_id"].astype(str)
-
-                # ensure community_id is string if exists
-                if "community_id" in posts_df.columns:
-                    posts_df["community_id"] = posts_df["community_id"].astype(str)
-
-                # ensure score column exists
-                if "score" not in posts_df.columns:
-                    posts_df["score"] = 0
+                state.posts_df = self._prepare_posts_df(posts_df)
+                logger.info(f"[HEURISTICS] loaded {len(state.posts_df)} posts")
 
-                self.posts_df = posts_df
-                logger.info(f"[HEURISTICS] loaded {len(self.posts_df)} posts")
+            self._build_post_arrays(state)
 
             # -------- user profiles --------
-            users_df = self.db_conn.get_users()
+            users_df = self.db_conn.get_users(projection=HEURISTIC_USER_FIELDS)
             if users_df is None or users_df.empty:
                 logger.warning("[HEURISTICS] no users found")
-                self.user_profiles = {}
             else:
-                self.user_profiles = {}
-                for _, row in users_df.iterrows():
-                    uid = str(row.get("user_id") or row.get("_id"))
-                    if not uid:
-                        continue
-
-                    num_posts = self._safe_int(row.get("num_posts"), 0)
-                    num_comments = self._safe_int(row.get("num_comments"), 0)
-
-                    total_votes = num_posts + num_comments
-
-                    communities = row.get("communities_followed") or []
-                    top_communities = {}
-                    try:
-                        for c in communities:
-                            top_communities[str(c)] = 1
-                    except Exception:
-                        top_communities = {}
-
-                    self.user_profiles[uid] = {
-                        "total_votes": total_votes,
-                        "top_communities": top_communities,
-                        "num_posts": num_posts,
-                        "num_comments": num_comments,
-                    }
-
-                logger.info(f"[HEURISTICS] built user_profiles for {len(self.user_profiles)} users")
+                state.user_profiles = self._build_user_profiles(users_df)
+                logger.info(f"[HEURISTICS] built user_profiles for {len(state.user_profiles)} users")
 
             # -------- votes / collaborative matrix --------
-            votes_df = self._load_votes_df()
-            if votes_df is not None and not votes_df.empty:
+            users, targets, values = self._load_vote_arrays("post")
+            if users.size:
                 try:
-                    upr = votes_df[votes_df["target_type"] == "post"]
-                    if upr.empty:
-                        logger.info("[HEURISTICS] no post votes in votes_df; collaborative disabled")
-                        self.user_post_matrix = None
-                        self.user_similarity_df = None
-                    else:
-                        matrix = upr.pivot_table(
-                            index="user_id",
-                            columns="target_id",
-                            values="value",
-                            fill_value=0,
-                        )
-                        self.user_post_matrix = matrix
-
-                        sim = cosine_similarity(matrix)
-                        self.user_similarity_df = pd.DataFrame(
-                            sim,
-                            index=matrix.index,
-                            columns=matrix.index,
-                        )
-                        logger.info(f"[HEURISTICS] built user-post matrix {matrix.shape}")
+                    (
+                        state.user_post_matrix,
+                        state.vote_user_index,
+                        state.vote_post_index,
+                    ) = self._build_vote_matrix(users, targets, values)
+                    logger.info(
+                        f"[HEURISTICS] built sparse user-post matrix {state.user_post_matrix.shape} "
+                        f"({state.user_post_matrix.nnz} votes)"
+                    )
+
+                    if COLLAB_INCLUDE_COMMENT_VOTES:
+                        users, targets, values = self._load_vote_arrays("comment")
+                        if users.size:
+                            (
+                                state.user_comment_matrix,
+                                state.comment_user_index,
+                                state.vote_comment_index,
+                            ) = self._build_vote_matrix(users, targets, values)
+                            logger.info(
+                                f"[HEURISTICS] built sparse user-comment matrix {state.user_comment_matrix.shape}"
+                            )
+
+                    self._build_neighbour_index(state)
                 except Exception as e:
                     logger.exception(f"[HEURISTICS] error building matrix/similarity: {e}")
-                    self.user_post_matrix = None
-                    self.user_similarity_df = None
+                    self._reset_collaborative(state)
             else:
-                logger.info("[HEURISTICS] no votes data found; collaborative disabled")
-                self.user_post_matrix = None
-                self.user_similarity_df = None
+                logger.info("[HEURISTICS] no post votes found; collaborative disabled")
 
+            self._link_post_vote_cols(state)
+
+            self._state = state
+            self._watermarks = watermarks
             logger.info("[HEURISTICS] init complete")
         except Exception as e:
             logger.exception(f"[HEURISTICS] init failed: {e}")
             # graceful fallback
-            self.posts_df = pd.DataFrame()
-            self.user_profiles = {}
-            self.user_post_matrix = None
-            self.user_similarity_df = None
+            self._state = HeuristicsState()
+
+    def refresh_heuristics_data(self) -> Dict[str, Any]:
+        """
+        Incrementally refresh heuristic data from MongoDB.
+
+        Pulls only posts, users and vote documents changed since the stored
+        watermark, patches a copy of the current snapshot and swaps it in
+        with a single reference assignment. Requests in flight keep reading
+        the old snapshot and are never blocked. The neighbour index is only
+        rebuilt when the vote matrices actually changed.
+
+        Hard-deleted documents are not detected; posts should be retired
+        through their status field, which is picked up like any update.
+
+        Returns:
+            Dict with the number of changed posts, users and vote documents
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            logger.info("[HEURISTICS] refresh already running; skipped")
+            return {"status": "skipped"}
+
+        try:
+            watermarks = self._read_watermarks()
+            old = self._state
+            state = old.copy()
+
+            posts_df = self.db_conn.get_posts(self._changed_since("posts"), projection=HEURISTIC_POST_FIELDS)
+            users_df = self.db_conn.get_users(self._changed_since("users"), projection=HEURISTIC_USER_FIELDS)
+            votes_filter = self._changed_since("votes")
+            voters = self._changed_voters(votes_filter)
+
+            posts_changed = posts_df is not None and not posts_df.empty
+            users_changed = users_df is not None and not users_df.empty
+
+            if posts_changed:
+                changed = self._prepare_posts_df(posts_df)
+                if old.posts_df.empty:
+                    state.posts_df = changed
+                else:
+                    kept = old.posts_df[~old.posts_df["post_id"].isin(changed["post_id"])]
+                    state.posts_df = pd.concat([kept, changed], ignore_index=True)
+                self._build_post_arrays(state)
+
+            if users_changed:
+                profiles = dict(old.user_profiles)
+                profiles.update(self._build_user_profiles(users_df))
+                state.user_profiles = profiles
+
+            if voters:
+                (
+                    state.user_post_matrix,
+                    state.vote_user_index,
+                    state.vote_post_index,
+                ) = self._patch_vote_matrix(
+                    old.user_post_matrix,
+                    old.vote_user_index,
+                    old.vote_post_index,
+                    voters,
+                    *self._load_vote_arrays("post", votes_filter),
+                )
+
+                if COLLAB_INCLUDE_COMMENT_VOTES:
+                    (
+                        state.user_comment_matrix,
+                        state.comment_user_index,
+                        state.vote_comment_index,
+                    ) = self._patch_vote_matrix(
+                        old.user_comment_matrix,
+                        old.comment_user_index,
+                        old.vote_comment_index,
+                        voters,
+                        *self._load_vote_arrays("comment", votes_filter),
+                    )
+
+                votes_changed = not (
+                    self._same_votes(old.user_post_matrix, state.user_post_matrix)
+                    and self._same_votes(old.user_comment_matrix, state.user_comment_matrix)
+                )
+                if votes_changed:
+                    self._build_neighbour_index(state)
+            else:
+                votes_changed = False
+
+            if posts_changed or votes_changed:
+                self._link_post_vote_cols(state)
+
+            self._state = state
+            # only advance watermarks that actually moved
+            for name, mark in watermarks.items():
+                if mark is not None:
+                    self._watermarks[name] = mark
+
+            stats = {
+                "status": "success",
+                "posts": 0 if not posts_changed else len(posts_df),
+                "users": 0 if not users_changed else len(users_df),
+                "votes": len(voters),
+            }
+            logger.info(f"[HEURISTICS] incremental refresh: {stats}")
+            return stats
+        except Exception as e:
+            logger.exception(f"[HEURISTICS] incremental refresh failed: {e}")
+            return {"status": "failed", "error": str(e)}
+        finally:
+            self._refresh_lock.release()
+
+    def _read_watermarks(self) -> Dict[str, Any]:
+        """
+        Latest updatedAt per collection with the ids of the documents at it
+        (None if no document has one; ids None if there are too many).
+        """
+        watermarks = {}
+        for name in WATERMARK_COLLECTIONS:
+            try:
+                coll = self.db.get_collection(name)
+                doc = coll.find_one(
+                    {"updatedAt": {"$exists": True}},
+                    projection={"updatedAt": 1},
+                    sort=[("updatedAt", -1)],
+                )
+                if doc is None:
+                    watermarks[name] = None
+                    continue
+                mark = doc.get("updatedAt")
+                boundary = [
+                    d["_id"]
+                    for d in coll.find({"updatedAt": mark}, projection={"_id": 1}).limit(WATERMARK_MAX_BOUNDARY_IDS + 1)
+                ]
+                watermarks[name] = (mark, boundary if len(boundary) <= WATERMARK_MAX_BOUNDARY_IDS else None)
+            except Exception as e:
+                logger.warning(f"[HEURISTICS] could not read {name} watermark: {e}")
+                watermarks[name] = None
+        return watermarks
+
+    def _changed_voters(self, filter_query: Dict[str, Any]) -> List[str]:
+        """Vote matrix rows touched by the matching vote documents, keyed like _load_vote_arrays."""
+        pipeline = [
+            {"$match": filter_query},
+            {"$group": {"_id": {"$toString": {"$ifNull": ["$user_id", "$_id"]}}}},
+        ]
+        return [row["_id"] for row in self.db.get_collection("votes").aggregate(pipeline)]
+
+    def _changed_since(self, name: str) -> Dict[str, Any]:
+        """
+        Filter for documents changed since the stored watermark.
+        Documents written later with the watermark's own updatedAt are still
+        picked up; the ones already read at it are skipped by _id.
+        """
+        watermark = self._watermarks.get(name)
+        if watermark is None:
+            return {"updatedAt": {"$exists": True}}
+        mark, boundary = watermark
+        if not boundary:
+            return {"updatedAt": {"$gte": mark}}
+        return {
+            "$or": [
+                {"updatedAt": {"$gt": mark}},
+                {"updatedAt": mark, "_id": {"$nin": boundary}},
+            ]
+        }
+
+    @staticmethod
+    def _same_votes(old: sparse.csr_matrix | None, new: sparse.csr_matrix | None) -> bool:
+        """True if a patched vote matrix equals the one it was patched from."""
+        if old is None or new is None:
+            return old is new
+        return old.shape == new.shape and (old != new).nnz == 0
+
+    def _prepare_posts_df(self, posts_df: pd.DataFrame) -> pd.DataFrame:
+        # rename _id -> post_id is already done in get_posts()
+        # ensure post_id is string
+        if "post_id" in posts_df.columns:
+            posts_df["post_id"] = posts_df["post_id"].astype(str)
+
+        # ensure community_id is string if exists
+        if "community_id" in posts_df.columns:
+            posts_df["community_id"] = posts_df["community_id"].astype(str)
+
+        # ensure score column exists
+        if "score" not in posts_df.columns:
+            posts_df["score"] = 0
+
+        return posts_df
+
+    def _build_user_profiles(self, users_df: pd.DataFrame) -> Dict[str, Dict[str, Any]]:
+        user_profiles = {}
+        for _, row in users_df.iterrows():
+            uid = str(row.get("user_id") or row.get("_id"))
+            if not uid:
+                continue
+
+            num_posts = self._safe_int(row.get("num_posts"), 0)
+            num_comments = self._safe_int(row.get("num_comments"), 0)
+
+            total_votes = num_posts + num_comments
+
+            communities = row.get("communities_followed") or []
+            top_communities = {}
+            try:
+                for c in communities:
+                    top_communities[str(c)] = 1
+            except Exception:
+                top_communities = {}
+
+            user_profiles[uid] = {
+                "total_votes": total_votes,
+                "top_communities": top_communities,
+                "num_posts": num_posts,
+                "num_comments": num_comments,
+            }
+        return user_profiles
+
+    def _build_post_arrays(self, state: HeuristicsState):
+        """
+        Precompute the per-post columns used by cold-start scoring:
+        post ids, community codes, clipped popularity and the active mask.
+        """
+        posts_df = state.posts_df
+        if posts_df is None or posts_df.empty or "post_id" not in posts_df.columns:
+            empty = HeuristicsState()
+            state.post_ids = empty.post_ids
+            state.post_index = empty.post_index
+            state.post_community_codes = empty.post_community_codes
+            state.community_index = empty.community_index
+            state.post_popularity = empty.post_popularity
+            state.post_active = empty.post_active
+            self._build_popular_lists(state)
+            return
+
+        post_ids = posts_df["post_id"].astype(str).to_numpy(dtype=object)
+
+        # first row wins for duplicated ids, like the old boolean-mask lookup
+        post_index: Dict[str, int] = {}
+        for i, pid in enumerate(post_ids):
+            post_index.setdefault(pid, i)
+
+        if "community_id" in posts_df.columns:
+            codes, uniques = pd.factorize(posts_df["community_id"].astype(str))
+            community_index = {str(c): i for i, c in enumerate(uniques) if c}
+            # empty community ids never count as a match
+            empty_code = community_index.get("", -1)
+            codes = np.where(codes == empty_code, -1, codes).astype(np.int64)
+        else:
+            codes = np.full(len(post_ids), -1, dtype=np.int64)
+            community_index = {}
+
+        scores = pd.to_numeric(posts_df["score"], errors="coerce").to_numpy(dtype=np.float64)
+        # fmin keeps min(1.0, nan) == 1.0 semantics of the scalar formula
+        popularity = np.fmin(scores / 100.0, 1.0)
+
+        if "status" in posts_df.columns:
+            active = (posts_df["status"] == "active").to_numpy(dtype=bool)
+        else:
+            active = np.ones(len(post_ids), dtype=bool)
+
+        state.post_ids = post_ids
+        state.post_index = post_index
+        state.post_community_codes = codes
+        state.community_index = community_index
+        state.post_popularity = popularity
+        state.post_active = active
+        self._build_popular_lists(state)
+
+    def _build_popular_lists(self, state: HeuristicsState):
+        """
+        Most popular active posts overall and per community, for candidate generation.
+        Lists hold at least top_k posts, so for users without collaborative
+        evidence the candidates always contain the exact cold-start top-k.
+        """
+        n = max(CANDIDATE_POPULAR_K, self.top_k)
+        active_idx = np.flatnonzero(state.post_active)
+        # stable: equal popularity keeps post order, like _top_k_indices
+        order = active_idx[np.argsort(-state.post_popularity[active_idx], kind="stable")]
+        state.popular_posts = order[:n]
+
+        codes = state.post_community_codes[order]
+        order, codes = order[codes >= 0], codes[codes >= 0]
+        grouped = np.argsort(codes, kind="stable")
+        order, codes = order[grouped], codes[grouped]
+
+        starts = np.flatnonzero(np.diff(codes, prepend=-1))
+        ends = np.append(starts[1:], codes.size)
+        state.community_popular_posts = {
+            int(codes[start]): order[start:min(end, start + n)]
+            for start, end in zip(starts, ends)
+        }
+
+    def _reset_collaborative(self, state: HeuristicsState):
+        state.user_post_matrix = None
+        state.vote_user_index = {}
+        state.vote_post_index = {}
+        state.neighbour_ids = None
+        state.neighbour_sims = None
+        state.user_comment_matrix = None
+        state.comment_user_index = {}
+        state.vote_comment_index = {}
+
+    def _build_vote_matrix(
+        self, users: np.ndarray, targets: np.ndarray, values: np.ndarray
+    ) -> Tuple[sparse.csr_matrix, Dict[str, int], Dict[str, int]]:
+        """
+        Build a CSR user x target vote matrix from flattened vote arrays.
+        Returns the matrix with its row (user) and column (target) lookups.
+        """
+        user_ids, user_codes = np.unique(users, return_inverse=True)
+        target_ids, target_codes = np.unique(targets, return_inverse=True)
+
+        matrix = self._votes_to_csr(
+            user_codes, target_codes, values, (len(user_ids), len(target_ids))
+        )
+        user_index = {uid: i for i, uid in enumerate(user_ids)}
+        target_index = {tid: i for i, tid in enumerate(target_ids)}
+        return matrix, user_index, target_index
+
+    def _patch_vote_matrix(
+        self,
+        matrix: sparse.csr_matrix | None,
+        user_index: Dict[str, int],
+        target_index: Dict[str, int],
+        changed_users: List[str],
+        users: np.ndarray,
+        targets: np.ndarray,
+        values: np.ndarray,
+    ) -> Tuple[sparse.csr_matrix, Dict[str, int], Dict[str, int]]:
+        """
+        Replace the rows of changed_users with their current votes
+        (users/targets/values). New users and targets get appended rows / columns.
+        The inputs are left untouched; patched copies are returned.
+        """
+        user_index = dict(user_index)
+        target_index = dict(target_index)
+        for uid in changed_users:
+            user_index.setdefault(uid, len(user_index))
+        for uid in users:
+            user_index.setdefault(uid, len(user_index))
+        for tid in targets:
+            target_index.setdefault(tid, len(target_index))
+
+        shape = (len(user_index), len(target_index))
+        if matrix is None:
+            matrix = sparse.csr_matrix(shape, dtype=np.float32)
+        else:
+            matrix = matrix.copy()
+            matrix.resize(shape)
+
+        # drop the changed users' old rows, then add their current votes
+        keep = np.ones(shape[0], dtype=np.float32)
+        keep[[user_index[uid] for uid in changed_users]] = 0
+        matrix = sparse.diags(keep).dot(matrix)
+        if users.size:
+            user_codes = np.fromiter((user_index[u] for u in users), dtype=np.int64, count=users.size)
+            target_codes = np.fromiter((target_index[t] for t in targets), dtype=np.int64, count=targets.size)
+            matrix = matrix + self._votes_to_csr(user_codes, target_codes, values, shape)
+        matrix = matrix.tocsr()
+        matrix.eliminate_zeros()
+
+        return matrix, user_index, target_index
+
+    def _votes_to_csr(
+        self,
+        user_codes: np.ndarray,
+        target_codes: np.ndarray,
+        values: np.ndarray,
+        shape,
+    ) -> sparse.csr_matrix:
+        """
+        Vote coordinates -> CSR matrix.
+        Repeated (user, target) pairs are averaged, as pivot_table did.
+        """
+        totals = sparse.csr_matrix((values, (user_codes, target_codes)), shape=shape)
+        counts = sparse.csr_matrix(
+            (np.ones_like(values), (user_codes, target_codes)), shape=shape
+        )
+        # same sparsity pattern after summing duplicates, so data lines up
+        totals.sort_indices()
+        counts.sort_indices()
+        totals.data /= counts.data
+        totals.eliminate_zeros()
+        return totals
+
+    def _build_neighbour_index(self, state: HeuristicsState, top_n: int = COLLAB_TOP_N_NEIGHBOURS):
+        """
+        Precompute each user's top-N most cosine-similar users (self excluded).
+        Similarities are computed SIMILARITY_BLOCK_ROWS users at a time,
+        so memory stays O(block x users) instead of O(users^2).
+        Selection matches nlargest(keep="first"): ties go to the lower row,
+        and users without positive similarity still fill up the N slots.
+        """
+        matrix = self._similarity_features(state)
+        n_users = matrix.shape[0]
+        top_n = min(top_n, n_users - 1)
+        if top_n <= 0:
+            state.neighbour_ids = np.empty((n_users, 0), dtype=np.int32)
+            state.neighbour_sims = np.empty((n_users, 0), dtype=np.float32)
+            return
+
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        normalized = sparse.diags(1.0 / norms).dot(matrix).astype(np.float32).tocsr()
+        normalized_t = normalized.T.tocsr()
+
+        neighbour_ids = np.empty((n_users, top_n), dtype=np.int32)
+        neighbour_sims = np.empty((n_users, top_n), dtype=np.float32)
+        for start in range(0, n_users, SIMILARITY_BLOCK_ROWS):
+            stop = min(start + SIMILARITY_BLOCK_ROWS, n_users)
+            block = normalized[start:stop].dot(normalized_t).toarray()
+            rows = np.arange(stop - start)
+            block[rows, rows + start] = -np.inf
+
+            part = np.argpartition(-block, top_n - 1, axis=1)[:, :top_n]
+            part_sims = np.take_along_axis(block, part, axis=1)
+
+            # where more users tie at the cut than fit, the partition picked
+            # among them arbitrarily; give those slots to the lowest rows
+            kth = part_sims.min(axis=1, keepdims=True)
+            at_cut = part_sims == kth
+            tied = np.flatnonzero((block == kth).sum(axis=1) > at_cut.sum(axis=1))
+            if tied.size:
+                sub_part = part[tied]
+                sub_part[at_cut[tied]] = self._first_ties(block[tied], kth[tied], at_cut[tied])
+                part[tied] = sub_part
+
+            order = np.lexsort((part, -part_sims), axis=1)
+            neighbour_ids[start:stop] = np.take_along_axis(part, order, axis=1)
+            neighbour_sims[start:stop] = np.take_along_axis(part_sims, order, axis=1)
+
+        state.neighbour_ids = neighbour_ids
+        state.neighbour_sims = neighbour_sims
+
+    @staticmethod
+    def _first_ties(block: np.ndarray, kth: np.ndarray, at_cut: np.ndarray) -> np.ndarray:
+        """
+        Lowest columns equal to each row's kth value, as many per row as
+        at_cut marks, flattened row by row (the order of part[at_cut]).
+        """
+        ties = block == kth
+        rows = np.arange(block.shape[0])
+        firsts = np.empty(at_cut.shape, dtype=np.int64)
+        for j in range(at_cut.shape[1]):
+            firsts[:, j] = ties.argmax(axis=1)
+            ties[rows, firsts[:, j]] = False
+        # row i takes its first at_cut[i].sum() ties
+        return firsts[np.sort(at_cut, axis=1)[:, ::-1]]
+
+    def _similarity_features(self, state: HeuristicsState) -> sparse.csr_matrix:
+        """
+        Rows users are compared on: their post votes, followed by their comment
+        votes when the comment matrix is loaded (COLLAB_INCLUDE_COMMENT_VOTES),
+        so users who vote on the same comments count as neighbours too.
+        Rows follow user_post_matrix; comment-only voters are left out.
+        """
+        matrix = state.user_post_matrix
+        if state.user_comment_matrix is None:
+            return matrix
+
+        rows, comment_rows = [], []
+        for uid, row in state.vote_user_index.items():
+            comment_row = state.comment_user_index.get(uid)
+            if comment_row is not None:
+                rows.append(row)
+                comment_rows.append(comment_row)
+
+        # selection matrix: post-matrix row <- comment-matrix row of the same user
+        align = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, comment_rows)),
+            shape=(matrix.shape[0], state.user_comment_matrix.shape[0]),
+        )
+        return sparse.hstack([matrix, align.dot(state.user_comment_matrix)], format="csr")
 
-    def _load_votes_df(self) -> pd.DataFrame:
+    def _link_post_vote_cols(self, state: HeuristicsState):
+        """Align user_post_matrix columns with the cold-start post arrays."""
+        state.post_vote_cols = self._vote_cols_for(state, state.post_ids)
+
+        n_cols = state.user_post_matrix.shape[1] if state.user_post_matrix is not None else 0
+        vote_col_posts = np.full(n_cols, -1, dtype=np.int64)
+        # reversed so the first row wins for duplicated post ids, like post_index
+        voted = np.flatnonzero(state.post_vote_cols >= 0)[::-1]
+        vote_col_posts[state.post_vote_cols[voted]] = voted
+        state.vote_col_posts = vote_col_posts
+
+    def _vote_cols_for(self, state: HeuristicsState, post_ids) -> np.ndarray:
+        cols = state.vote_post_index
+        return np.fromiter(
+            (cols.get(str(pid), -1) for pid in post_ids),
+            dtype=np.int64,
+            count=len(post_ids),
+        )
+
+    def _load_vote_arrays(
+        self, target_type: str = "post", filter_query: Optional[Dict[str, Any]] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """
-        Read votes collection and flatten to rows:
-        Each votes document may look like your example:
+        Flatten the votes collection to (user_id, target_id, value) arrays.
+        Each votes document looks like:
         {
           _id: ...,
           user_id: ...,
           votes: {
             post: { target_ids: [...], value: 1 },
-            comment: { ... }
+            comment: { target_ids: [...], value: 1 }
           }
         }
-        We'll expand post votes into rows:
-        user_id, target_id, value, target_type='post'
+        The $unwind / $project runs inside MongoDB, so Python only sees
+        one small row per vote instead of walking every document.
+
+        Args:
+            target_type: "post" or "comment"
+            filter_query: Optional $match on the votes documents
+
+        Returns:
+            user ids and target ids (object arrays of str) and float32 values
         """
+        field = f"$votes.{target_type}"
+        pipeline = [
+            {"$match": filter_query or {}},
+            {
+                "$project": {
+                    "_id": 0,
+                    # user id stored as user_id (ObjectId or string)
+                    "user_id": {"$toString": {"$ifNull": ["$user_id", "$_id"]}},
+                    "target_id": f"{field}.target_ids",
+                    "value": {"$ifNull": [f"{field}.value", 0]},
+                }
+            },
+            {"$unwind": "$target_id"},
+            {
+                "$project": {
+                    "user_id": 1,
+                    "target_id": {"$toString": "$target_id"},
+                    "value": 1,
+                }
+            },
+        ]
         try:
-            rows = []
+            users, targets, values = [], [], []
             coll = self.db.get_collection("votes")
-            for doc in coll.find({}):
-                # user id stored as user_id (ObjectId or string)
-                uid = doc.get("user_id")
-                uid = str(uid) if uid is not None else str(doc.get("_id", ""))
-
-                votes = doc.get("votes", {}) or {}
-                post_votes = votes.get("post") or {}
-                if isinstance(post_votes, dict):
-                    target_ids = post_votes.get("target_ids", []) or []
-                    value = post_votes.get("value", 0) or 0
-                    value = self._safe_int(value, 0)
-
-                    for tid in target_ids:
-                        rows.append(
-                            {
-                                "user_id": uid,
-                                "target_id": str(tid),
-                                "value": value,
-                                "target_type": "post",
-                            }
-                        )
-
-                # You can also flatten comment votes here if you need them
-
-            if not rows:
-                return pd.DataFrame()
-            return pd.DataFrame(rows)
+            for row in coll.aggregate(pipeline, batchSize=MONGO_BATCH_SIZE):
+                users.append(row["user_id"])
+                targets.append(row["target_id"])
+                values.append(row["value"])
+
+            values = pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").fillna(0)
+            return (
+                np.asarray(users, dtype=object),
+                np.asarray(targets, dtype=object),
+                # same truncation as _safe_int on the stored value
+                np.trunc(values.to_numpy(dtype=np.float64)).astype(np.float32),
+            )
         except Exception as e:
-            logger.exception(f"[HEURISTICS] load_votes_df error: {e}")
-            return pd.DataFrame()
+            logger.exception(f"[HEURISTICS] load {target_type} votes error: {e}")
+            empty = np.empty(0, dtype=object)
+            return empty, empty, np.empty(0, dtype=np.float32)
 
     # ----------------- Cold-start detection -----------------
     def is_cold_start_user(self, user_id: str) -> bool:
@@ -236,7 +806,8 @@ class AdvancedTopKRecommender:
         """
         uid = str(user_id)
         pid = str(post_id)
-        user_prof = self.user_profiles.get(
+        state = self._state
+        user_prof = state.user_profiles.get(
             uid,
             {
                 "total_votes": 0,
@@ -246,18 +817,13 @@ class AdvancedTopKRecommender:
             },
         )
 
-        if self.posts_df is None or self.posts_df.empty:
-            return 0.5
-
-        post = self.posts_df[self.posts_df["post_id"] == pid]
-        if post.shape[0] == 0:
+        idx = state.post_index.get(pid)
+        if idx is None:
             return 0.5
 
-        post_community = str(post["community_id"].values[0]) if "community_id" in post.columns else ""
-        post_score = float(post["score"].values[0]) if "score" in post.columns else 0.0
-
-        community_match = 1.0 if post_community and post_community in user_prof.get("top_communities", {}) else 0.5
-        popularity_score = min(1.0, post_score / 100.0)
+        user_codes = self._user_community_codes(state, user_prof)
+        community_match = 1.0 if state.post_community_codes[idx] in user_codes else 0.5
+        popularity_score = state.post_popularity[idx]
         user_activity = min(
             1.0,
             (user_prof.get("num_posts", 0) + user_prof.get("num_comments", 0)) / 100.0,
@@ -266,80 +832,296 @@ class AdvancedTopKRecommender:
         cold_score = (community_match * 0.5) + (popularity_score * 0.3) + (user_activity * 0.2)
         return float(np.clip(cold_score, 0.0, 1.0))
 
+    def _user_community_codes(self, state: HeuristicsState, user_prof: Dict[str, Any]) -> np.ndarray:
+        """Map a user's followed communities onto the post community codes."""
+        codes = [
+            state.community_index[c]
+            for c in user_prof.get("top_communities", {})
+            if c in state.community_index
+        ]
+        return np.asarray(codes, dtype=np.int64)
+
+    def _score_cold_start_batch(
+        self, state: HeuristicsState, user_id: str, positions: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Vectorized _get_cold_start_score over every post in posts_df,
+        or only the posts at the given positions.
+        Returns a float array aligned with state.post_ids (or positions).
+        """
+        user_prof = state.user_profiles.get(
+            str(user_id),
+            {
+                "total_votes": 0,
+                "top_communities": {},
+                "num_posts": 0,
+                "num_comments": 0,
+            },
+        )
+
+        post_codes = state.post_community_codes
+        popularity = state.post_popularity
+        if positions is not None:
+            post_codes = post_codes[positions]
+            popularity = popularity[positions]
+
+        user_codes = self._user_community_codes(state, user_prof)
+        community_match = np.where(np.isin(post_codes, user_codes), 1.0, 0.5)
+        user_activity = min(
+            1.0,
+            (user_prof.get("num_posts", 0) + user_prof.get("num_comments", 0)) / 100.0,
+        )
+
+        cold_scores = (community_match * 0.5) + (popularity * 0.3) + (user_activity * 0.2)
+        return np.clip(cold_scores, 0.0, 1.0)
+
     def _get_collaborative_score(self, user_id: str, post_id: str) -> float:
         """
         Look at top-K similar users and average their votes on post_id.
         Returns 0.5 (neutral) if no evidence.
         """
         try:
-            if self.user_similarity_df is None or self.user_post_matrix is None:
-                return 0.5
+            return float(self.score_collaborative_batch(user_id, [post_id])[0])
+        except Exception as e:
+            logger.exception(f"[HEURISTICS] collaborative score error: {e}")
+            return 0.5
 
-            uid = str(user_id)
-            pid = str(post_id)
+    def score_collaborative_batch(self, user_id: str, post_ids) -> np.ndarray:
+        """
+        Collaborative score for many posts at once.
 
-            if uid not in self.user_similarity_df.index:
-                return 0.5
+        Resolves the user's neighbours once, then takes the mean non-zero
+        neighbour vote per post from a single sparse row/column slice.
 
-            sims = self.user_similarity_df[uid].nlargest(6)
-            # skip self
-            sims = sims.iloc[1:6] if len(sims) > 1 else sims.iloc[0:0]
+        Args:
+            user_id: User to score for
+            post_ids: Iterable of candidate post ids
 
-            votes = []
-            for sim_uid in sims.index:
-                if pid in self.user_post_matrix.columns and sim_uid in self.user_post_matrix.index:
-                    vote = self.user_post_matrix.at[sim_uid, pid]
-                    if vote != 0:
-                        votes.append(vote)
+        Returns:
+            float array aligned with post_ids; 0.5 (neutral) where there is no evidence
+        """
+        state = self._state
+        post_ids = list(post_ids)
+        return self._score_collaborative_cols(state, user_id, self._vote_cols_for(state, post_ids))
 
-            if votes:
-                score = float(np.clip(np.mean(votes), 0.0, 1.0))
-                return score
+    def _score_collaborative_cols(self, state: HeuristicsState, user_id: str, cols: np.ndarray) -> np.ndarray:
+        """score_collaborative_batch on user_post_matrix column indices (-1 = unknown post)."""
+        scores = np.full(cols.shape[0], 0.5, dtype=np.float64)
+        if state.user_post_matrix is None or state.neighbour_ids is None:
+            return scores
 
-            return 0.5
-        except Exception as e:
-            logger.exception(f"[HEURISTICS] collaborative score error: {e}")
-            return 0.5
+        row = state.vote_user_index.get(str(user_id))
+        if row is None:
+            return scores
 
-    # ----------------- Cold-start recommendation generator -----------------
-    def get_cold_start_recommendations(self, user_id: str, top_k: int = None) -> List[Dict[str, Any]]:
+        neighbours = state.neighbour_ids[row]
+        known = np.flatnonzero(cols >= 0)
+        if neighbours.size == 0 or known.size == 0:
+            return scores
+
+        votes = state.user_post_matrix[neighbours][:, cols[known]]
+        totals = np.asarray(votes.sum(axis=0, dtype=np.float64)).ravel()
+        counts = votes.getnnz(axis=0)
+
+        voted = counts > 0
+        scores[known[voted]] = np.clip(totals[voted] / counts[voted], 0.0, 1.0)
+        return scores
+
+    # ----------------- Two-stage pipeline -----------------
+    def generate_candidates(self, user_id: str) -> np.ndarray:
+        """
+        Stage 1: a few hundred candidates from cheap sources
+          - FAISS ANN on the user's stored profile embedding (CANDIDATE_ANN_K)
+          - most popular active posts of the user's communities and overall
+            (CANDIDATE_POPULAR_K each)
+          - posts the user's collaborative neighbours voted up (CANDIDATE_COLLAB_K)
+        Inactive posts and posts the user already voted on are dropped.
+
+        Returns:
+            Sorted positions into the current snapshot's post_ids
+        """
+        return self._generate_candidates(self._state, str(user_id))
+
+    def _generate_candidates(
+        self,
+        state: HeuristicsState,
+        uid: str,
+        ann_candidates: Optional[np.ndarray] = None,
+        exclude_seen: bool = True,
+    ) -> np.ndarray:
+        """
+        ann_candidates: precomputed _ann_candidates_batch result for uid.
+        exclude_seen=False keeps posts the user voted on (cold-start ranking).
+        """
+        if ann_candidates is None:
+            ann_candidates = self._ann_candidates(state, uid)
+        user_prof = state.user_profiles.get(uid, {})
+        sources = [ann_candidates, state.popular_posts]
+        sources.extend(
+            state.community_popular_posts.get(int(code), np.empty(0, dtype=np.int64))
+            for code in self._user_community_codes(state, user_prof)
+        )
+
+        row = state.vote_user_index.get(uid)
+        seen = np.empty(0, dtype=np.int64)
+        if row is not None and state.user_post_matrix is not None:
+            sources.append(self._collab_candidates(state, row))
+            if exclude_seen:
+                seen = state.vote_col_posts[state.user_post_matrix[row].indices]
+
+        candidates = np.unique(np.concatenate(sources).astype(np.int64))
+        candidates = candidates[candidates >= 0]
+        candidates = candidates[state.post_active[candidates]]
+        return np.setdiff1d(candidates, seen, assume_unique=True)
+
+    def _ann_candidates(self, state: HeuristicsState, uid: str) -> np.ndarray:
+        """Nearest posts to the user's stored profile embedding; empty if there is none."""
+        return self._ann_candidates_batch(state, [uid])[uid]
+
+    def _ann_candidates_batch(self, state: HeuristicsState, uids: List[str]) -> Dict[str, np.ndarray]:
+        """_ann_candidates for many users with a single 2-D FAISS query."""
+        empty = np.empty(0, dtype=np.int64)
+        candidates = {uid: empty for uid in uids}
+        if self.indexer is None or self.embedder is None or CANDIDATE_ANN_K <= 0:
+            return candidates
+
+        store = self.embedder.user_store
+        rows = store.rows_for(uids)
+        found_rows = np.flatnonzero(rows >= 0)
+        if found_rows.size == 0:
+            return candidates
+
+        try:
+            _, post_ids = self.indexer.search_batch(store.vectors[rows[found_rows]], k=CANDIDATE_ANN_K)
+        except Exception:
+            logger.exception("[HYBRID] ANN candidate search failed")
+            return candidates
+
+        for i, user_post_ids in zip(found_rows, post_ids):
+            found = user_post_ids.compressed()
+            candidates[uids[i]] = np.fromiter(
+                (state.post_index.get(str(pid), -1) for pid in found), dtype=np.int64, count=len(found)
+            )
+        return candidates
+
+    def _collab_candidates(self, state: HeuristicsState, row: int) -> np.ndarray:
+        """Posts most often voted up by the user's neighbours."""
+        if state.neighbour_ids is None or CANDIDATE_COLLAB_K <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        votes = state.user_post_matrix[state.neighbour_ids[row]]
+        cols, counts = np.unique(votes.indices[votes.data > 0], return_counts=True)
+        top = cols[np.argsort(-counts, kind="stable")[:CANDIDATE_COLLAB_K]]
+        return state.vote_col_posts[top]
+
+    def _rerank_candidates(
+        self, state: HeuristicsState, uid: str, candidates: np.ndarray, top_k: int
+    ) -> List[Dict[str, Any]]:
+        """Stage 2: 0.6 heuristic / 0.4 collaborative blend over the candidates only."""
+        cold_scores = self._score_cold_start_batch(state, uid, candidates)
+        collab_scores = self._score_collaborative_cols(state, uid, state.post_vote_cols[candidates])
+        final_scores = 0.6 * cold_scores + 0.4 * collab_scores
+
+        return [
+            {"item_id": str(state.post_ids[candidates[i]]), "score": float(final_scores[i]), "rank": rank}
+            for rank, i in enumerate(self._top_k_indices(final_scores, top_k), 1)
+        ]
+
+    def get_two_stage_recommendations(
+        self, user_id: str, top_k: int = None, exclude_seen: bool = True
+    ) -> List[Dict[str, Any]]:
+        """
+        Candidate generation followed by re-ranking; cost grows with the
+        candidate count, not the number of posts.
+
+        Args:
+            user_id: User to rank for
+            top_k: List length (default self.top_k)
+            exclude_seen: Drop posts the user already voted on
+        """
         if top_k is None:
             top_k = self.top_k
-        if self.posts_df is None or self.posts_df.empty:
+        state = self._state
+        if state.posts_df is None or state.posts_df.empty:
             return []
 
-        candidates: List[Dict[str, Any]] = []
-        for _, row in self.posts_df.iterrows():
-            pid = str(row["post_id"])
-
-            # only rank active posts if status exists
-            if "status" in row and row["status"] != "active":
-                continue
-
-            cold_score = self._get_cold_start_score(user_id, pid)
-            collab_score = self._get_collaborative_score(user_id, pid)
-            final_score = 0.6 * cold_score + 0.4 * collab_score
+        uid = str(user_id)
+        candidates = self._generate_candidates(state, uid, exclude_seen=exclude_seen)
+        if candidates.size == 0:
+            return []
+        return self._rerank_candidates(state, uid, candidates, top_k)
 
-            candidates.append({"item_id": pid, "score": float(final_score)})
+    def get_two_stage_recommendations_batch(
+        self, user_ids: List[str], top_k: int = None, exclude_seen: bool = True
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        get_two_stage_recommendations for many users on one snapshot; the ANN
+        stage runs as a single 2-D FAISS query for all of them.
+        """
+        if top_k is None:
+            top_k = self.top_k
+        uids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+        state = self._state
+        if state.posts_df is None or state.posts_df.empty:
+            return {uid: [] for uid in uids}
 
-        candidates.sort(key=lambda x: x["score"], reverse=True)
-        top = candidates[:top_k]
-        for i, item in enumerate(top, 1):
-            item["rank"] = i
+        ann_candidates = self._ann_candidates_batch(state, uids)
+        results = {}
+        for uid in uids:
+            candidates = self._generate_candidates(state, uid, ann_candidates[uid], exclude_seen)
+            results[uid] = self._rerank_candidates(state, uid, candidates, top_k) if candidates.size else []
+        return results
 
+    def _cache_recommendations(self, user_id: str, top: List[Dict[str, Any]], kind: str):
         # cache into upstash for quicker subsequent hits
         try:
             self.cache.store_user_recommendations(user_id, top)
         except Exception:
-            logger.exception("[HEURISTICS] failed caching cold-start recs")
+            logger.exception(f"[HEURISTICS] failed caching {kind} recs")
+
+    # ----------------- Cold-start recommendation generator -----------------
+    def get_cold_start_recommendations(self, user_id: str, top_k: int = None) -> List[Dict[str, Any]]:
+        # "cold" means no posts / comments yet; like the full-scan ranking this
+        # replaced, posts the user already voted on stay eligible
+        top = self.get_two_stage_recommendations(user_id, top_k, exclude_seen=False)
+        if not top:
+            return []
+
+        self._cache_recommendations(user_id, top, "cold-start")
+        return top
+
+    def get_cold_start_recommendations_batch(
+        self, user_ids: List[str], top_k: int = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """Cold-start lists for many users, cached through one Upstash pipeline."""
+        results = self.get_two_stage_recommendations_batch(user_ids, top_k, exclude_seen=False)
+        to_cache = {uid: top for uid, top in results.items() if top}
+        if to_cache:
+            try:
+                self.cache.store_batch_recommendations(to_cache)
+            except Exception:
+                logger.exception("[HEURISTICS] failed caching cold-start recs")
+        return results
 
+    # ----------------- Warm-user inline path -----------------
+    def get_warm_recommendations(self, user_id: str, top_k: int = None) -> List[Dict[str, Any]]:
+        """
+        Warm users computed in-process with the two-stage pipeline and cached,
+        so the API can answer without waiting on the Celery SBERT/FAISS task.
+        """
+        top = self.get_two_stage_recommendations(user_id, top_k)
+        if not top:
+            return []
+
+        self._cache_recommendations(user_id, top, "warm")
         return top
 
     # ----------------- Public entry for API -----------------
     def get_hybrid_recommendations(self, user_id: str) -> Dict[str, Any]:
         """
         Called by FastAPI:
-        - If cache hit -> return cached
+        - If cache hit -> return cached ('stale': True once past CACHE_EXPIRY_HOURS,
+          the caller should refresh it in the background)
         - If cold-start user -> compute and return cold_start recs (and cache them)
         - Otherwise -> return {'recommendations': None, 'source':'on_demand'} so caller may enqueue Celery
         """
@@ -347,13 +1129,14 @@ class AdvancedTopKRecommender:
 
         # cache check (Upstash)
         try:
-            cached = self.cache.get_user_recommendations(uid)
-            if cached:
+            cached = self.cache.get_user_recommendations_entry(uid)
+            if cached and cached[0]:
                 return {
                     "user_id": uid,
-                    "recommendations": cached,
+                    "recommendations": cached[0],
                     "source": "cache",
                     "strategy": "cache",
+                    "stale": cached[1],
                 }
         except Exception:
             logger.exception("Cache read failed")
@@ -378,6 +1161,44 @@ class AdvancedTopKRecommender:
             "strategy": "enqueue",
         }
 
+    async def aget_hybrid_recommendations(self, user_id: str) -> Dict[str, Any]:
+        """
+        get_hybrid_recommendations for the FastAPI event loop: the Upstash
+        lookup uses the async client and cold-start scoring (and caching)
+        runs in a worker thread, so concurrent requests are not serialized
+        behind it.
+        """
+        uid = str(user_id)
+
+        cached = await self.cache.aget_user_recommendations_entry(uid)
+        if cached and cached[0]:
+            return {
+                "user_id": uid,
+                "recommendations": cached[0],
+                "source": "cache",
+                "strategy": "cache",
+                "stale": cached[1],
+            }
+
+        if self.is_cold_start_user(uid):
+            logger.info(f"[HYBRID] Cold-start user detected: {uid}")
+            # same path (ranking and caching) as the sync, batch and revalidate callers
+            recs = await asyncio.to_thread(self.get_cold_start_recommendations, uid, self.top_k)
+            return {
+                "user_id": uid,
+                "recommendations": recs,
+                "source": "cold_start",
+                "strategy": "cold_start",
+            }
+
+        logger.info(f"[HYBRID] Cache miss and not cold-start for {uid}")
+        return {
+            "user_id": uid,
+            "recommendations": None,
+            "source": "on_demand",
+            "strategy": "enqueue",
+        }
+
 
 # singleton
 _recommender = None
@@ -1,10 +1,33 @@
-import json
+import asyncio
 import logging
-from typing import Any, List, Dict, Optional
+import threading
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from typing import Any, Iterable, List, Dict, Optional, Tuple
+import httpx
 from upstash_redis import Redis
 from upstash_redis.asyncio import Redis as AsyncRedis
 import os
 from dotenv import load_dotenv  
+from config import (
+    CACHE_BINARY_ENCODING,
+    CACHE_EXPIRY_HOURS,
+    CACHE_EXPIRY_JITTER,
+    CACHE_GENERATION_BUILD_TTL_SECONDS,
+    CACHE_GENERATION_POLL_SECONDS,
+    CACHE_SCAN_BATCH_SIZE,
+    CACHE_STALE_GRACE_HOURS,
+    LOCAL_CACHE_MAX_ENTRIES,
+    LOCAL_CACHE_TTL_SECONDS,
+    UPSTASH_KEEPALIVE_EXPIRY_SECONDS,
+    UPSTASH_MAX_CONNECTIONS,
+    UPSTASH_MAX_KEEPALIVE_CONNECTIONS,
+    UPSTASH_MGET_BATCH_SIZE,
+    UPSTASH_REST_RETRIES,
+    UPSTASH_TIMEOUT_SECONDS,
+)
+from recommendation_codec import decode_recommendations, encode_recommendations
 
 
 logger = logging.getLogger(__name__)
@@ -12,6 +35,135 @@ logger = logging.getLogger(__name__)
 # Load .env as soon as this module is imported
 load_dotenv()  
 
+# Nightly runs write recommendations:v{n}:{user_id} and flip GENERATION_KEY
+# to n once every user is written; until the first flip, entries live under
+# the unversioned recommendations:{user_id}. While a run writes, the
+# building marker of its generation (refreshed by every batch write) keeps
+# the garbage collector away from it.
+GENERATION_KEY = "recommendations_meta:generation"
+PREVIOUS_GENERATION_KEY = "recommendations_meta:previous_generation"
+NEXT_GENERATION_KEY = "recommendations_meta:next_generation"
+BUILDING_GENERATION_PREFIX = "recommendations_meta:building:"
+
+# invalidate_post rewrite, atomic per batch. KEYS[1]: post -> users set,
+# KEYS[1 + i]: list of member ARGV[3i - 2]; ARGV[3i - 1]: value read before
+# ("" if missing), ARGV[3i]: replacement ("" deletes, "=" leaves the list).
+# A list stored again since it was read keeps its value and its member, the
+# new list may contain the post again.
+_REPLACE_IF_UNCHANGED = """
+local changed = 0
+for i = 2, #KEYS do
+    local base = 3 * (i - 2)
+    if (redis.call('GET', KEYS[i]) or '') == ARGV[base + 2] then
+        local value = ARGV[base + 3]
+        if value == '' then
+            redis.call('DEL', KEYS[i])
+            changed = changed + 1
+        elseif value ~= '=' then
+            redis.call('SET', KEYS[i], value, 'KEEPTTL')
+            changed = changed + 1
+        end
+        redis.call('SREM', KEYS[1], ARGV[base + 1])
+    end
+end
+return changed
+"""
+
+
+def _use_http_client(client, http_client):
+    """
+    Swap the httpx client upstash_redis created (no timeout, default pool
+    limits) for one built from the UPSTASH_* pool settings; the library has
+    no constructor argument for it.
+    """
+    http = getattr(client, "_http", None)
+    if http is not None and hasattr(http, "_client"):
+        http._client = http_client
+
+
+def _parse_generation(value) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    return int(value)
+
+
+def _soft_ttl_seconds(user_id: str) -> float:
+    """CACHE_EXPIRY_HOURS stretched by up to CACHE_EXPIRY_JITTER, fixed per user."""
+    # crc32 rather than hash(): every process has to agree on the jitter
+    spread = zlib.crc32(str(user_id).encode("utf-8")) / 2 ** 32
+    return CACHE_EXPIRY_HOURS * 3600 * (1 + CACHE_EXPIRY_JITTER * spread)
+
+
+def _copy_entry(entry):
+    """Copy a (recommendations, timestamp) entry down to the recommendation dicts."""
+    recommendations, timestamp = entry
+    return [dict(rec) for rec in recommendations], timestamp
+
+
+class LocalLRUCache:
+    """
+    Size- and TTL-bounded in-process LRU for recommendation lists
+    (stored as (recommendations, timestamp) entries). Lists are copied on
+    set and get, so callers can modify what they get back without changing
+    the cached entry.
+
+    Entries are dropped when the process itself stores or clears a user;
+    writes made by other processes (Celery workers, other API workers)
+    show up once the local entry's TTL runs out.
+    """
+
+    def __init__(self, max_entries: int = LOCAL_CACHE_MAX_ENTRIES, ttl_seconds: float = LOCAL_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry[1]
+        return _copy_entry(value)
+
+    def set(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        value = _copy_entry(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
 
 
 class UpstashClient:
@@ -19,13 +171,239 @@ class UpstashClient:
         """Initialize Upstash Redis client"""
         self.sync_redis = Redis(
             url=os.getenv("UPSTASH_REDIS_REST_URL"),
-            token=os.getenv("UPSTASH_REDIS_REST_TOKEN")
-           
+            token=os.getenv("UPSTASH_REDIS_REST_TOKEN"),
+            rest_retries=UPSTASH_REST_RETRIES
         )
         self.async_redis = AsyncRedis(
             url=os.getenv("UPSTASH_REDIS_REST_URL"),
-            token=os.getenv("UPSTASH_REDIS_REST_TOKEN")
+            token=os.getenv("UPSTASH_REDIS_REST_TOKEN"),
+            rest_retries=UPSTASH_REST_RETRIES
+        )
+        # keep-alive pool shared by single calls and pipelines of each client
+        limits = httpx.Limits(
+            max_connections=UPSTASH_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTASH_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTASH_KEEPALIVE_EXPIRY_SECONDS,
+        )
+        timeout = httpx.Timeout(UPSTASH_TIMEOUT_SECONDS)
+        _use_http_client(self.sync_redis, httpx.Client(limits=limits, timeout=timeout))
+        _use_http_client(self.async_redis, httpx.AsyncClient(limits=limits, timeout=timeout))
+        # hot users are answered from memory before going to Upstash
+        self.local_cache = LocalLRUCache()
+        # generation pointer, re-read every CACHE_GENERATION_POLL_SECONDS
+        self._generation = None
+        self._generation_checked = float("-inf")
+
+    def _key(self, user_id: str, generation: Optional[int] = None) -> str:
+        if generation is None:
+            return f"recommendations:{user_id}"
+        return f"recommendations:v{generation}:{user_id}"
+
+    def _post_key(self, post_id: str, generation: Optional[int] = None) -> str:
+        if generation is None:
+            return f"post_users:{post_id}"
+        return f"post_users:v{generation}:{post_id}"
+
+    # ----------------- Cache generations -----------------
+    def current_generation(self) -> Optional[int]:
+        """Generation readers and single-user writes use (None: unversioned keys)."""
+        now = time.monotonic()
+        if now - self._generation_checked >= CACHE_GENERATION_POLL_SECONDS:
+            try:
+                self._generation = _parse_generation(self.sync_redis.get(GENERATION_KEY))
+                self._generation_checked = now
+            except Exception as e:
+                # keep serving the last known generation
+                logger.error(f"✗ Error reading cache generation: {str(e)}")
+        return self._generation
+
+    async def acurrent_generation(self) -> Optional[int]:
+        """Non-blocking current_generation."""
+        now = time.monotonic()
+        if now - self._generation_checked >= CACHE_GENERATION_POLL_SECONDS:
+            try:
+                self._generation = _parse_generation(await self.async_redis.get(GENERATION_KEY))
+                self._generation_checked = now
+            except Exception as e:
+                logger.error(f"✗ Error reading cache generation: {str(e)}")
+        return self._generation
+
+    def begin_generation(self) -> int:
+        """
+        Allocate a generation for a nightly run; readers do not see it until
+        publish_generation. It is marked as building for
+        CACHE_GENERATION_BUILD_TTL_SECONDS past the run's last batch write.
+        """
+        generation = int(self.sync_redis.incr(NEXT_GENERATION_KEY))
+        self.sync_redis.set(self._building_key(generation), 1, ex=CACHE_GENERATION_BUILD_TTL_SECONDS)
+        return generation
+
+    def _building_key(self, generation: int) -> str:
+        return f"{BUILDING_GENERATION_PREFIX}{generation}"
+
+    def publish_generation(self, generation: int) -> Optional[int]:
+        """
+        Point all readers at a fully written generation in one transaction
+        
+        Args:
+            generation: Generation from begin_generation
+        
+        Returns:
+            The generation it replaced (kept for rollback_generation)
+        """
+        previous = _parse_generation(self.sync_redis.get(GENERATION_KEY))
+        transaction = self.sync_redis.multi()
+        transaction.set(GENERATION_KEY, generation)
+        transaction.delete(self._building_key(generation))
+        if previous is not None:
+            transaction.set(PREVIOUS_GENERATION_KEY, previous)
+        else:
+            transaction.delete(PREVIOUS_GENERATION_KEY)
+        transaction.exec()
+
+        self._generation, self._generation_checked = generation, time.monotonic()
+        logger.info(f"✓ Published cache generation {generation} (previous: {previous})")
+        return previous
+
+    def rollback_generation(self) -> Optional[int]:
+        """
+        Point readers back at the previous generation
+        
+        Returns:
+            The generation now served, or None if there is nothing to roll back to
+        """
+        previous = _parse_generation(self.sync_redis.get(PREVIOUS_GENERATION_KEY))
+        if previous is None:
+            return None
+
+        transaction = self.sync_redis.multi()
+        transaction.set(GENERATION_KEY, previous)
+        transaction.delete(PREVIOUS_GENERATION_KEY)
+        transaction.exec()
+
+        self._generation, self._generation_checked = previous, time.monotonic()
+        logger.info(f"✓ Rolled cache back to generation {previous}")
+        return previous
+
+    def _live_generations(self) -> List[Optional[int]]:
+        """Current and previous generation, read from Upstash (not the polled copy)."""
+        current = _parse_generation(self.sync_redis.get(GENERATION_KEY))
+        previous = _parse_generation(self.sync_redis.get(PREVIOUS_GENERATION_KEY))
+        return [current] if previous is None else [current, previous]
+
+    def _collectable_generations(self) -> Tuple[Optional[int], Optional[int], set, int]:
+        """
+        State the garbage collector decides on, read from Upstash (not the polled copy)
+
+        Returns:
+            Tuple of (current, previous, building generations, last allocated generation)
+        """
+        # read the counter first: anything allocated after it is left alone
+        last_allocated = _parse_generation(self.sync_redis.get(NEXT_GENERATION_KEY)) or 0
+        current = _parse_generation(self.sync_redis.get(GENERATION_KEY))
+        previous = _parse_generation(self.sync_redis.get(PREVIOUS_GENERATION_KEY))
+
+        building = set()
+        cursor = 0
+        while True:
+            cursor, keys = self.sync_redis.scan(cursor, match=f"{BUILDING_GENERATION_PREFIX}*")
+            for key in keys:
+                if isinstance(key, bytes):
+                    key = key.decode()
+                building.add(int(key[len(BUILDING_GENERATION_PREFIX):]))
+            if int(cursor) == 0:
+                break
+        return current, previous, building, last_allocated
+
+    def collect_generations(self, batch_size: int = CACHE_SCAN_BATCH_SIZE) -> int:
+        """
+        Delete entries and reverse-index sets of generations nobody reads or writes
+
+        Collected: generations older than the previous one (or the current
+        one when there is no previous), and other unpublished / rolled-back
+        generations whose building marker has expired. A run that is still
+        writing keeps its marker alive and is never touched.
+
+        Args:
+            batch_size: SCAN page size
+
+        Returns:
+            Number of keys removed
+        """
+        current, previous, building, last_allocated = self._collectable_generations()
+        live = {generation for generation in (current, previous) if generation is not None}
+        oldest_live = min(live) if live else None
+
+        def collectable(generation):
+            if generation in live or generation > last_allocated:
+                return False
+            if oldest_live is not None and generation < oldest_live:
+                return True
+            return generation not in building
+
+        removed = 0
+        for pattern in ("recommendations:v*", "post_users:v*"):
+            cursor = 0
+            while True:
+                cursor, keys = self.sync_redis.scan(cursor, match=pattern, count=batch_size)
+                garbage = []
+                for key in keys:
+                    if isinstance(key, bytes):
+                        key = key.decode()
+                    try:
+                        generation = int(key.split(":")[1][1:])
+                    except ValueError:
+                        continue
+                    if collectable(generation):
+                        garbage.append(key)
+                if garbage:
+                    removed += self.sync_redis.unlink(*garbage)
+                if int(cursor) == 0:
+                    break
+
+        logger.info(
+            f"✓ Collected {removed} keys of old cache generations "
+            f"(current {current}, previous {previous}, building {sorted(building)})"
         )
+        return removed
+
+    def _index_posts(
+        self,
+        pipeline,
+        user_recommendations: Dict[str, List[Dict[str, Any]]],
+        ttl_seconds: int,
+        generation: Optional[int] = None,
+    ):
+        """
+        Queue post -> users reverse index updates on a pipeline: one SADD per
+        post with every user whose list contains it. The set's TTL follows the
+        newest entry, so it never outlives the lists it points to by much;
+        members whose list has since changed are skipped by invalidate_post.
+        """
+        users_by_post = defaultdict(list)
+        for user_id, recommendations in user_recommendations.items():
+            for rec in recommendations:
+                users_by_post[str(rec["item_id"])].append(user_id)
+
+        for post_id, user_ids in users_by_post.items():
+            post_key = self._post_key(post_id, generation)
+            pipeline.sadd(post_key, *user_ids)
+            pipeline.expire(post_key, ttl_seconds)
+
+    def _serialize(self, user_id: str, recommendations: List[Dict[str, Any]], timestamp: int) -> str:
+        # the user id is already in the key, so it is not repeated in the value
+        return encode_recommendations(recommendations, timestamp=timestamp, binary=CACHE_BINARY_ENCODING)
+
+    def _redis_ttl(self, expiry_hours: int) -> int:
+        # entries outlive their freshness by the grace period (stale-while-revalidate)
+        return (expiry_hours + CACHE_STALE_GRACE_HOURS) * 3600
+
+    def is_stale(self, timestamp: Optional[int], user_id: str) -> bool:
+        """
+        True once an entry is older than CACHE_EXPIRY_HOURS plus the user's
+        jitter (unknown age counts as fresh).
+        """
+        return timestamp is not None and time.time() - timestamp >= _soft_ttl_seconds(user_id)
 
     def store_user_recommendations(
         self, 
@@ -39,29 +417,33 @@ class UpstashClient:
         Args:
             user_id: Unique user identifier
             recommendations: List of recommendation dicts with item_id and score
-            expiry_hours: TTL in hours (default: 24)
+            expiry_hours: Freshness in hours (default: 24); the key itself lives
+                CACHE_STALE_GRACE_HOURS longer
         
         Returns:
             True if successful, False otherwise
         """
         try:
-            key = f"recommendations:{user_id}"
+            generation = self.current_generation()
+            key = self._key(user_id, generation)
+            timestamp = int(time.time())
             
-            # Serialize recommendations to JSON
-            value = json.dumps({
-                "user_id": user_id,
-                "recommendations": recommendations,
-                "timestamp": int(__import__('time').time())
-            })
+            # Serialize recommendations (compact binary unless disabled)
+            value = self._serialize(user_id, recommendations, timestamp)
             
-            # Store with expiration
-            expiry_seconds = expiry_hours * 3600
-            self.sync_redis.setex(key, expiry_seconds, value)
+            # Store with expiration; stale after expiry_hours, gone after the grace period
+            ttl_seconds = self._redis_ttl(expiry_hours)
+            pipeline = self.sync_redis.pipeline()
+            pipeline.setex(key, ttl_seconds, value)
+            self._index_posts(pipeline, {user_id: recommendations}, ttl_seconds, generation)
+            pipeline.exec()
+            self.local_cache.set(key, (recommendations, timestamp))
             
             logger.info(f"✓ Stored {len(recommendations)} recommendations for user {user_id}")
             return True
             
         except Exception as e:
+            self.local_cache.invalidate(self._key(user_id, self._generation))
             logger.error(f"✗ Error storing recommendations for {user_id}: {str(e)}")
             return False
 
@@ -73,16 +455,34 @@ class UpstashClient:
             user_id: Unique user identifier
         
         Returns:
-            List of recommendations or None if not cached
+            List of recommendations (possibly stale) or None if not cached
+        """
+        entry = self.get_user_recommendations_entry(user_id)
+        return entry[0] if entry else None
+
+    def get_user_recommendations_entry(self, user_id: str) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        Like get_user_recommendations, but also reports freshness
+        
+        Args:
+            user_id: Unique user identifier
+        
+        Returns:
+            Tuple of (recommendations, stale) or None if not cached
         """
         try:
-            key = f"recommendations:{user_id}"
+            key = self._key(user_id, self.current_generation())
+            local = self.local_cache.get(key)
+            if local is not None:
+                return local[0], self.is_stale(local[1], user_id)
+
             value = self.sync_redis.get(key)
             
             if value:
-                data = json.loads(value)
+                recommendations, timestamp = decode_recommendations(value)
                 logger.info(f"✓ Cache hit for user {user_id}")
-                return data["recommendations"]
+                self.local_cache.set(key, (recommendations, timestamp))
+                return recommendations, self.is_stale(timestamp, user_id)
             
             logger.info(f"✗ Cache miss for user {user_id}")
             return None
@@ -91,36 +491,181 @@ class UpstashClient:
             logger.error(f"✗ Error retrieving recommendations for {user_id}: {str(e)}")
             return None
 
+    def _entries_from_values(self, user_ids, keys, values) -> Dict[str, Optional[Tuple[List[Dict[str, Any]], bool]]]:
+        entries = {}
+        for user_id, key, value in zip(user_ids, keys, values):
+            if not value:
+                entries[user_id] = None
+                continue
+            recommendations, timestamp = decode_recommendations(value)
+            self.local_cache.set(key, (recommendations, timestamp))
+            entries[user_id] = (recommendations, self.is_stale(timestamp, user_id))
+        return entries
+
+    def _split_local(self, user_ids: Iterable[str], generation: Optional[int]):
+        """Answer what the local LRU can; returns (entries, user ids left for Upstash)."""
+        entries, missing = {}, []
+        for user_id in dict.fromkeys(str(user_id) for user_id in user_ids):
+            local = self.local_cache.get(self._key(user_id, generation))
+            if local is not None:
+                entries[user_id] = (local[0], self.is_stale(local[1], user_id))
+            else:
+                missing.append(user_id)
+        return entries, missing
+
+    def get_many(self, user_ids: Iterable[str]) -> Dict[str, Optional[List[Dict[str, Any]]]]:
+        """
+        Cached recommendations for many users (one MGET per UPSTASH_MGET_BATCH_SIZE)
+        
+        Args:
+            user_ids: Iterable of user identifiers
+        
+        Returns:
+            Dict user_id -> recommendations (possibly stale) or None if not cached
+        """
+        return {
+            user_id: entry[0] if entry else None
+            for user_id, entry in self.get_many_entries(user_ids).items()
+        }
+
+    def get_many_entries(
+        self, user_ids: Iterable[str], batch_size: int = UPSTASH_MGET_BATCH_SIZE
+    ) -> Dict[str, Optional[Tuple[List[Dict[str, Any]], bool]]]:
+        """get_many with freshness: user_id -> (recommendations, stale) or None."""
+        generation = self.current_generation()
+        entries, missing = self._split_local(user_ids, generation)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            keys = [self._key(user_id, generation) for user_id in batch]
+            try:
+                entries.update(self._entries_from_values(batch, keys, self.sync_redis.mget(*keys)))
+            except Exception as e:
+                logger.error(f"✗ Error retrieving recommendations for {len(batch)} users: {str(e)}")
+                entries.update((user_id, None) for user_id in batch)
+        return entries
+
+    # ----------------- Async variants (FastAPI request path) -----------------
+    async def astore_user_recommendations(
+        self, 
+        user_id: str, 
+        recommendations: List[Dict[str, Any]], 
+        expiry_hours: int = 24
+    ) -> bool:
+        """
+        Non-blocking store_user_recommendations for use inside the event loop;
+        Celery tasks keep using the blocking version.
+        """
+        try:
+            timestamp = int(time.time())
+            value = self._serialize(user_id, recommendations, timestamp)
+            generation = await self.acurrent_generation()
+            key = self._key(user_id, generation)
+            ttl_seconds = self._redis_ttl(expiry_hours)
+            pipeline = self.async_redis.pipeline()
+            pipeline.setex(key, ttl_seconds, value)
+            self._index_posts(pipeline, {user_id: recommendations}, ttl_seconds, generation)
+            await pipeline.exec()
+            self.local_cache.set(key, (recommendations, timestamp))
+            
+            logger.info(f"✓ Stored {len(recommendations)} recommendations for user {user_id}")
+            return True
+            
+        except Exception as e:
+            self.local_cache.invalidate(self._key(user_id, self._generation))
+            logger.error(f"✗ Error storing recommendations for {user_id}: {str(e)}")
+            return False
+
+    async def aget_user_recommendations(self, user_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Non-blocking get_user_recommendations; the HTTPS round trip to Upstash
+        no longer holds up other requests on the same worker.
+        """
+        entry = await self.aget_user_recommendations_entry(user_id)
+        return entry[0] if entry else None
+
+    async def aget_user_recommendations_entry(self, user_id: str) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """Non-blocking get_user_recommendations_entry: (recommendations, stale) or None."""
+        try:
+            key = self._key(user_id, await self.acurrent_generation())
+            local = self.local_cache.get(key)
+            if local is not None:
+                return local[0], self.is_stale(local[1], user_id)
+
+            value = await self.async_redis.get(key)
+            
+            if value:
+                recommendations, timestamp = decode_recommendations(value)
+                logger.info(f"✓ Cache hit for user {user_id}")
+                self.local_cache.set(key, (recommendations, timestamp))
+                return recommendations, self.is_stale(timestamp, user_id)
+            
+            logger.info(f"✗ Cache miss for user {user_id}")
+            return None
+            
+        except Exception as e:
+            logger.error(f"✗ Error retrieving recommendations for {user_id}: {str(e)}")
+            return None
+
+    async def aget_many_entries(
+        self, user_ids: Iterable[str], batch_size: int = UPSTASH_MGET_BATCH_SIZE
+    ) -> Dict[str, Optional[Tuple[List[Dict[str, Any]], bool]]]:
+        """Non-blocking get_many_entries; the MGET batches run concurrently."""
+        generation = await self.acurrent_generation()
+        entries, missing = self._split_local(user_ids, generation)
+        batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+
+        async def fetch(batch):
+            keys = [self._key(user_id, generation) for user_id in batch]
+            try:
+                return self._entries_from_values(batch, keys, await self.async_redis.mget(*keys))
+            except Exception as e:
+                logger.error(f"✗ Error retrieving recommendations for {len(batch)} users: {str(e)}")
+                return dict.fromkeys(batch)
+
+        for result in await asyncio.gather(*(fetch(batch) for batch in batches)):
+            entries.update(result)
+        return entries
+
     def store_batch_recommendations(
         self, 
         user_recommendations: Dict[str, List[Dict[str, Any]]], 
-        expiry_hours: int = 24
+        expiry_hours: int = 24,
+        generation: Optional[int] = None
     ) -> Dict[str, bool]:
         """
         Store recommendations for multiple users efficiently using pipeline
         
         Args:
             user_recommendations: Dict mapping user_id to their recommendations
-            expiry_hours: TTL in hours
+            expiry_hours: Freshness in hours (see store_user_recommendations)
+            generation: Write into this generation (nightly run building the
+                next one) instead of the current one
         
         Returns:
             Dict with success status for each user
         """
         try:
+            building = generation is not None
+            if generation is None:
+                generation = self.current_generation()
             pipeline = self.sync_redis.pipeline()
-            expiry_seconds = expiry_hours * 3600
+            expiry_seconds = self._redis_ttl(expiry_hours)
+            timestamp = int(time.time())
             
             results = {}
             for user_id, recommendations in user_recommendations.items():
-                key = f"recommendations:{user_id}"
-                value = json.dumps({
-                    "user_id": user_id,
-                    "recommendations": recommendations,
-                    "timestamp": int(__import__('time').time())
-                })
+                key = self._key(user_id, generation)
+                value = self._serialize(user_id, recommendations, timestamp)
                 
                 pipeline.setex(key, expiry_seconds, value)
+                self.local_cache.invalidate(key)
                 results[user_id] = True
+
+            # reverse index goes out in the same round trip as the lists
+            self._index_posts(pipeline, user_recommendations, expiry_seconds, generation)
+            if building:
+                # heartbeat: the run is alive, keep the collector off its generation
+                pipeline.set(self._building_key(generation), 1, ex=CACHE_GENERATION_BUILD_TTL_SECONDS)
             
             # Execute pipeline
             pipeline.exec()
@@ -131,10 +676,66 @@ class UpstashClient:
             logger.error(f"✗ Error in batch storage: {str(e)}")
             return {uid: False for uid in user_recommendations.keys()}
 
+    def invalidate_post(self, post_id: str, batch_size: int = CACHE_SCAN_BATCH_SIZE) -> int:
+        """
+        Drop a post (deleted, flagged, deactivated) from every cached list that
+        contains it, using the post -> users reverse index
+        
+        Affected lists are rewritten without the post (ranks closed up, original
+        timestamp and TTL kept); a list left empty is deleted. Other users'
+        entries are not touched. Applies to the current and the previous
+        generation, so a rollback does not bring the post back.
+        
+        Args:
+            post_id: Post to remove
+            batch_size: Users per MGET / write pipeline
+        
+        Returns:
+            Number of cached lists changed
+        """
+        post_id = str(post_id)
+        changed = 0
+        try:
+            for generation in self._live_generations():
+                changed += self._invalidate_post_in(post_id, generation, batch_size)
+            logger.info(f"✓ Removed post {post_id} from {changed} cached recommendation lists")
+        except Exception as e:
+            logger.error(f"✗ Error invalidating post {post_id}: {str(e)}")
+        return changed
+
+    def _invalidate_post_in(self, post_id: str, generation: Optional[int], batch_size: int) -> int:
+        post_key = self._post_key(post_id, generation)
+        changed = 0
+        user_ids = list(self.sync_redis.smembers(post_key) or [])
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            keys = [self._key(user_id, generation) for user_id in batch]
+            values = self.sync_redis.mget(*keys)
+
+            args = []
+            for user_id, key, value in zip(batch, keys, values):
+                self.local_cache.invalidate(key)
+                replacement = "="
+                if value:
+                    recommendations, timestamp = decode_recommendations(value)
+                    kept = [rec for rec in recommendations if str(rec["item_id"]) != post_id]
+                    # same length: list was recomputed since it was indexed
+                    if len(kept) < len(recommendations):
+                        kept = [dict(rec, rank=rank) for rank, rec in enumerate(kept, 1)]
+                        replacement = self._serialize(user_id, kept, timestamp) if kept else ""
+                args.extend([user_id, value or "", replacement])
+
+            # compare-and-set: lists written since the MGET are left alone, and
+            # members added to the set meanwhile are kept for the next invalidation
+            changed += int(self.sync_redis.eval(_REPLACE_IF_UNCHANGED, keys=[post_key] + keys, args=args))
+
+        return changed
+
     def clear_recommendations(self, user_id: str) -> bool:
         """Delete recommendations for a user"""
         try:
-            key = f"recommendations:{user_id}"
+            key = self._key(user_id, self.current_generation())
+            self.local_cache.invalidate(key)
             self.sync_redis.delete(key)
             logger.info(f"✓ Cleared recommendations for user {user_id}")
             return True